@@ -1,68 +1,174 @@
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from datetime import date
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from app.database import get_db
-from app.schemas.magazine import MagazineBase, MagazineResponse
-from app.services.magazine_service import save_magazine, query_magazine, hybrid_search
+from app.database import get_read_db, get_write_db
+from app.schemas.magazine import (
+    FacetsResponse, IngestJobAccepted, IngestJobResponse, MagazineBase, MagazineResponse, SearchFilters,
+    parse_on_duplicate, parse_result_fields,
+)
+from app.services.magazine_service import (
+    save_magazine, save_magazines_bulk, query_magazine, hybrid_search, get_facets, export_magazines, submit_ingest_job,
+    get_ingest_job,
+)
+from app.util.ingest_worker import notify_ingest_workers
+from app.util.pagination import decode_cursor
+from app.util.responses import ENCODES_AVOIDED_HEADER, empty_search_response, json_response
+from app.util.timing import TimedRoute
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-@router.post("/magazine", response_model=List[MagazineBase], status_code=status.HTTP_201_CREATED)
-def store_magazines(magazine_data: List[MagazineBase], db: Session = Depends(get_db)):
+@router.post("/magazine", response_model=List[MagazineBase], status_code=status.HTTP_201_CREATED,
+             responses={status.HTTP_202_ACCEPTED: {"model": IngestJobAccepted}})
+def store_magazines(magazine_data: List[MagazineBase], response: Response, db: Session = Depends(get_write_db),
+                    bulk: bool = Query(False, description="Encode and insert the whole batch in a single transaction"),
+                    job: bool = Query(False, description="Stage the batch and return 202 with an ingest job to poll"),
+                    on_duplicate: str = Query(None, description=
+                                              "For contents already stored: skip, update_metadata or insert")):
     try:
         logger.info("Received a request to store magazines.")
+        on_duplicate = parse_on_duplicate(on_duplicate)
+
+        if job:
+            accepted = submit_ingest_job(db, magazine_data, on_duplicate)
+            notify_ingest_workers()
+            logger.info(f"Staged {accepted.total} magazines as ingest job {accepted.job_id}.")
+            return json_response(accepted, status_code=status.HTTP_202_ACCEPTED)
+
+        if bulk:
+            saved_magazines, encodes_avoided = save_magazines_bulk(db, magazine_data, on_duplicate)
+            logger.info(f"Total {len(saved_magazines)} magazines bulk saved successfully.")
+            response.headers[ENCODES_AVOIDED_HEADER] = str(encodes_avoided)
+            return saved_magazines
+
         saved_magazines = []
+        encodes_avoided = 0
 
         for magazine in magazine_data:
             logger.debug(f"Processing magazine with title: {magazine.title}")
-            saved_magazines.append(save_magazine(db, magazine))
+            saved_magazine, avoided = save_magazine(db, magazine, on_duplicate)
+            saved_magazines.append(saved_magazine)
+            encodes_avoided += avoided
             logger.debug(f"Magazine with title '{magazine.title}")
 
         logger.info(f"Total {len(saved_magazines)} magazines saved successfully.")
+        response.headers[ENCODES_AVOIDED_HEADER] = str(encodes_avoided)
         return saved_magazines
+    except ValueError as e:
+        logger.warning(f"Rejected store request: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error occurred while storing magazines: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.get("/magazine", response_model=MagazineResponse, status_code=status.HTTP_200_OK)
-def search_magazine(db: Session = Depends(get_db),
+def search_magazine(db: Session = Depends(get_read_db),
                     search: str = Query(None, description="Search query for magazines"),
                     page: int = Query(1, description="Search query for magazines"),
-                    page_size: int = Query(10, description="Search query for magazines")):
+                    page_size: int = Query(10, description="Search query for magazines"),
+                    category: str = Query(None, description="Only magazines in this category"),
+                    author: str = Query(None, description="Only magazines by this author"),
+                    published_from: date = Query(None, description="Only magazines published on or after this date"),
+                    published_to: date = Query(None, description="Only magazines published on or before this date"),
+                    fields: str = Query(None, description="Comma separated result fields, e.g. id,title,snippet")):
     try:
         logger.info(f"Received a search request with query: '{search}', page: {page}, page_size: {page_size}")
+        filters = SearchFilters(category=category, author=author, published_from=published_from,
+                                published_to=published_to)
+        result_fields = parse_result_fields(fields)
 
         if not search:
             logger.warning("Search query is empty. Returning empty results.")
-            return MagazineResponse(results=[], total_count=0)
+            return empty_search_response(page, page_size)
         
-        result = query_magazine(db=db, query=search, page=page, page_size=page_size)
+        result = query_magazine(db=db, query=search, page=page, page_size=page_size, filters=filters,
+                                fields=result_fields)
         logger.info(f"Search completed successfully. Found {len(result.magazines)} results.")
-        return result
+        return json_response(result)
+    except ValueError as e:
+        logger.warning(f"Rejected search request: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error occurred during search: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
 @router.get("/magazine/best", response_model=MagazineResponse, status_code=status.HTTP_200_OK)
-def search_magazine(db: Session = Depends(get_db),
+def search_magazine(db: Session = Depends(get_read_db),
                     search: str = Query(None, description="Search query for magazines"),
                     page: int = Query(1, description="Search query for magazines"),
-                    page_size: int = Query(10, description="Search query for magazines")):
+                    page_size: int = Query(10, description="Search query for magazines"),
+                    cursor: str = Query(None, description="next_cursor from the previous page, replaces page for deep scrolling"),
+                    category: str = Query(None, description="Only magazines in this category"),
+                    author: str = Query(None, description="Only magazines by this author"),
+                    published_from: date = Query(None, description="Only magazines published on or after this date"),
+                    published_to: date = Query(None, description="Only magazines published on or before this date"),
+                    fields: str = Query(None, description="Comma separated result fields, e.g. id,title,snippet")):
     try:
         logger.info(f"Received a hybrid search request with query: '{search}', page: {page}, page_size: {page_size}")
+        filters = SearchFilters(category=category, author=author, published_from=published_from,
+                                published_to=published_to)
+        result_fields = parse_result_fields(fields)
 
         if not search:
             logger.warning("Search query is empty. Returning empty results.")
-            return MagazineResponse(results=[], total_count=0)
+            return empty_search_response(page, page_size)
         
-        result = hybrid_search(db=db, query=search, page=page, page_size=page_size)
+        result = hybrid_search(db=db, query=search, page=page, page_size=page_size,
+                               cursor=decode_cursor(cursor) if cursor else None, filters=filters,
+                               fields=result_fields)
         logger.info(f"Hybrid search completed successfully. Found {len(result.magazines)} results.")
-        return result
+        return json_response(result)
+    except ValueError as e:
+        logger.warning(f"Rejected hybrid search request: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error occurred during hybrid search: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    
+
+# Magazines per category and per publication year, read from the trigger maintained aggregate
+@router.get("/magazine/facets", response_model=FacetsResponse, status_code=status.HTTP_200_OK)
+def magazine_facets(db: Session = Depends(get_read_db)):
+    try:
+        logger.info("Received a facet counts request.")
+        return get_facets(db)
+    except Exception as e:
+        logger.error(f"Error occurred while reading facet counts: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+# Streams the whole corpus (or the filtered part of it) as NDJSON in id order. Rows come from a server-side
+# cursor, so memory stays flat however large the export, and an interrupted export resumes with after_id.
+@router.get("/magazine/export", status_code=status.HTTP_200_OK)
+def export_magazine(include_embeddings: bool = Query(False, description="Add each magazine's content embedding"),
+                    after_id: int = Query(None, description="Only magazines with a larger id, the last id received to resume"),
+                    max_id: int = Query(None, description="Only magazines up to this id"),
+                    category: str = Query(None, description="Only magazines in this category"),
+                    author: str = Query(None, description="Only magazines by this author"),
+                    published_from: date = Query(None, description="Only magazines published on or after this date"),
+                    published_to: date = Query(None, description="Only magazines published on or before this date")):
+    try:
+        logger.info(f"Received an export request after id {after_id} up to id {max_id}.")
+        filters = SearchFilters(category=category, author=author, published_from=published_from,
+                                published_to=published_to)
+        return StreamingResponse(export_magazines(filters, after_id, max_id, include_embeddings),
+                                 media_type="application/x-ndjson")
+    except ValueError as e:
+        logger.warning(f"Rejected export request: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+# Progress, per-record failures and throughput of an ingest job. Read from the primary: the workers update it
+# there and a replica could lag behind.
+@router.get("/magazine/jobs/{job_id}", response_model=IngestJobResponse, status_code=status.HTTP_200_OK)
+def ingest_job_status(job_id: int, db: Session = Depends(get_write_db)):
+    try:
+        job = get_ingest_job(db, job_id)
+    except Exception as e:
+        logger.error(f"Error occurred while reading ingest job {job_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Ingest job {job_id} not found")
+    return job
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app.services.magazine_service import search_count_cache, search_result_cache
+from app.util.metrics import render_metrics
+from app.util.startup import readiness
+from app.util.utils import query_embedding_cache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# hit ratio, evictions and memory use of the per-worker caches, used to size them
+@router.get("/cache/stats", status_code=status.HTTP_200_OK)
+def cache_stats():
+    return {
+        "search_results": search_result_cache.stats(),
+        "search_counts": search_count_cache.stats(),
+        "query_embeddings": query_embedding_cache.stats(),
+    }
+
+# Prometheus scrape target: per-stage latency histograms, request latency by route and connection pool usage
+@router.get("/metrics", response_class=PlainTextResponse, status_code=status.HTTP_200_OK)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# liveness only says the process is up and serving, it never depends on the database or model
+@router.get("/health/live", status_code=status.HTTP_200_OK)
+def health_live():
+    return {"status": "alive"}
+
+# ready once tables, indexes and the model are in place, 503 until then
+@router.get("/health/ready", status_code=status.HTTP_200_OK)
+def health_ready():
+    ready, checks, errors = readiness()
+    body = {"status": "ready" if ready else "starting", "checks": checks}
+    if errors:
+        body["errors"] = errors
+    if not ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+    return body
@@ -0,0 +1,300 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import count, cycle
+
+import numpy as np
+import requests
+
+from app.data_loader import create_session, process_magazines
+from app.data_loader_relevant import generate_magazine_batch, seed_generator, titles
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reproducible load test for the three API endpoints:
+#
+#   python -m app.benchmark seed --size 100k                      # deterministic corpus, loaded through the API
+#   python -m app.benchmark run --size 100k --concurrency 16 --duration 60 --output results/100k.json
+#   python -m app.benchmark compare results/before.json results/after.json
+
+API_URL = "http://localhost:8000/api/magazine"
+CORPUS_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+DEFAULT_MIX = "search=0.45,best=0.45,post=0.10"
+CORPUS_FIELDS = ["title", "author", "category", "content", "publish_date"]
+
+
+def parse_size(size: str):
+    if size.lower() in CORPUS_SIZES:
+        return CORPUS_SIZES[size.lower()]
+    return int(size)
+
+# "search=0.45,best=0.45,post=0.1" -> {"search": 0.45, ...}, unknown endpoints are rejected
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' in query mix, expected: {', '.join(ENDPOINTS)}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+def corpus_path(size: int, seed: int, directory: str = "benchmarks"):
+    return os.path.join(directory, f"corpus-{size}-seed{seed}.csv")
+
+# Writes size synthetic magazines to a CSV in the format data_loader and precompute read. The same size
+# and seed always produce the same file, so runs on different releases search the same corpus.
+def write_corpus(path: str, size: int, seed: int, batch_size: int = 10000):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    seed_generator(seed)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", newline="") as corpus_file:
+        writer = csv.DictWriter(corpus_file, fieldnames=CORPUS_FIELDS)
+        writer.writeheader()
+        for start in range(0, size, batch_size):
+            writer.writerows(generate_magazine_batch(min(batch_size, size - start)))
+    os.replace(temp_path, path)
+    logger.info(f"Wrote {size} magazines to {path}.")
+
+# Generates the corpus once and loads it, through the bulk API by default or through the offline precompute
+# pipeline, which is the practical route for 1M rows. Every API seed starts from row 0; the data_loader
+# checkpoint of an earlier seed is only followed with resume, for continuing an interrupted seed of the same
+# database.
+def seed_corpus(size: int, seed: int = 42, url: str = API_URL, concurrency: int = 4, batch_size: int = 500,
+                loader: str = "api", directory: str = "benchmarks", resume: bool = False):
+    path = corpus_path(size, seed, directory)
+    if not os.path.exists(path):
+        write_corpus(path, size, seed)
+
+    if loader == "precompute":
+        from app.precompute import precompute
+
+        precompute(path)
+        return True
+
+    checkpoint_path = path + ".checkpoint"
+    if not resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+        logger.info(f"Removed the checkpoint of an earlier seed, loading {path} from the first row.")
+    return process_magazines(path, batch_size=batch_size, concurrency=concurrency,
+                             checkpoint_path=checkpoint_path, url=url)
+
+# Short search phrases built from the generator's titles, so queries hit both legs of the hybrid search
+def build_query_pool(seed: int, size: int = 500):
+    rng = random.Random(seed)
+    words = sorted({
+        word.lower() for title in sum(titles.values(), [])
+        for word in re.findall(r"[A-Za-z]+", title) if len(word) > 3
+    })
+    return [" ".join(rng.sample(words, rng.choice((1, 1, 2, 2, 3)))) for _ in range(size)]
+
+def build_post_pool(seed: int, size: int, batch_size: int):
+    seed_generator(seed)
+    return [generate_magazine_batch(batch_size) for _ in range(size)]
+
+
+def search_request(session, url, rng, context):
+    params = {"search": rng.choice(context["queries"]), "page": rng.randint(1, context["max_page"]),
+              "page_size": context["page_size"]}
+    return session.get(url, params=params, timeout=context["timeout"])
+
+def best_request(session, url, rng, context):
+    params = {"search": rng.choice(context["queries"]), "page": rng.randint(1, context["max_page"]),
+              "page_size": context["page_size"]}
+    return session.get(url + "/best", params=params, timeout=context["timeout"])
+
+# The pooled batches are reused with a suffix unique to the run and the request, so every POST sends contents
+# the database has not seen and pays for its encodes instead of taking the duplicate path
+def post_request(session, url, rng, context):
+    request_id = next(context["post_ids"])
+    batch = [
+        {**magazine, "content": f"{magazine['content']} Issue {context['run_id']}-{request_id}-{index}."}
+        for index, magazine in enumerate(next(context["posts"]))
+    ]
+    return session.post(url, json=batch, timeout=context["timeout"])
+
+
+ENDPOINTS = {
+    "search": search_request,
+    "best": best_request,
+    "post": post_request,
+}
+
+
+# One closed-loop client: picks an endpoint by the mix weights, waits for the response, repeats until the
+# deadline. Samples taken during the warm-up are dropped.
+def run_worker(worker: int, session, url, weights, context, warmup_until, deadline):
+    rng = random.Random(context["seed"] * 1000 + worker)
+    names, probabilities = list(weights), list(weights.values())
+    samples = []
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, probabilities)[0]
+        started = time.perf_counter()
+        try:
+            response = ENDPOINTS[name](session, url, rng, context)
+            status_code = response.status_code
+            encodes_avoided = int(response.headers.get("X-Encodes-Avoided", 0))
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"{name} request failed: {e}")
+            status_code, encodes_avoided = 0, 0
+        finished = time.perf_counter()
+        if started >= warmup_until:
+            samples.append((name, (finished - started) * 1000, status_code, encodes_avoided))
+    return samples
+
+def summarize(samples, seconds: float):
+    latencies = np.array([latency for _, latency, _, _ in samples]) if samples else np.zeros(1)
+    statuses = Counter(str(status_code) for _, _, status_code, _ in samples)
+    errors = sum(count for status_code, count in statuses.items() if not 200 <= int(status_code) < 400)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput_rps": len(samples) / seconds if seconds else 0.0,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean": float(latencies.mean()),
+            "max": float(latencies.max()),
+        },
+        "status_codes": dict(statuses),
+        # records answered from stored embeddings, stays 0 unless POSTs hit the duplicate path
+        "encodes_avoided": sum(encodes_avoided for _, _, _, encodes_avoided in samples),
+    }
+
+def run_benchmark(url: str = API_URL, concurrency: int = 8, duration: float = 60, warmup: float = 5,
+                  mix: str = DEFAULT_MIX, seed: int = 42, page_size: int = 10, max_page: int = 3,
+                  post_batch_size: int = 10, timeout: float = 30, corpus_size: int = None):
+    weights = parse_mix(mix)
+    context = {
+        "seed": seed,
+        "queries": build_query_pool(seed),
+        # posted magazines come from a different seed than the corpus so they are new rows
+        "posts": cycle(build_post_pool(seed + 1, 200, post_batch_size)) if "post" in weights else None,
+        "post_ids": count(),
+        "run_id": uuid.uuid4().hex[:12],
+        "page_size": page_size,
+        "max_page": max_page,
+        "timeout": timeout,
+    }
+    session = create_session(concurrency)
+
+    logger.info(f"Running {concurrency} clients for {warmup}s warm-up + {duration}s against {url} ({mix}).")
+    started_at = datetime.now(timezone.utc).isoformat()
+    warmup_until = time.perf_counter() + warmup
+    deadline = warmup_until + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_worker, worker, session, url, weights, context, warmup_until, deadline)
+            for worker in range(concurrency)
+        ]
+        samples = [sample for future in futures for sample in future.result()]
+
+    return {
+        "config": {
+            "url": url,
+            "corpus_size": corpus_size,
+            "seed": seed,
+            "concurrency": concurrency,
+            "duration_seconds": duration,
+            "warmup_seconds": warmup,
+            "mix": weights,
+            "page_size": page_size,
+            "max_page": max_page,
+            "post_batch_size": post_batch_size,
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "host": platform.node(),
+        },
+        "endpoints": {
+            name: summarize([sample for sample in samples if sample[0] == name], duration) for name in weights
+        },
+        "overall": summarize(samples, duration),
+    }
+
+# Side by side latency and throughput of two result files, changes are reported relative to the baseline
+def compare_results(baseline_path: str, candidate_path: str):
+    with open(baseline_path) as baseline_file, open(candidate_path) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    report = {}
+    for name in ["overall"] + sorted(set(baseline["endpoints"]) & set(candidate["endpoints"])):
+        before = baseline[name] if name == "overall" else baseline["endpoints"][name]
+        after = candidate[name] if name == "overall" else candidate["endpoints"][name]
+        report[name] = {
+            metric: {"baseline": before_value, "candidate": after_value,
+                     "change": (after_value - before_value) / before_value if before_value else None}
+            for metric, before_value, after_value in [
+                ("p50_ms", before["latency_ms"]["p50"], after["latency_ms"]["p50"]),
+                ("p95_ms", before["latency_ms"]["p95"], after["latency_ms"]["p95"]),
+                ("p99_ms", before["latency_ms"]["p99"], after["latency_ms"]["p99"]),
+                ("throughput_rps", before["throughput_rps"], after["throughput_rps"]),
+                ("error_rate", before["error_rate"], after["error_rate"]),
+            ]
+        }
+    return report
+
+def write_json(report, output: str = None):
+    payload = json.dumps(report, indent=2)
+    if output:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as output_file:
+            output_file.write(payload + "\n")
+        logger.info(f"Wrote benchmark report to {output}.")
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a deterministic corpus and load test the magazine API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Generate and load a deterministic synthetic corpus")
+    seed_parser.add_argument("--size", default="10k", help="10k, 100k, 1m or a row count")
+    seed_parser.add_argument("--seed", type=int, default=42)
+    seed_parser.add_argument("--loader", choices=["api", "precompute"], default="api")
+    seed_parser.add_argument("--concurrency", type=int, default=4)
+    seed_parser.add_argument("--batch-size", type=int, default=500)
+    seed_parser.add_argument("--url", default=API_URL)
+    seed_parser.add_argument("--resume", action="store_true",
+                             help="Continue an interrupted seed from its checkpoint instead of loading from row 0")
+
+    run_parser = commands.add_parser("run", help="Drive the endpoints and report latency percentiles as JSON")
+    run_parser.add_argument("--size", default=None, help="Corpus size the database was seeded with, recorded in the report")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=60, help="Measured seconds")
+    run_parser.add_argument("--warmup", type=float, default=5, help="Seconds of load before measuring")
+    run_parser.add_argument("--mix", default=DEFAULT_MIX, help="Endpoint weights, e.g. search=0.5,best=0.5")
+    run_parser.add_argument("--page-size", type=int, default=10)
+    run_parser.add_argument("--max-page", type=int, default=3, help="Pages are drawn uniformly from 1..max-page")
+    run_parser.add_argument("--post-batch-size", type=int, default=10, help="Magazines per POST request")
+    run_parser.add_argument("--output", default=None, help="JSON report path, printed to stdout when omitted")
+    run_parser.add_argument("--url", default=API_URL)
+
+    compare_parser = commands.add_parser("compare", help="Diff two benchmark reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed_corpus(parse_size(args.size), args.seed, args.url, args.concurrency, args.batch_size, args.loader,
+                    resume=args.resume)
+    elif args.command == "run":
+        write_json(run_benchmark(
+            args.url, args.concurrency, args.duration, args.warmup, args.mix, args.seed, args.page_size,
+            args.max_page, args.post_batch_size, corpus_size=parse_size(args.size) if args.size else None,
+        ), args.output)
+    else:
+        write_json(compare_results(args.baseline, args.candidate))
@@ -3,4 +3,129 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
\ No newline at end of file
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Read/write split: DATABASE_URL is the primary, written to by ingestion, migrations and start-up, and
+# DATABASE_READ_URLS an optional comma separated list of streaming replicas the search routes are spread across.
+# Reads fall back to the primary while no replica is healthy; a replica whose connection fails is skipped for
+# READ_REPLICA_RETRY_SECONDS. Each replica (and the primary's read pool) gets READ_POOL_SIZE + READ_MAX_OVERFLOW
+# connections, kept apart from the WRITE_POOL_SIZE + WRITE_MAX_OVERFLOW ingestion connections.
+DATABASE_READ_URLS = [url.strip() for url in os.getenv("DATABASE_READ_URLS", "").split(",") if url.strip()]
+READ_REPLICA_RETRY_SECONDS = float(os.getenv("READ_REPLICA_RETRY_SECONDS", "30"))
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "40"))
+READ_MAX_OVERFLOW = int(os.getenv("READ_MAX_OVERFLOW", "40"))
+WRITE_POOL_SIZE = int(os.getenv("WRITE_POOL_SIZE", "10"))
+WRITE_MAX_OVERFLOW = int(os.getenv("WRITE_MAX_OVERFLOW", "10"))
+
+# selected this model looking at its speed and performance ratio
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "multi-qa-MiniLM-L6-cos-v1")
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "384"))
+# EMBEDDING_MODEL_NAME only seeds a fresh database, after that the active model is the one recorded in
+# embedding_model_state, which every process re-reads every EMBEDDING_MODEL_CHECK_SECONDS to follow a re-embed
+EMBEDDING_MODEL_CHECK_SECONDS = float(os.getenv("EMBEDDING_MODEL_CHECK_SECONDS", "5"))
+# Re-embedding (`python -m app.util.reembed`): rows per batch (one encode and one transaction), the most rows
+# per second the job may process and the intra-op threads of its model, so live traffic keeps its CPU
+REEMBED_BATCH_SIZE = int(os.getenv("REEMBED_BATCH_SIZE", "256"))
+REEMBED_MAX_ROWS_PER_SECOND = float(os.getenv("REEMBED_MAX_ROWS_PER_SECOND", "200"))
+REEMBED_THREADS = int(os.getenv("REEMBED_THREADS", "1"))
+
+# Embedding backend: "sentence-transformers" (float32 PyTorch) or "onnx" (ONNX Runtime, int8 quantized by default)
+# loaded from a local directory produced by `python -m app.embedding_tools export`
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers")
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH")
+EMBEDDING_ONNX_QUANTIZED = os.getenv("EMBEDDING_ONNX_QUANTIZED", "true").lower() == "true"
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+
+# Bulk ingestion tuning: sentences per model.encode forward pass and rows per multi-row INSERT
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+INGEST_INSERT_CHUNK_SIZE = int(os.getenv("INGEST_INSERT_CHUNK_SIZE", "500"))
+
+# Ingest jobs (POST /magazine?job=true): staged records are embedded and inserted in the background by
+# INGEST_WORKERS threads per API process (0 leaves it to `python -m app.util.ingest_worker`), claiming
+# INGEST_JOB_BATCH_SIZE records per transaction and polling every INGEST_POLL_SECONDS while idle
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_JOB_BATCH_SIZE = int(os.getenv("INGEST_JOB_BATCH_SIZE", "256"))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "1"))
+# What ingest does with a magazine whose content is already stored (same content hash) when the request doesn't
+# pass on_duplicate: "insert" writes another row reusing the stored embedding, "skip" returns the stored magazine
+# and "update_metadata" gives the stored magazine the submitted title, author, category and publish date
+INGEST_ON_DUPLICATE = os.getenv("INGEST_ON_DUPLICATE", "insert")
+# per-record failures listed by GET /magazine/jobs/{id}
+INGEST_JOB_FAILURES_REPORTED = int(os.getenv("INGEST_JOB_FAILURES_REPORTED", "100"))
+
+# Query embedding cache: max cached queries (0 disables) and entry lifetime in seconds (0 keeps until evicted)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+
+# Micro-batching of concurrent query encodings: largest batch per forward pass and how long to wait to fill it
+EMBEDDING_BATCHING_ENABLED = os.getenv("EMBEDDING_BATCHING_ENABLED", "true").lower() == "true"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+
+# Hybrid search: candidates fetched per leg, HNSW search breadth and the reciprocal rank fusion constant
+SEARCH_CANDIDATE_K = int(os.getenv("SEARCH_CANDIDATE_K", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "200"))
+# pgvector >= 0.8 iterative index scans for filtered vector legs ("relaxed_order", "strict_order" or "off"), so
+# the HNSW scan keeps going until enough rows pass the filters instead of post-filtering a fixed ef_search window
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Search result cache: max cached responses, entry lifetime in seconds and memory cap in MB
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "300"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "64"))
+# Lifetime in seconds of search responses served by a read replica, which can lag behind the write that
+# invalidated the caches
+REPLICA_RESULT_CACHE_TTL = float(os.getenv("REPLICA_RESULT_CACHE_TTL", "5"))
+
+# Vector storage: "full" searches the float32 column, "halfvec" / "binary" search a compact copy (created by
+# `python -m app.util.migrations compact-vectors`) and re-rank oversample x candidate_k rows with full precision
+VECTOR_STORAGE_MODE = os.getenv("VECTOR_STORAGE_MODE", "full")
+VECTOR_RERANK_OVERSAMPLE = int(os.getenv("VECTOR_RERANK_OVERSAMPLE", "4"))
+
+# Vector search engine: "postgres" (pgvector) or "local", a memory-mapped flat index in LOCAL_INDEX_PATH shared
+# by all workers on the host, synced from the database every LOCAL_INDEX_SYNC_SECONDS
+VECTOR_SEARCH_ENGINE = os.getenv("VECTOR_SEARCH_ENGINE", "postgres")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "data/vector_index")
+LOCAL_INDEX_SYNC_SECONDS = float(os.getenv("LOCAL_INDEX_SYNC_SECONDS", "5"))
+LOCAL_INDEX_SYNC_LOOKBACK = int(os.getenv("LOCAL_INDEX_SYNC_LOOKBACK", "1000"))
+
+# Async request path: asyncpg engine, async routes and encoding on a dedicated executor, so one worker can hold
+# many in-flight searches that wait on Postgres. ASYNC_DATABASE_URL defaults to DATABASE_URL with the asyncpg driver
+ASYNC_MODE = os.getenv("ASYNC_MODE", "false").lower() == "true"
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (
+    DATABASE_URL and "postgresql+asyncpg://" + DATABASE_URL.split("://", 1)[1]
+)
+ASYNC_DATABASE_READ_URLS = [url.strip() for url in os.getenv("ASYNC_DATABASE_READ_URLS", "").split(",") if url.strip()] or [
+    "postgresql+asyncpg://" + url.split("://", 1)[1] for url in DATABASE_READ_URLS
+]
+EMBEDDING_EXECUTOR_THREADS = int(os.getenv("EMBEDDING_EXECUTOR_THREADS", "2"))
+# requests queue in the event loop for a connection, so the async pool can stay well below the request concurrency
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "20"))
+ASYNC_MAX_OVERFLOW = int(os.getenv("ASYNC_MAX_OVERFLOW", "10"))
+
+# Multi-worker server (python -m app.server): worker processes, and the model's intra-op threads per worker
+# (0 splits the CPU count evenly between the workers so they don't oversubscribe the cores)
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+SERVER_THREADS_PER_WORKER = int(os.getenv("SERVER_THREADS_PER_WORKER", "0"))
+# Directory where the server's workers share their metrics, so /metrics covers every worker whichever one
+# the scrape lands on (a fresh temporary directory when unset)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+# total_results of GET /magazine: exact for tables of at most SEARCH_COUNT_SAMPLE_ROWS rows, otherwise estimated
+# from a block sample of about that many rows (and flagged total_is_approximate). Estimates up to
+# SEARCH_COUNT_CAP are raised to the keyword matches, counted through the index up to that cap
+SEARCH_COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", "1000"))
+SEARCH_COUNT_SAMPLE_ROWS = int(os.getenv("SEARCH_COUNT_SAMPLE_ROWS", "10000"))
+
+# snippet field of search results: ts_headline excerpts of at most SNIPPET_MAX_FRAGMENTS fragments of
+# SNIPPET_MIN_WORDS to SNIPPET_MAX_WORDS words, with the matched words wrapped in <b></b>
+SNIPPET_MAX_WORDS = int(os.getenv("SNIPPET_MAX_WORDS", "35"))
+SNIPPET_MIN_WORDS = int(os.getenv("SNIPPET_MIN_WORDS", "15"))
+SNIPPET_MAX_FRAGMENTS = int(os.getenv("SNIPPET_MAX_FRAGMENTS", "2"))
+
+# GET /magazine/export: rows fetched per round trip from the server-side cursor, which bounds the memory an
+# export holds whatever its size
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
@@ -1,36 +1,45 @@
+import argparse
+import ast
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+API_URL = "http://localhost:8000/api/magazine"
+
+
+# One pooled keep-alive session shared by every in-flight batch
+def create_session(concurrency):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({'Content-Type': 'application/json'})
+    return session
+
 # Call the API to add magazines
-def call_api(magazines_batch):
-    url = "http://localhost:8000/api/magazine"
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    
+def call_api(session, url, magazines_batch):
     try:
-        # Send POST request to the API
-        response = requests.post(url, json=magazines_batch, headers=headers)
+        # Send POST request to the API using the bulk ingestion mode. Contents that are already stored are
+        # skipped, so batches re-sent on resume don't insert their rows a second time
+        response = session.post(url, params={"bulk": "true", "on_duplicate": "skip"}, json=magazines_batch)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        
-        # Parse the JSON response
-        result = response.json()
-        # print(result)
-        # print(type(result))
+
         # Check if the response contains the expected structure
+        result = response.json()
         if isinstance(result, list):
-            for magazine in result:
-                logger.info(f"Magazine {magazine['id']} added successfully.")
             return True
         else:
             logger.error("Unexpected response format from API.")
             return False
-    
+
     except requests.exceptions.RequestException as e:
         logger.error(f"API call failed: {e}")
         return False
@@ -38,38 +47,112 @@ def call_api(magazines_batch):
         logger.error(f"Failed to decode JSON response: {e}")
         return False
 
-# Main processing function
-def process_magazines(file_path, batch_size=10, max_records=None):
-    try:
-        # Read entire CSV file using pandas
-        df = pd.read_csv(file_path)
+# content cells hold a python list of sentences, parse them without eval
+def parse_content(value):
+    if isinstance(value, str) and value.startswith('['):
+        return ' '.join(ast.literal_eval(value))
+    return value
 
-        # Ensure 'publish_date' column is in the correct format
-        df['publish_date'] = pd.to_datetime(df['publish_date'], format='%Y-%m-%d').dt.strftime('%Y-%m-%d')
+def read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path) as checkpoint:
+        return int(checkpoint.read().strip() or 0)
 
-        # Concatenate content sentences before processing and update the 'content' column
-        df['content'] = df['content'].apply(lambda x: ' '.join(eval(x)) if isinstance(x, str) else x)
+# written through a temp file so a crash never leaves a half written checkpoint behind
+def write_checkpoint(checkpoint_path, committed_rows):
+    temp_path = checkpoint_path + ".tmp"
+    with open(temp_path, "w") as checkpoint:
+        checkpoint.write(str(committed_rows))
+    os.replace(temp_path, checkpoint_path)
 
-        magazines = df.to_dict(orient='records')
+# Streams (start_row, batch) pairs chunk by chunk, so memory stays flat regardless of file size
+def stream_batches(file_path, batch_size, chunk_size, skip_rows, max_records=None):
+    row = skip_rows
+    reader = pd.read_csv(file_path, chunksize=chunk_size, skiprows=range(1, skip_rows + 1))
 
-        # Limit records to process if max_records is provided
-        if max_records:
-            magazines = magazines[:max_records]
+    for chunk in reader:
+        # Ensure 'publish_date' column is in the correct format
+        chunk['publish_date'] = pd.to_datetime(chunk['publish_date'], format='%Y-%m-%d').dt.strftime('%Y-%m-%d')
+        chunk['content'] = chunk['content'].apply(parse_content)
+        magazines = chunk.to_dict(orient='records')
 
-        # Process in batches of 10 records
         for i in range(0, len(magazines), batch_size):
-            batch = magazines[i:i+batch_size]
-            success = call_api(batch)
-            
-            if not success:
-                logger.error("Error while processing batch, halting further operations.")
-                break
+            if max_records is not None and row >= max_records:
+                return
+            batch = magazines[i:i + batch_size]
+            if max_records is not None:
+                batch = batch[:max_records - row]
+            yield row, batch
+            row += len(batch)
+
+# Main processing function
+def process_magazines(file_path, batch_size=100, max_records=None, concurrency=4,
+                      chunk_size=10000, checkpoint_path=None, url=API_URL):
+    checkpoint_path = checkpoint_path or file_path + ".checkpoint"
+    committed_rows = read_checkpoint(checkpoint_path)
+    if committed_rows:
+        logger.info(f"Resuming from checkpoint, skipping {committed_rows} already committed rows.")
+
+    session = create_session(concurrency)
+    # batches can complete out of order, the checkpoint only advances over a contiguous prefix
+    finished = {}
+    in_flight = {}
+    failed = False
+    loaded_rows = 0
+    started = time.perf_counter()
+
+    def collect(done):
+        nonlocal committed_rows, failed, loaded_rows
+        for future in done:
+            start_row, size = in_flight.pop(future)
+            if future.result():
+                finished[start_row] = size
+                loaded_rows += size
+            else:
+                failed = True
+        while committed_rows in finished:
+            committed_rows += finished.pop(committed_rows)
+        write_checkpoint(checkpoint_path, committed_rows)
+        elapsed = time.perf_counter() - started
+        logger.info(f"Committed {committed_rows} rows ({loaded_rows / elapsed:.1f} rows/sec).")
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for start_row, batch in stream_batches(file_path, batch_size, chunk_size, committed_rows, max_records):
+                # bounded number of in-flight batches keeps memory flat
+                while len(in_flight) >= concurrency and not failed:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                if failed:
+                    break
+                in_flight[executor.submit(call_api, session, url, batch)] = (start_row, len(batch))
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
 
     except Exception as e:
         logger.error(f"Error during processing: {e}")
+        failed = True
+
+    elapsed = time.perf_counter() - started
+    if failed:
+        logger.error(f"Error while processing batch, halting. Resume will restart from row {committed_rows}.")
+    logger.info(f"Loaded {loaded_rows} rows in {elapsed:.1f}s ({loaded_rows / elapsed if elapsed else 0:.1f} rows/sec).")
+    return not failed
 
 
-batch_size = 10
-max_records = 100
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream magazines from a CSV file into the API.")
+    parser.add_argument("file_path", nargs="?", default="app/fake_magazines.csv")
+    parser.add_argument("--batch-size", type=int, default=100, help="Records per POST request")
+    parser.add_argument("--max-records", type=int, default=None, help="Stop after this many rows")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent in-flight batches")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="CSV rows read into memory at a time")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file, defaults to <file_path>.checkpoint")
+    parser.add_argument("--url", default=API_URL)
+    args = parser.parse_args()
 
-process_magazines("app/fake_magazines.csv", batch_size, max_records)
+    process_magazines(args.file_path, args.batch_size, args.max_records, args.concurrency,
+                      args.chunk_size, args.checkpoint, args.url)
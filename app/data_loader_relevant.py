@@ -1,4 +1,5 @@
 import requests
+from datetime import date
 from faker import Faker
 import random
 import logging
@@ -70,13 +71,21 @@ titles = {
         'Income tax deductions: What you can claim and how to maximize savings'
     ]
 }
+# fixed publish date range, so a seeded corpus doesn't depend on the day it is generated
+PUBLISH_DATE_RANGE = (date(2000, 1, 1), date(2024, 12, 31))
+
+# Seeds both random and Faker so generate_magazine_batch produces the same corpus on every run
+def seed_generator(seed: int):
+    random.seed(seed)
+    fake.seed_instance(seed)
+
 def generate_magazine_batch(batch_size: int):
     
     batch = []
     for _ in range(batch_size):
         category = random.choice(categories)
         title = random.choice(titles[category])
-        publish_date = fake.date_this_century()
+        publish_date = fake.date_between_dates(*PUBLISH_DATE_RANGE)
         
         magazine = {
             'title': title,
@@ -129,5 +138,6 @@ def add_data_to_database(total_count: int = 50, batch_size: int = 10):
     logger.info("Data generation completed")
     
     
-# Generate 50 magazines in batches of 10
-add_data_to_database(50, 10)
\ No newline at end of file
+if __name__ == "__main__":
+    # Generate 50 magazines in batches of 10
+    add_data_to_database(50, 10)
@@ -1,23 +1,190 @@
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from app.config import DATABASE_URL
-
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=50,
-    max_overflow=50,
-    pool_timeout=10,
-    pool_recycle=3600,
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from app.config import (
+    ASYNC_DATABASE_READ_URLS, ASYNC_DATABASE_URL, ASYNC_MAX_OVERFLOW, ASYNC_MODE, ASYNC_POOL_SIZE, DATABASE_READ_URLS,
+    DATABASE_URL, READ_MAX_OVERFLOW, READ_POOL_SIZE, READ_REPLICA_RETRY_SECONDS, WRITE_MAX_OVERFLOW, WRITE_POOL_SIZE,
 )
+from app.util.metrics import Gauge, pool_checkout_wait, register_pool_metrics
+from app.util.replicas import ReadReplicas
+from app.util.timing import add_to_request
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# records how long each pool checkout waited for a free connection, labelled with the pool it came from
+class TimedCheckoutMixin:
+    metrics_label = ""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            pool_checkout_wait.observe(waited, pool=self.metrics_label)
+            add_to_request("db_checkout", waited)
+
+    # dispose() replaces the pool with a fresh one (e.g. in every forked worker), which keeps the label
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_label = self.metrics_label
+        return pool
+
+class TimedQueuePool(TimedCheckoutMixin, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+# Read engines run every transaction READ ONLY and ping connections on checkout, so a replica that went
+# away is noticed when a session opens rather than halfway through a search
+READ_ENGINE_OPTIONS = {"pool_pre_ping": True, "execution_options": {"postgresql_readonly": True}}
+
+def create_pooled_engine(url: str, pool_size: int, max_overflow: int, metrics_prefix: str, pool_label: str,
+                         **kwargs):
+    pooled_engine = create_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=10,
+        pool_recycle=3600,
+        **kwargs,
+    )
+    pooled_engine.pool.metrics_label = pool_label
+    register_pool_metrics(pooled_engine, pool_size + max_overflow, prefix=metrics_prefix)
+    return pooled_engine
+
+# The primary, for ingestion, migrations, start-up and the CLIs
+engine = create_pooled_engine(DATABASE_URL, WRITE_POOL_SIZE, WRITE_MAX_OVERFLOW, "magazine_db_pool", "write")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Search traffic gets its own pools: one per replica, plus one on the primary for when no replica is
+# configured or healthy, so reads and ingestion never wait on each other's connections
+read_engine = create_pooled_engine(DATABASE_URL, READ_POOL_SIZE, READ_MAX_OVERFLOW, "magazine_db_read_pool", "read",
+                                   **READ_ENGINE_OPTIONS)
+read_replicas = ReadReplicas(
+    [create_pooled_engine(url, READ_POOL_SIZE, READ_MAX_OVERFLOW, f"magazine_db_replica_{index}_pool",
+                          f"replica-{index}", **READ_ENGINE_OPTIONS)
+     for index, url in enumerate(DATABASE_READ_URLS)],
+    read_engine,
+    READ_REPLICA_RETRY_SECONDS,
+)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+Gauge("magazine_db_read_replicas_healthy", "Read replicas currently taking search traffic.",
+      read_replicas.healthy_count)
+
 Base = declarative_base()
 
-# Dependency for database session
-def get_db():
+# every sync engine of this process, for disposing them after a fork
+def sync_engines():
+    return [engine, read_engine, *read_replicas.engines]
+
+# Dependency for a write session on the primary
+def get_write_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Read only session on the first replica (in round robin order) that hands out a connection, else the primary
+def open_read_session():
+    for candidate in read_replicas.candidates():
+        db = ReadSessionLocal(bind=candidate)
+        try:
+            db.connection()
+            db.info["replica"] = candidate is not read_replicas.primary
+            return db
+        except DBAPIError as e:
+            db.close()
+            if candidate is read_replicas.primary:
+                raise
+            read_replicas.mark_down(candidate, e)
+
+# Dependency for a read session, used by the search routes
+def get_read_db():
+    db = open_read_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# asyncpg engines for the async request path, only created in ASYNC_MODE so asyncpg stays optional. They
+# mirror the sync split: the write engine on the primary and read engines of ASYNC_POOL_SIZE +
+# ASYNC_MAX_OVERFLOW connections each. Start-up tasks, migrations and the CLIs keep using the sync engine.
+async_engine = None
+async_read_replicas = None
+AsyncSessionLocal = None
+AsyncReadSessionLocal = None
+if ASYNC_MODE:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    def create_pooled_async_engine(url: str, pool_size: int, max_overflow: int, metrics_prefix: str, pool_label: str,
+                                   **kwargs):
+        pooled_engine = create_async_engine(
+            url,
+            poolclass=TimedAsyncAdaptedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=10,
+            pool_recycle=3600,
+            **kwargs,
+        )
+        pooled_engine.pool.metrics_label = pool_label
+        register_pool_metrics(pooled_engine, pool_size + max_overflow, prefix=metrics_prefix)
+        return pooled_engine
+
+    async_engine = create_pooled_async_engine(ASYNC_DATABASE_URL, WRITE_POOL_SIZE, WRITE_MAX_OVERFLOW,
+                                              "magazine_db_async_pool", "async-write")
+    async_read_replicas = ReadReplicas(
+        [create_pooled_async_engine(url, ASYNC_POOL_SIZE, ASYNC_MAX_OVERFLOW,
+                                    f"magazine_db_async_replica_{index}_pool", f"async-replica-{index}",
+                                    **READ_ENGINE_OPTIONS)
+         for index, url in enumerate(ASYNC_DATABASE_READ_URLS)],
+        create_pooled_async_engine(ASYNC_DATABASE_URL, ASYNC_POOL_SIZE, ASYNC_MAX_OVERFLOW,
+                                   "magazine_db_async_read_pool", "async-read", **READ_ENGINE_OPTIONS),
+        READ_REPLICA_RETRY_SECONDS,
+    )
+    Gauge("magazine_db_async_read_replicas_healthy", "Read replicas currently taking async search traffic.",
+          async_read_replicas.healthy_count)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    AsyncReadSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+# every async engine of this process, disposed on shutdown
+def async_engines():
+    if async_engine is None:
+        return []
+    return [async_engine, *async_read_replicas.engines, async_read_replicas.primary]
+
+# Dependency for an async write session on the primary
+async def get_async_write_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# async counterpart of open_read_session
+async def open_async_read_session():
+    for candidate in async_read_replicas.candidates():
+        db = AsyncReadSessionLocal(bind=candidate)
+        try:
+            await db.connection()
+            db.info["replica"] = candidate is not async_read_replicas.primary
+            return db
+        except (DBAPIError, OSError) as e:
+            await db.close()
+            if candidate is async_read_replicas.primary:
+                raise
+            async_read_replicas.mark_down(candidate, e)
+
+# Dependency for an async read session, used by the async search routes
+async def get_async_read_db():
+    db = await open_async_read_session()
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -0,0 +1,130 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app.config import EMBEDDING_BATCH_SIZE, EMBEDDING_MODEL_NAME
+from app.database import engine
+from app.util.embedding_backends import BACKENDS, SentenceTransformerBackend, create_backend
+
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Tooling for the embedding backends:
+#
+#   python -m app.embedding_tools export models/minilm-onnx      # ONNX + int8 quantized copy of the model
+#   python -m app.embedding_tools compare --backend onnx         # cosine agreement and speed vs PyTorch
+
+
+# Exports the transformer of the sentence transformer model to ONNX (token embeddings out, pooling is done
+# by OnnxBackend) next to its tokenizer, plus a dynamically int8 quantized copy of the graph
+def export_onnx(output_dir: str, model_name: str = EMBEDDING_MODEL_NAME, quantize: bool = True, opset: int = 14):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    transformer = SentenceTransformer(model_name, device="cpu")[0]
+    hf_model = transformer.auto_model.eval()
+    tokenizer = transformer.tokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+    hf_model.config.save_pretrained(output_dir)
+
+    sample = tokenizer(["warm up"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    model_file = os.path.join(output_dir, "model.onnx")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["token_embeddings"]}
+    torch.onnx.export(
+        TokenEmbeddings(hf_model),
+        tuple(sample[name] for name in input_names),
+        model_file,
+        input_names=input_names,
+        output_names=["token_embeddings"],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset,
+    )
+    logger.info(f"Exported ONNX model to {model_file}.")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_file = os.path.join(output_dir, "model_quantized.onnx")
+        quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8)
+        logger.info(f"Wrote int8 quantized model to {quantized_file}.")
+
+def sample_contents(samples: int):
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT content FROM magazine_content ORDER BY random() LIMIT :samples"), {"samples": samples}
+        ).scalars().all()
+
+def timed_encode(backend, texts):
+    started = time.perf_counter()
+    embeddings = np.asarray(backend.encode(texts, batch_size=EMBEDDING_BATCH_SIZE), dtype=np.float32)
+    return embeddings, time.perf_counter() - started
+
+# Encodes the same stored contents with both backends and reports how closely the vectors agree,
+# so the accuracy cost of a faster backend is known before switching EMBEDDING_BACKEND
+def compare_backends(backend_name: str, reference_name: str = SentenceTransformerBackend.name, samples: int = 500):
+    texts = sample_contents(samples)
+    if not texts:
+        raise ValueError("magazine_content is empty, load some magazines before comparing backends.")
+
+    reference_embeddings, reference_seconds = timed_encode(create_backend(reference_name), texts)
+    candidate_embeddings, candidate_seconds = timed_encode(create_backend(backend_name), texts)
+
+    reference_embeddings /= np.linalg.norm(reference_embeddings, axis=1, keepdims=True)
+    candidate_embeddings /= np.linalg.norm(candidate_embeddings, axis=1, keepdims=True)
+    cosine = (reference_embeddings * candidate_embeddings).sum(axis=1)
+
+    report = {
+        "samples": len(texts),
+        "reference": reference_name,
+        "candidate": backend_name,
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "cosine_p5": float(np.percentile(cosine, 5)),
+        "reference_ms_per_text": 1000 * reference_seconds / len(texts),
+        "candidate_ms_per_text": 1000 * candidate_seconds / len(texts),
+        "speedup": reference_seconds / candidate_seconds if candidate_seconds else None,
+    }
+    for key, value in report.items():
+        logger.info(f"{key}: {value}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and compare embedding backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export the model to ONNX with an int8 quantized copy")
+    export_parser.add_argument("output_dir")
+    export_parser.add_argument("--model-name", default=EMBEDDING_MODEL_NAME)
+    export_parser.add_argument("--no-quantize", action="store_true")
+
+    compare_parser = commands.add_parser("compare", help="Report cosine agreement between two backends")
+    compare_parser.add_argument("--backend", default="onnx", choices=list(BACKENDS))
+    compare_parser.add_argument("--reference", default=SentenceTransformerBackend.name, choices=list(BACKENDS))
+    compare_parser.add_argument("--samples", type=int, default=500)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_onnx(args.output_dir, args.model_name, not args.no_quantize)
+    else:
+        compare_backends(args.backend, args.reference, args.samples)
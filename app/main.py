@@ -1,8 +1,12 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 import uvicorn
-from app.api.magazine_routes import router as magazine_router
-from app.database import engine, Base
-from app.util.utils import create_indexes
+from app.config import ASYNC_MODE
+from app.api.system_routes import router as system_router
+from app.database import async_engines
+from app.util.ingest_worker import stop_ingest_workers
+from app.util.startup import start_background_startup
+from app.util.timing import TimingMiddleware
 
 import logging
 
@@ -12,19 +16,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Tables, indexes and the model are prepared in the background so the server binds immediately,
+# the load balancer waits for /health/ready before routing traffic
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_background_startup()
+    yield
+    stop_ingest_workers()
+    for async_engine in async_engines():
+        await async_engine.dispose()
 
-#create required indexes
-create_indexes()
+app = FastAPI(title="Magazine API", lifespan=lifespan)
 
-app = FastAPI(title="Magazine API")
+# per-stage timings in the Server-Timing header and the request latency histograms behind /metrics
+app.add_middleware(TimingMiddleware)
 
-# Include the API router
+# Include the API router, the async handlers on the asyncpg engine in ASYNC_MODE
+if ASYNC_MODE:
+    from app.api.async_magazine_routes import router as magazine_router
+else:
+    from app.api.magazine_routes import router as magazine_router
 app.include_router(magazine_router, prefix="/api", tags=["magazines"])
+app.include_router(system_router, tags=["system"])
 
-try:
-    logger.info("Starting FastAPI application on host: 0.0.0.0, port: 8000.")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-except Exception as e:
-    logger.error(f"Error occurred while running the FastAPI application: {str(e)}")
\ No newline at end of file
+if __name__ == "__main__":
+    try:
+        logger.info("Starting FastAPI application on host: 0.0.0.0, port: 8000.")
+        uvicorn.run(app, host="0.0.0.0", port=8000)
+    except Exception as e:
+        logger.error(f"Error occurred while running the FastAPI application: {str(e)}")
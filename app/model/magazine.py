@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Text
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, String, Date, ForeignKey, Text, func, text
 from sqlalchemy.orm import relationship
 from app.database import Base
 from pgvector.sqlalchemy import Vector
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 
 class MagazineInformation(Base):
     __tablename__ = "magazine_information"
@@ -22,8 +22,79 @@ class MagazineContent(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     magazine_id = Column(Integer, ForeignKey("magazine_information.id"))
     content = Column(String)
-    content_tsvector = Column(TSVECTOR)
+    # weighted title (A), author (B) and content (C) lexemes, maintained by database triggers
+    # (see app.util.migrations.install_search_document)
+    search_document = Column(TSVECTOR)
     content_embedding = Column(Vector(384))
+    # the embedding model that produced content_embedding (NULL for rows written before it was recorded)
+    embedding_model = Column(String)
+    # sha256 of content, set by a database trigger (see app.util.migrations.install_content_hash), so ingest
+    # can find a stored copy of a content and reuse its embedding
+    content_hash = Column(String(64))
 
     # One-to-One relationship back to MagazineInformation
-    magazine = relationship("MagazineInformation", back_populates="content")
\ No newline at end of file
+    magazine = relationship("MagazineInformation", back_populates="content")
+
+# Number of magazines per (category, publication year), maintained by statement level triggers on
+# magazine_information (see app.util.migrations.install_facet_counts) so facet counts never scan the table
+class MagazineFacetCount(Base):
+    __tablename__ = "magazine_facet_counts"
+
+    category = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    magazines = Column(BigInteger, nullable=False, default=0)
+
+# Single row (id 1) recording which embedding model content_embedding holds and the progress of a re-embed to
+# next_model (see app.util.reembed). Every process follows active_model, the cutover flips it in the same
+# transaction that swaps the columns.
+class EmbeddingModelState(Base):
+    __tablename__ = "embedding_model_state"
+
+    id = Column(Integer, primary_key=True)
+    active_model = Column(String, nullable=False)
+    # the model content_embedding_next is being filled with, NULL while no re-embed runs
+    next_model = Column(String)
+    # idle, backfilling, indexing, ready (column and indexes complete, waiting for the cutover) or repairing
+    # (cut over, re-encoding the rows written with the old model meanwhile)
+    reembed_status = Column(String, nullable=False, default="idle")
+    # rows up to this id hold next_model vectors, a restarted job resumes after it. While repairing, the last id
+    # at the cutover
+    reembed_last_id = Column(BigInteger, nullable=False, default=0)
+    # the model content_embedding_previous holds until it is dropped
+    previous_model = Column(String)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+# An asynchronous ingest submitted with POST /magazine?job=true. The counters are updated by the ingest
+# workers in the same transaction that inserts the magazines, so they never run ahead of the data.
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    # queued, running, completed or completed_with_errors
+    status = Column(String, nullable=False, default="queued")
+    total = Column(Integer, nullable=False)
+    succeeded = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    # what the workers do with records whose content is already stored, see INGEST_ON_DUPLICATE
+    on_duplicate = Column(String, nullable=False, server_default="insert")
+    encodes_avoided = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+# The validated records of an ingest job waiting to be embedded and inserted. Workers claim pending rows with
+# FOR UPDATE SKIP LOCKED, ingested rows are deleted and failed ones kept with their error.
+class IngestStagingRecord(Base):
+    __tablename__ = "ingest_staging"
+    __table_args__ = (
+        Index("idx_ingest_staging_pending", "id", postgresql_where=text("status = 'pending'")),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    job_id = Column(BigInteger, ForeignKey("ingest_jobs.id", ondelete="CASCADE"), nullable=False, index=True)
+    # position of the record in the submitted batch
+    position = Column(Integer, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    # pending or failed
+    status = Column(String, nullable=False, default="pending")
+    error = Column(Text)
@@ -0,0 +1,209 @@
+import argparse
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from app.config import EMBEDDING_BACKEND, EMBEDDING_BATCH_SIZE, EMBEDDING_DIMENSION, EMBEDDING_MODEL_NAME
+from app.data_loader import stream_batches
+from app.database import engine, Base
+from app.model import magazine  # noqa: F401  registers the tables on Base
+from app.util.migrations import (
+    install_content_hash, install_embedding_model_state, install_facet_counts, install_search_changed,
+    install_search_document,
+)
+
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Offline corpus build: encode the source CSV across a process pool into a memory-mapped float32 file,
+# then COPY everything into Postgres and build the indexes once at the end.
+#
+#   python -m app.precompute app/fake_magazines.csv --workers 4
+
+_worker_model = None
+
+
+# Runs once per worker process: pin BLAS/torch threads before torch is imported, then load one model
+def init_worker(threads_per_worker: int):
+    global _worker_model
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads_per_worker)
+
+    from app.util.embedding_backends import OnnxBackend, create_backend
+
+    if EMBEDDING_BACKEND == OnnxBackend.name:
+        _worker_model = OnnxBackend(threads=threads_per_worker)
+    else:
+        import torch
+
+        torch.set_num_threads(threads_per_worker)
+        _worker_model = create_backend(EMBEDDING_BACKEND)
+
+# Each worker writes its shard straight into the shared memory-mapped file, nothing is pickled back
+def encode_shard(embeddings_path: str, total_rows: int, start_row: int, contents: list):
+    embeddings = np.memmap(embeddings_path, dtype=np.float32, mode="r+", shape=(total_rows, EMBEDDING_DIMENSION))
+    embeddings[start_row:start_row + len(contents)] = _worker_model.encode(contents, batch_size=EMBEDDING_BATCH_SIZE)
+    embeddings.flush()
+    return len(contents)
+
+def count_rows(file_path: str, chunk_size: int, max_records: int = None):
+    total_rows = sum(len(chunk) for chunk in pd.read_csv(file_path, usecols=["title"], chunksize=chunk_size))
+    return min(total_rows, max_records) if max_records is not None else total_rows
+
+def encode_corpus(file_path, embeddings_path, total_rows, workers, shard_size, chunk_size, max_records=None):
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f"Encoding {total_rows} rows with {workers} workers x {threads_per_worker} threads.")
+
+    np.memmap(embeddings_path, dtype=np.float32, mode="w+", shape=(total_rows, EMBEDDING_DIMENSION)).flush()
+
+    started = time.perf_counter()
+    encoded_rows = 0
+    in_flight = set()
+    # spawn, so workers never inherit a forked torch thread pool
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+        for start_row, batch in stream_batches(file_path, shard_size, chunk_size, 0, max_records):
+            # keep a couple of shards queued per worker, memory stays bounded by the in-flight shards
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                encoded_rows += sum(future.result() for future in done)
+                logger.info(f"Encoded {encoded_rows}/{total_rows} rows "
+                            f"({encoded_rows / (time.perf_counter() - started):.1f} rows/sec).")
+            contents = [magazine["content"] for magazine in batch]
+            in_flight.add(executor.submit(encode_shard, embeddings_path, total_rows, start_row, contents))
+
+        for future in in_flight:
+            encoded_rows += future.result()
+
+    logger.info(f"Encoded {encoded_rows} rows in {time.perf_counter() - started:.1f}s.")
+
+def format_vector(vector):
+    return "[" + ",".join(map(str, vector.tolist())) + "]"
+
+# COPY the CSV rows plus their precomputed embeddings into a temp staging table, then fan out
+# into both tables with set based INSERT ... SELECT statements in the same transaction
+def load_corpus(file_path, embeddings_path, total_rows, chunk_size, max_records=None):
+    embeddings = np.memmap(embeddings_path, dtype=np.float32, mode="r", shape=(total_rows, EMBEDDING_DIMENSION))
+    started = time.perf_counter()
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            CREATE TEMP TABLE magazine_staging (
+                row_no BIGINT,
+                title VARCHAR,
+                author VARCHAR,
+                category VARCHAR,
+                publish_date DATE,
+                content VARCHAR,
+                content_embedding VECTOR({EMBEDDING_DIMENSION})
+            ) ON COMMIT DROP;
+        """)
+
+        for start_row, batch in stream_batches(file_path, chunk_size, chunk_size, 0, max_records):
+            frame = pd.DataFrame(batch, columns=["title", "author", "category", "publish_date", "content"])
+            frame.insert(0, "row_no", range(start_row, start_row + len(frame)))
+            frame["content_embedding"] = [format_vector(vector) for vector in embeddings[start_row:start_row + len(frame)]]
+
+            buffer = io.StringIO()
+            frame.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(
+                "COPY magazine_staging (row_no, title, author, category, publish_date, content, content_embedding) "
+                "FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+            logger.info(f"Copied {start_row + len(frame)}/{total_rows} rows into staging.")
+
+        # ids come from the table's own sequence so live inserts can continue afterwards
+        cursor.execute("""
+            ALTER TABLE magazine_staging ADD COLUMN magazine_id INTEGER;
+            UPDATE magazine_staging
+            SET magazine_id = nextval(pg_get_serial_sequence('magazine_information', 'id'));
+
+            INSERT INTO magazine_information (id, title, author, category, publish_date)
+            SELECT magazine_id, title, author, category, publish_date
+            FROM magazine_staging ORDER BY row_no;
+
+            INSERT INTO magazine_content (magazine_id, content, content_embedding, embedding_model)
+            SELECT magazine_id, content, content_embedding, %(model)s
+            FROM magazine_staging ORDER BY row_no;
+        """, {"model": EMBEDDING_MODEL_NAME})
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    logger.info(f"Loaded {total_rows} rows in {time.perf_counter() - started:.1f}s.")
+
+def analyze_tables():
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE magazine_information;"))
+        connection.execute(text("ANALYZE magazine_content;"))
+
+def precompute(file_path, embeddings_path=None, workers=None, shard_size=1024, chunk_size=10000,
+               max_records=None, skip_encode=False, rebuild_indexes=True, maintenance_work_mem="1GB"):
+    from app.util.utils import create_indexes, drop_indexes
+
+    embeddings_path = embeddings_path or file_path + ".embeddings.f32"
+    workers = workers or os.cpu_count() or 1
+    total_rows = count_rows(file_path, chunk_size, max_records)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        install_search_document(connection)
+        install_facet_counts(connection)
+        install_embedding_model_state(connection)
+        install_content_hash(connection)
+        install_search_changed(connection)
+        active_model = connection.execute(text("SELECT active_model FROM embedding_model_state WHERE id = 1")).scalar()
+    # the workers encode with the configured model, which must be the one the stored vectors came from
+    if active_model != EMBEDDING_MODEL_NAME:
+        raise ValueError(f"The database holds {active_model} embeddings, set EMBEDDING_MODEL_NAME={active_model} "
+                         f"to load into it.")
+
+    if not skip_encode:
+        encode_corpus(file_path, embeddings_path, total_rows, workers, shard_size, chunk_size, max_records)
+
+    if rebuild_indexes:
+        logger.info("Dropping secondary indexes before the load.")
+        drop_indexes()
+
+    try:
+        load_corpus(file_path, embeddings_path, total_rows, chunk_size, max_records)
+        analyze_tables()
+    finally:
+        # indexes come back even when the load fails, so the API is never left without them
+        logger.info("Building indexes over the loaded data.")
+        create_indexes(maintenance_work_mem=maintenance_work_mem)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute embeddings offline and bulk load them into Postgres.")
+    parser.add_argument("file_path", nargs="?", default="app/fake_magazines.csv")
+    parser.add_argument("--embeddings-file", default=None, help="Memory-mapped float32 output, defaults to <file_path>.embeddings.f32")
+    parser.add_argument("--workers", type=int, default=None, help="Encoding processes, defaults to the CPU count")
+    parser.add_argument("--shard-size", type=int, default=1024, help="Rows encoded per task")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="CSV rows read and copied at a time")
+    parser.add_argument("--max-records", type=int, default=None)
+    parser.add_argument("--skip-encode", action="store_true", help="Reuse an existing embeddings file")
+    parser.add_argument("--keep-indexes", action="store_true", help="Do not drop indexes before loading")
+    parser.add_argument("--maintenance-work-mem", default="1GB", help="Memory for the post-load index builds")
+    args = parser.parse_args()
+
+    precompute(args.file_path, args.embeddings_file, args.workers, args.shard_size, args.chunk_size,
+               args.max_records, args.skip_encode, not args.keep_indexes, args.maintenance_work_mem)
@@ -0,0 +1,238 @@
+from typing import List
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import (
+    EXPORT_BATCH_SIZE, INGEST_INSERT_CHUNK_SIZE, INGEST_ON_DUPLICATE, SEARCH_CANDIDATE_K, SEARCH_COUNT_CAP,
+    SEARCH_COUNT_SAMPLE_ROWS, VECTOR_SEARCH_ENGINE,
+)
+from app.model.magazine import MagazineInformation
+from app.repositories.magazine_repository import (
+    TABLE_ROWS_SQL, bulk_insert_statements, combined_search_statement, content_hash, ef_search_statement,
+    encode_planned, export_statement, facet_counts_statement, has_filters, information_rows,
+    ingest_job_failures_statement, ingest_job_statement, ingest_job_statements, keyword_match_count_statement,
+    keyword_search_statement, local_ann_params, local_hydrate_statement, local_vector_candidates,
+    match_count_statement, plan_ingest, planned_content_rows, planned_inserts, resolve_planned, sampled_match_ratio_statement, staging_rows,
+    stored_contents, stored_contents_statement, uses_local_engine, vector_search_statement,
+)
+from app.schemas.magazine import DEFAULT_RESULT_FIELDS, MagazineBase, SearchFilters
+from app.util.ann_index import local_vector_index
+from app.util.timing import timed
+from app.util.utils import (
+    active_model_name, get_query_embedding_async, run_in_embedding_executor, search_model_async,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of magazine_repository for ASYNC_MODE. They run the same statements through an
+# AsyncSession, and every encode or local index scan is awaited on the embedding executor so the event
+# loop only ever waits on I/O.
+
+
+# async counterpart of magazine_repository.write_planned
+async def write_planned(db: AsyncSession, magazines: List[MagazineBase], hashes: list, actions: list,
+                        embeddings: dict, model_name: str):
+    information_stmt, content_stmt = bulk_insert_statements()
+    indexes = planned_inserts(actions)
+    new_ids = {}
+    for start in range(0, len(indexes), INGEST_INSERT_CHUNK_SIZE):
+        chunk = indexes[start:start + INGEST_INSERT_CHUNK_SIZE]
+        chunk_ids = (await db.execute(information_stmt,
+                                      information_rows([magazines[index] for index in chunk]))).scalars().all()
+        await db.execute(content_stmt, planned_content_rows(chunk_ids, chunk, magazines, hashes, actions, embeddings,
+                                                            model_name))
+        new_ids.update(zip(chunk, chunk_ids))
+
+    magazine_ids, updates = resolve_planned(magazines, actions, new_ids)
+    if updates:
+        await db.execute(update(MagazineInformation), updates)
+    return magazine_ids, ([new_ids[index] for index in indexes], [embeddings[hashes[index]] for index in indexes],
+                          model_name)
+
+# async counterpart of magazine_repository.ingest_magazines, encoding on the embedding executor
+async def ingest_magazines(db: AsyncSession, magazines: List[MagazineBase], policies: list):
+    model_name = active_model_name()
+    hashes = [content_hash(magazine.content) for magazine in magazines]
+    stored = stored_contents((await db.execute(stored_contents_statement(set(hashes), model_name))).all())
+    actions, to_encode = plan_ingest(hashes, policies, stored)
+    embeddings = await run_in_embedding_executor(encode_planned, magazines, hashes, to_encode, stored, model_name)
+    magazine_ids, new_rows = await write_planned(db, magazines, hashes, actions, embeddings, model_name)
+    return magazine_ids, new_rows, len(magazines) - len(to_encode)
+
+@timed("create_magazine")
+async def create_magazine(db: AsyncSession, magazine_data: MagazineBase, on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info("Creating a new magazine entry.")
+        magazine_ids, new_rows, encodes_avoided = await ingest_magazines(db, [magazine_data], [on_duplicate])
+        await db.commit()
+
+        if VECTOR_SEARCH_ENGINE == "local" and new_rows[0]:
+            await run_in_embedding_executor(local_vector_index.append, *new_rows)
+
+        magazine_data.id = magazine_ids[0]
+        logger.info(f"Magazine stored with ID: {magazine_data.id}"
+                    + (" (duplicate content, encode avoided)" if encodes_avoided else ""))
+        return magazine_data, encodes_avoided
+
+    except Exception as e:
+        await db.rollback()
+        raise Exception(e)
+
+@timed("create_magazines_bulk")
+async def create_magazines_bulk(db: AsyncSession, magazines: List[MagazineBase],
+                                on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info(f"Bulk creating {len(magazines)} magazine entries.")
+        magazine_ids, new_rows, encodes_avoided = await ingest_magazines(db, magazines,
+                                                                         [on_duplicate] * len(magazines))
+        await db.commit()
+
+        for magazine_id, magazine in zip(magazine_ids, magazines):
+            magazine.id = magazine_id
+        if VECTOR_SEARCH_ENGINE == "local" and new_rows[0]:
+            await run_in_embedding_executor(local_vector_index.append, *new_rows)
+        logger.info(f"Bulk created {len(new_rows[0])} of {len(magazines)} magazines, "
+                    f"{encodes_avoided} encodes avoided.")
+        return magazines, encodes_avoided
+
+    except Exception as e:
+        await db.rollback()
+        raise Exception(e)
+
+@timed("create_ingest_job")
+async def create_ingest_job(db: AsyncSession, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        job_stmt, staging_stmt = ingest_job_statements(len(magazines), on_duplicate)
+        job_id = (await db.execute(job_stmt)).scalar_one()
+        for start in range(0, len(magazines), INGEST_INSERT_CHUNK_SIZE):
+            await db.execute(staging_stmt, staging_rows(job_id, magazines[start:start + INGEST_INSERT_CHUNK_SIZE],
+                                                        start))
+        await db.commit()
+        logger.info(f"Staged {len(magazines)} magazines as ingest job {job_id}.")
+        return job_id
+
+    except Exception as e:
+        await db.rollback()
+        raise Exception(e)
+
+@timed("keyword_search")
+async def keyword_search(db: AsyncSession, query: str, page: int = 1, page_size: int = 10,
+                         filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.info(f"Performing keyword search for query: {query}")
+        results = (await db.execute(keyword_search_statement(query, page, page_size, filters, fields))).all()
+        logger.info(f"Keyword search returned {len(results)} results.")
+        return results
+
+    except Exception as e:
+        logger.error(f"Error during keyword search: {e}")
+        raise Exception(e)
+
+@timed("vector_search")
+async def vector_search(db: AsyncSession, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                        filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.info(f"Performing vector search for query: {query}")
+        model_name = await search_model_async(db)
+        query_vector = await get_query_embedding_async(query, model_name)
+
+        candidates = None
+        if uses_local_engine(has_filters(filters)):
+            candidates = await run_in_embedding_executor(local_vector_candidates, query_vector, page, page_size,
+                                                         min_score, model_name)
+        if candidates is not None:
+            ids, scores = candidates
+            results = (await db.execute(*local_hydrate_statement(ids, scores, fields, query))).all() if ids else []
+        else:
+            results = (await db.execute(vector_search_statement(query_vector, page, page_size, min_score,
+                                                                filters, fields, query))).all()
+
+        logger.info(f"Vector search returned {len(results)} results.")
+        return results
+
+    except Exception as e:
+        logger.error(f"Error during vector search: {e}")
+        raise Exception(e)
+
+@timed("combined_search")
+async def combined_search(db: AsyncSession, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                          cursor: tuple = None, candidate_k: int = SEARCH_CANDIDATE_K, filters: SearchFilters = None,
+                          fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.info(f"Performing combined search for query: {query}")
+        model_name = await search_model_async(db)
+        query_vector = await get_query_embedding_async(query, model_name)
+        ann_params = None
+        if uses_local_engine(has_filters(filters)):
+            ann_params = await run_in_embedding_executor(local_ann_params, query_vector, candidate_k, model_name)
+        sql_query, params = combined_search_statement(query, query_vector, page, page_size, min_score,
+                                                      cursor, candidate_k, filters, fields, ann_params)
+
+        await db.execute(ef_search_statement(candidate_k, has_filters(filters)))
+        results = (await db.execute(sql_query, params)).all()
+
+        logger.info(f"Combined search returned {len(results)} results.")
+        return results
+
+    except Exception as e:
+        logger.error(f"Error during combined search: {e}")
+        raise Exception(e)
+
+# same exact-when-cheap policy as magazine_repository.count_query_matches
+@timed("count_matches")
+async def count_query_matches(db: AsyncSession, query: str, min_score: float = 0.15,
+                              count_cap: int = SEARCH_COUNT_CAP, sample_rows: int = SEARCH_COUNT_SAMPLE_ROWS,
+                              filters: SearchFilters = None):
+    try:
+        query_vector = await get_query_embedding_async(query, await search_model_async(db))
+        table_rows = (await db.execute(TABLE_ROWS_SQL)).scalar() or 0
+        if table_rows <= sample_rows:
+            return (await db.execute(match_count_statement(query, query_vector, min_score,
+                                                           filters=filters))).scalar(), False
+
+        percent = 100.0 * sample_rows / table_rows
+        ratio = (await db.execute(sampled_match_ratio_statement(query, query_vector, percent, min_score,
+                                                                filters))).scalar() or 0
+        estimate = round(float(ratio) * table_rows)
+        if estimate > count_cap:
+            return estimate, True
+
+        keyword_matches = (await db.execute(keyword_match_count_statement(query, count_cap, filters))).scalar()
+        return max(estimate, keyword_matches), True
+
+    except Exception as e:
+        logger.error(f"Error during match counting: {e}")
+        raise Exception(e)
+
+@timed("facet_counts")
+async def facet_counts(db: AsyncSession):
+    try:
+        return (await db.execute(facet_counts_statement())).all()
+
+    except Exception as e:
+        logger.error(f"Error while reading facet counts: {e}")
+        raise Exception(e)
+
+async def export_rows(db: AsyncSession, filters: SearchFilters = None, after_id: int = None, max_id: int = None,
+                      include_embeddings: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    try:
+        statement = export_statement(filters, after_id, max_id, include_embeddings)
+        result = await db.stream(statement.execution_options(yield_per=batch_size))
+        async for partition in result.partitions():
+            yield partition
+
+    except Exception as e:
+        logger.error(f"Error while exporting magazines: {e}")
+        raise Exception(e)
+
+@timed("ingest_job")
+async def ingest_job(db: AsyncSession, job_id: int, failure_limit: int):
+    try:
+        job = (await db.execute(ingest_job_statement(job_id))).first()
+        if job is None:
+            return None, []
+        return job, (await db.execute(ingest_job_failures_statement(job_id, failure_limit))).all()
+
+    except Exception as e:
+        logger.error(f"Error while reading ingest job {job_id}: {e}")
+        raise Exception(e)
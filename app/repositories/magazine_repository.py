@@ -1,8 +1,23 @@
-from sqlalchemy import func, text
-from sqlalchemy.orm import Session
-from app.model.magazine import MagazineInformation, MagazineContent
-from app.schemas.magazine import MagazineBase
-from app.util.utils import get_embeddings
+import hashlib
+from collections import namedtuple
+from typing import List
+from pydantic import ValidationError
+from sqlalchemy import Text, and_, case, cast, delete, func, insert, select, tablesample, text, update
+from sqlalchemy.orm import Session, aliased
+from app.config import (
+    EXPORT_BATCH_SIZE, INGEST_INSERT_CHUNK_SIZE, INGEST_ON_DUPLICATE, SEARCH_CANDIDATE_K, HNSW_EF_SEARCH,
+    HNSW_ITERATIVE_SCAN, RRF_K,
+    VECTOR_STORAGE_MODE, VECTOR_RERANK_OVERSAMPLE, VECTOR_SEARCH_ENGINE,
+    SEARCH_COUNT_CAP, SEARCH_COUNT_SAMPLE_ROWS, SNIPPET_MAX_FRAGMENTS, SNIPPET_MAX_WORDS, SNIPPET_MIN_WORDS,
+)
+from app.model.magazine import (
+    IngestJob, IngestStagingRecord, MagazineFacetCount, MagazineInformation, MagazineContent,
+)
+from app.schemas.magazine import DEFAULT_RESULT_FIELDS, MagazineBase, SearchFilters
+from app.util.ann_index import local_vector_index
+from app.util.timing import timed
+from app.util.utils import active_model_name, get_embeddings_batch, get_query_embedding, search_model
+from app.util.vector_storage import compact_storage
 from pgvector.sqlalchemy import Vector
 import numpy as np
 import logging
@@ -10,71 +25,505 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-def create_magazine(db: Session, magazine_data: MagazineBase):
+# sha256 of the content, the digest the magazine_content trigger stores in content_hash
+def content_hash(content: str):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+# The stored copy of a content, whose embedding (and search document) ingest reuses instead of encoding again
+StoredContent = namedtuple("StoredContent", "magazine_id content_embedding search_document title author")
+
+# The first stored magazine with each of the given content hashes, among those embedded with model_name (rows
+# written before the model was recorded hold the active model's embeddings)
+def stored_contents_statement(hashes, model_name: str):
+    return select(
+        MagazineContent.content_hash, MagazineContent.magazine_id, MagazineContent.content_embedding,
+        MagazineContent.search_document, MagazineInformation.title, MagazineInformation.author,
+    ).join(
+        MagazineInformation, MagazineInformation.id == MagazineContent.magazine_id
+    ).where(
+        MagazineContent.content_hash.in_(hashes),
+        func.coalesce(MagazineContent.embedding_model, model_name) == model_name,
+    ).distinct(MagazineContent.content_hash).order_by(MagazineContent.content_hash, MagazineContent.id)
+
+def stored_contents(rows):
+    return {
+        row.content_hash: StoredContent(row.magazine_id, row.content_embedding, row.search_document, row.title,
+                                        row.author)
+        for row in rows
+    }
+
+# Decides per magazine what ingest writes under its on_duplicate policy. A content that is stored, or came
+# earlier in the same batch, is a duplicate: its action is the policy, with the stored copy (or the index of
+# the earlier magazine) as source. Other contents get ("new", None) and are encoded, each distinct one once.
+# Returns the actions and the indexes of the magazines to encode.
+def plan_ingest(hashes: list, policies: list, stored: dict):
+    actions, first_seen, to_encode = [], {}, []
+    for index, (digest, policy) in enumerate(zip(hashes, policies)):
+        source = stored.get(digest, first_seen.get(digest))
+        if source is None:
+            first_seen[digest] = index
+            to_encode.append(index)
+            actions.append(("new", None))
+        else:
+            actions.append((policy, source))
+    return actions, to_encode
+
+# the vector to store per content hash: encoded for new contents, the stored one for duplicates
+def encode_planned(magazines: List[MagazineBase], hashes: list, to_encode: list, stored: dict, model_name: str):
+    embeddings = {digest: copy.content_embedding for digest, copy in stored.items()}
+    if to_encode:
+        encoded = get_embeddings_batch([magazines[index].content for index in to_encode], model_name=model_name)
+        embeddings.update((hashes[index], embedding) for index, embedding in zip(to_encode, encoded))
+    return embeddings
+
+# indexes of the magazines that get a row of their own
+def planned_inserts(actions: list):
+    return [index for index, (action, _) in enumerate(actions) if action in ("new", "insert")]
+
+def planned_content_rows(new_ids, indexes: list, magazines: List[MagazineBase], hashes: list, actions: list,
+                         embeddings: dict, model_name: str):
+    rows = content_rows(new_ids, [magazines[index] for index in indexes],
+                        [embeddings[hashes[index]] for index in indexes], model_name)
+    for row, index in zip(rows, indexes):
+        _, source = actions[index]
+        magazine = magazines[index]
+        # the search document of a stored magazine with the same title and author is copied, NULL has the
+        # trigger compute it
+        same_document = isinstance(source, StoredContent) and (source.title, source.author) == (magazine.title,
+                                                                                                magazine.author)
+        row["search_document"] = source.search_document if same_document else None
+    return rows
+
+# The magazine id of every magazine (the stored one's for skipped and updated duplicates) and the metadata
+# updates, one per stored magazine with the last submitted metadata winning, in id order
+def resolve_planned(magazines: List[MagazineBase], actions: list, new_ids: dict):
+    magazine_ids, updates = [], {}
+    for index, (action, source) in enumerate(actions):
+        if action in ("new", "insert"):
+            magazine_ids.append(new_ids[index])
+            continue
+        target = source.magazine_id if isinstance(source, StoredContent) else new_ids[source]
+        magazine_ids.append(target)
+        if action == "update_metadata":
+            updates[target] = {"id": target, **information_rows([magazines[index]])[0]}
+    return magazine_ids, [updates[target] for target in sorted(updates)]
+
+# Writes a planned batch: multi-row inserts for the magazines getting a row, then the metadata updates. Returns
+# the magazine ids and the ids, vectors and model of the new rows, for the local vector index.
+def write_planned(db: Session, magazines: List[MagazineBase], hashes: list, actions: list, embeddings: dict,
+                  model_name: str):
+    information_stmt, content_stmt = bulk_insert_statements()
+    indexes = planned_inserts(actions)
+    new_ids = {}
+    for start in range(0, len(indexes), INGEST_INSERT_CHUNK_SIZE):
+        chunk = indexes[start:start + INGEST_INSERT_CHUNK_SIZE]
+        chunk_ids = db.execute(information_stmt,
+                               information_rows([magazines[index] for index in chunk])).scalars().all()
+        db.execute(content_stmt, planned_content_rows(chunk_ids, chunk, magazines, hashes, actions, embeddings,
+                                                      model_name))
+        new_ids.update(zip(chunk, chunk_ids))
+
+    magazine_ids, updates = resolve_planned(magazines, actions, new_ids)
+    if updates:
+        db.execute(update(MagazineInformation), updates)
+    return magazine_ids, ([new_ids[index] for index in indexes], [embeddings[hashes[index]] for index in indexes],
+                          model_name)
+
+# Ingest with content hash deduplication, shared by the single and bulk paths: finds the stored copies of the
+# batch's contents, encodes only the contents not stored yet and writes the batch under the policies (one per
+# magazine). Leaves the commit to the caller. Returns the magazine ids, the new rows and the encodes avoided.
+def ingest_magazines(db: Session, magazines: List[MagazineBase], policies: list):
+    model_name = active_model_name()
+    hashes = [content_hash(magazine.content) for magazine in magazines]
+    stored = stored_contents(db.execute(stored_contents_statement(set(hashes), model_name)).all())
+    actions, to_encode = plan_ingest(hashes, policies, stored)
+    embeddings = encode_planned(magazines, hashes, to_encode, stored, model_name)
+    magazine_ids, new_rows = write_planned(db, magazines, hashes, actions, embeddings, model_name)
+    return magazine_ids, new_rows, len(magazines) - len(to_encode)
+
+# Stores one magazine, or under on_duplicate resolves it against a stored magazine with the same content.
+# Returns the magazine with its id and the number of encodes avoided (0 or 1).
+@timed("create_magazine")
+def create_magazine(db: Session, magazine_data: MagazineBase, on_duplicate: str = INGEST_ON_DUPLICATE):
     try:
         logger.info("Creating a new magazine entry.")
-        new_magazine = MagazineInformation(
-            title=magazine_data.title,
-            author=magazine_data.author,
-            category=magazine_data.category,
-            publish_date=magazine_data.publish_date,
-        )
-
-        db.add(new_magazine)
+        magazine_ids, new_rows, encodes_avoided = ingest_magazines(db, [magazine_data], [on_duplicate])
         db.commit()
-        db.refresh(new_magazine)
 
-        logger.info(f"New magazine created with ID: {new_magazine.id}")
+        if VECTOR_SEARCH_ENGINE == "local" and new_rows[0]:
+            local_vector_index.append(*new_rows)
+
+        magazine_data.id = magazine_ids[0]
+        logger.info(f"Magazine stored with ID: {magazine_data.id}"
+                    + (" (duplicate content, encode avoided)" if encodes_avoided else ""))
+        return magazine_data, encodes_avoided
+
+    except Exception as e:
+        db.rollback()
+        raise Exception(e)
 
-        new_content = MagazineContent(
-            magazine_id=new_magazine.id,
-            content=magazine_data.content,
-            content_embedding = get_embeddings(magazine_data.content),
-            content_tsvector=text("to_tsvector('english', :b_content)").bindparams(b_content=magazine_data.content)
-        )
-        db.add(new_content)
+# INSERT ... RETURNING id for magazine_information and the matching magazine_content insert, executed with one
+# parameter set per magazine so the driver sends them as multi-row statements. search_document is filled by
+# the database trigger, so content is only sent once.
+def bulk_insert_statements():
+    information_stmt = insert(MagazineInformation).returning(
+        MagazineInformation.id, sort_by_parameter_order=True
+    )
+    content_stmt = insert(MagazineContent)
+    return information_stmt, content_stmt
+
+def information_rows(magazines: List[MagazineBase]):
+    return [
+        {
+            "title": magazine.title,
+            "author": magazine.author,
+            "category": magazine.category,
+            "publish_date": magazine.publish_date,
+        }
+        for magazine in magazines
+    ]
+
+def content_rows(new_ids, magazines: List[MagazineBase], embeddings, model_name: str):
+    return [
+        {
+            "magazine_id": new_id,
+            "content": magazine.content,
+            "content_embedding": embedding,
+            "embedding_model": model_name,
+        }
+        for new_id, magazine, embedding in zip(new_ids, magazines, embeddings)
+    ]
+
+# Bulk variant of create_magazine: one batched encode for the contents not stored yet and multi-row
+# INSERT ... RETURNING for both tables, committed as a single transaction
+@timed("create_magazines_bulk")
+def create_magazines_bulk(db: Session, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info(f"Bulk creating {len(magazines)} magazine entries.")
+        magazine_ids, new_rows, encodes_avoided = ingest_magazines(db, magazines, [on_duplicate] * len(magazines))
         db.commit()
-        
-        magazine_data.id = new_magazine.id
-        logger.info("Magazine content added successfully.")
-        return magazine_data
-    
+
+        for magazine_id, magazine in zip(magazine_ids, magazines):
+            magazine.id = magazine_id
+        if VECTOR_SEARCH_ENGINE == "local" and new_rows[0]:
+            local_vector_index.append(*new_rows)
+        logger.info(f"Bulk created {len(new_rows[0])} of {len(magazines)} magazines, "
+                    f"{encodes_avoided} encodes avoided.")
+        return magazines, encodes_avoided
+
+    except Exception as e:
+        db.rollback()
+        raise Exception(e)
+
+# Statements of an ingest job submission: the job row, and its validated records staged as JSON, one
+# parameter set per record
+def ingest_job_statements(total: int, on_duplicate: str = INGEST_ON_DUPLICATE):
+    job_stmt = insert(IngestJob).values(total=total, on_duplicate=on_duplicate).returning(IngestJob.id)
+    staging_stmt = insert(IngestStagingRecord)
+    return job_stmt, staging_stmt
+
+def staging_rows(job_id: int, magazines: List[MagazineBase], first_position: int = 0):
+    return [
+        {
+            "job_id": job_id,
+            "position": first_position + offset,
+            "payload": magazine.model_dump(mode="json", exclude={"id"}),
+        }
+        for offset, magazine in enumerate(magazines)
+    ]
+
+@timed("create_ingest_job")
+def create_ingest_job(db: Session, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        job_stmt, staging_stmt = ingest_job_statements(len(magazines), on_duplicate)
+        job_id = db.execute(job_stmt).scalar_one()
+        for start in range(0, len(magazines), INGEST_INSERT_CHUNK_SIZE):
+            db.execute(staging_stmt, staging_rows(job_id, magazines[start:start + INGEST_INSERT_CHUNK_SIZE], start))
+        db.commit()
+        logger.info(f"Staged {len(magazines)} magazines as ingest job {job_id}.")
+        return job_id
+
     except Exception as e:
+        db.rollback()
         raise Exception(e)
 
-# A seperate method for keyword based search on author, title and content_tsvector field  
-def keyword_search(db: Session,query: str,page: int=1,page_size: int=10):
+# The oldest pending staging records with their job's on_duplicate policy, locked for the claiming transaction.
+# Concurrent workers skip each other's locked rows instead of waiting, and a worker that dies mid-batch rolls
+# back, releasing its records. The job rows aren't locked here, the progress update does that in job order.
+def claim_staged_records_statement(limit: int):
+    return select(
+        IngestStagingRecord.id, IngestStagingRecord.job_id, IngestStagingRecord.payload, IngestJob.on_duplicate
+    ).join(
+        IngestJob, IngestJob.id == IngestStagingRecord.job_id
+    ).where(
+        IngestStagingRecord.status == "pending"
+    ).order_by(IngestStagingRecord.id).limit(limit).with_for_update(skip_locked=True, of=IngestStagingRecord)
+
+# Adds a batch's outcome to its jobs' counters. The first batch sets started_at to its transaction start,
+# when its records were claimed, and the batch taking a job to its total finishes it.
+JOB_PROGRESS_SQL = text("""
+    UPDATE ingest_jobs
+    SET succeeded = succeeded + :succeeded,
+        failed = failed + :failed,
+        encodes_avoided = encodes_avoided + :encodes_avoided,
+        started_at = COALESCE(started_at, now()),
+        finished_at = CASE WHEN succeeded + failed + :succeeded + :failed >= total THEN clock_timestamp() END,
+        status = CASE
+            WHEN succeeded + failed + :succeeded + :failed < total THEN 'running'
+            WHEN failed + :failed > 0 THEN 'completed_with_errors'
+            ELSE 'completed'
+        END
+    WHERE id = :job_id
+""")
+
+# Writes the staged magazines as one planned batch under a savepoint. If that fails, every record is retried
+# under its own savepoint so one bad record only fails itself. Returns the magazine ids by staging id, the
+# errors by staging id, the staging ids whose encode was avoided and the new rows.
+def write_staged_magazines(db: Session, staged_ids: list, magazines: List[MagazineBase], hashes: list,
+                           policies: list, stored: dict, embeddings: dict, model_name: str):
+    try:
+        with db.begin_nested():
+            actions, _ = plan_ingest(hashes, policies, stored)
+            magazine_ids, new_rows = write_planned(db, magazines, hashes, actions, embeddings, model_name)
+        avoided = {staged_id for staged_id, (action, _) in zip(staged_ids, actions) if action != "new"}
+        return dict(zip(staged_ids, magazine_ids)), {}, avoided, new_rows
+
+    except Exception as e:
+        logger.warning(f"Batch insert of {len(staged_ids)} staged magazines failed, retrying one by one: "
+                       f"{str(e).splitlines()[0]}")
+
+    stored = dict(stored)
+    succeeded, failures, avoided, new_ids, new_vectors = {}, {}, set(), [], []
+    for staged_id, magazine, digest, policy in zip(staged_ids, magazines, hashes, policies):
+        try:
+            with db.begin_nested():
+                actions, _ = plan_ingest([digest], [policy], stored)
+                magazine_ids, (row_ids, row_vectors, _) = write_planned(db, [magazine], [digest], actions,
+                                                                        embeddings, model_name)
+        except Exception as e:
+            failures[staged_id] = str(e).splitlines()[0]
+            continue
+
+        succeeded[staged_id] = magazine_ids[0]
+        new_ids.extend(row_ids)
+        new_vectors.extend(row_vectors)
+        if actions[0][0] == "new":
+            # later records with the same content are duplicates of this one
+            stored[digest] = StoredContent(magazine_ids[0], embeddings[digest], None, magazine.title, magazine.author)
+        else:
+            avoided.add(staged_id)
+    return succeeded, failures, avoided, (new_ids, new_vectors, model_name)
+
+# Claims up to batch_size staged records and ingests them in a single transaction: one batched encode of the
+# contents not stored yet, the writes, deleting the ingested records, keeping the failed ones with their error
+# and updating the job counters all commit together. Returns the number of records claimed and ingested.
+@timed("ingest_staged_batch")
+def ingest_staged_batch(db: Session, batch_size: int):
+    try:
+        records = db.execute(claim_staged_records_statement(batch_size)).all()
+        if not records:
+            db.rollback()
+            return 0, 0
+
+        magazines, failures = {}, {}
+        for record in records:
+            try:
+                magazines[record.id] = MagazineBase.model_validate(record.payload)
+            except ValidationError as e:
+                failures[record.id] = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                                                for error in e.errors())
+
+        succeeded, avoided, new_rows = {}, set(), ([], [], None)
+        if magazines:
+            model_name = active_model_name()
+            staged_ids = list(magazines)
+            batch = list(magazines.values())
+            hashes = [content_hash(magazine.content) for magazine in batch]
+            policies = [record.on_duplicate for record in records if record.id in magazines]
+            stored = stored_contents(db.execute(stored_contents_statement(set(hashes), model_name)).all())
+            _, to_encode = plan_ingest(hashes, policies, stored)
+            embeddings = encode_planned(batch, hashes, to_encode, stored, model_name)
+            succeeded, write_failures, avoided, new_rows = write_staged_magazines(
+                db, staged_ids, batch, hashes, policies, stored, embeddings, model_name
+            )
+            failures.update(write_failures)
+
+        if succeeded:
+            db.execute(delete(IngestStagingRecord).where(IngestStagingRecord.id.in_(list(succeeded))))
+        if failures:
+            db.execute(update(IngestStagingRecord), [
+                {"id": staged_id, "status": "failed", "error": error} for staged_id, error in failures.items()
+            ])
+
+        progress = {}
+        for record in records:
+            ok, failed, saved = progress.get(record.job_id, (0, 0, 0))
+            progress[record.job_id] = (ok + (record.id in succeeded), failed + (record.id in failures),
+                                       saved + (record.id in avoided))
+        # in job id order, so workers finishing batches of the same jobs lock the job rows in the same order
+        db.execute(JOB_PROGRESS_SQL, [
+            {"job_id": job_id, "succeeded": ok, "failed": failed, "encodes_avoided": saved}
+            for job_id, (ok, failed, saved) in sorted(progress.items())
+        ])
+        db.commit()
+
+        if VECTOR_SEARCH_ENGINE == "local" and new_rows[0]:
+            local_vector_index.append(*new_rows)
+        logger.info(f"Ingested {len(succeeded)} of {len(records)} staged magazines, {len(failures)} failed, "
+                    f"{len(avoided)} encodes avoided.")
+        return len(records), len(succeeded)
+
+    except Exception as e:
+        db.rollback()
+        raise Exception(e)
+
+def ingest_job_statement(job_id: int):
+    return select(IngestJob, func.now().label("now")).where(IngestJob.id == job_id)
+
+def ingest_job_failures_statement(job_id: int, limit: int):
+    return select(
+        IngestStagingRecord.position, IngestStagingRecord.error
+    ).where(
+        IngestStagingRecord.job_id == job_id, IngestStagingRecord.status == "failed"
+    ).order_by(IngestStagingRecord.position).limit(limit)
+
+# The job row (with the database's current time, for the throughput of running jobs) and its first failures
+@timed("ingest_job")
+def ingest_job(db: Session, job_id: int, failure_limit: int):
+    try:
+        job = db.execute(ingest_job_statement(job_id)).first()
+        if job is None:
+            return None, []
+        return job, db.execute(ingest_job_failures_statement(job_id, failure_limit)).all()
+
+    except Exception as e:
+        logger.error(f"Error while reading ingest job {job_id}: {e}")
+        raise Exception(e)
+
+# The search text as a tsquery: plain words are ANDed, "quoted phrases", or and -word work as in a web search
+# box, and malformed input never raises
+def text_search_query(query: str):
+    return func.websearch_to_tsquery('english', query)
+
+# Keyword match on the weighted search_document (title, author and content), served by its GIN index, and its
+# relevance score. content defaults to the mapped table, the match counting passes a sampled alias of it.
+def keyword_filter(query: str, content=MagazineContent):
+    return content.search_document.op("@@")(text_search_query(query))
+
+def keyword_rank(query: str):
+    return func.ts_rank_cd(MagazineContent.search_document, text_search_query(query))
+
+# Cosine similarity (1 - cosine distance) between the stored embeddings and the query vector
+def vector_similarity(query_vector, content=MagazineContent):
+    query_vector = func.cast(np.asarray(query_vector).tolist(), Vector(384))
+    return 1 - func.cosine_distance(content.content_embedding, query_vector)
+
+def has_filters(filters: SearchFilters = None):
+    return filters is not None and not filters.is_empty()
+
+# whether nearest neighbours come from the local index rather than Postgres
+def uses_local_engine(filtered: bool = False):
+    return VECTOR_SEARCH_ENGINE == "local" and not filtered
+
+# The search filters as conditions on magazine_information, served by the (column, publish_date) indexes
+def filter_conditions(filters: SearchFilters = None, information=MagazineInformation):
+    conditions = []
+    if filters is None:
+        return conditions
+    if filters.category is not None:
+        conditions.append(information.category == filters.category)
+    if filters.author is not None:
+        conditions.append(information.author == filters.author)
+    if filters.published_from is not None:
+        conditions.append(information.publish_date >= filters.published_from)
+    if filters.published_to is not None:
+        conditions.append(information.publish_date <= filters.published_to)
+    return conditions
+
+# the same conditions on "mi" for the text statements of combined_search, and their parameters
+def filter_sql(filters: SearchFilters = None):
+    conditions, params = [], {}
+    if filters is None:
+        return "", params
+    for column, operator, name, value in (
+        ("category", "=", "filter_category", filters.category),
+        ("author", "=", "filter_author", filters.author),
+        ("publish_date", ">=", "filter_published_from", filters.published_from),
+        ("publish_date", "<=", "filter_published_to", filters.published_to),
+    ):
+        if value is not None:
+            conditions.append(f"mi.{column} {operator} :{name}")
+            params[name] = value
+    return " AND ".join(conditions), params
+
+# ts_headline options of the snippet field
+SNIPPET_OPTIONS = (f"MaxWords={SNIPPET_MAX_WORDS}, MinWords={SNIPPET_MIN_WORDS}, "
+                   f"MaxFragments={SNIPPET_MAX_FRAGMENTS}, FragmentDelimiter=\" ... \"")
+
+# Columns of the requested result fields, so a search only reads and ships what the client asked for. The id
+# (and the score) are always selected. ts_headline re-parses the whole content, but Postgres evaluates such
+# expensive select-list functions after ORDER BY ... LIMIT, so snippets are only built for the returned page.
+def result_columns(fields: tuple = DEFAULT_RESULT_FIELDS, query: str = None):
+    columns = {
+        "title": MagazineInformation.title,
+        "author": MagazineInformation.author,
+        "category": MagazineInformation.category,
+        "publish_date": MagazineInformation.publish_date,
+        "content": MagazineContent.content,
+    }
+    return [
+        func.ts_headline('english', MagazineContent.content, text_search_query(query), SNIPPET_OPTIONS).label("snippet")
+        if field == "snippet" else columns[field]
+        for field in fields if field != "id"
+    ]
+
+# the same columns on the mi / mc aliases of the text statements, and their parameters
+RESULT_COLUMNS_SQL = {
+    "title": "mi.title",
+    "author": "mi.author",
+    "category": "mi.category",
+    "publish_date": "mi.publish_date",
+    "content": "mc.content",
+    "snippet": "ts_headline('english', mc.content, websearch_to_tsquery('english', :search_text), :snippet_options) AS snippet",
+}
+
+def result_columns_sql(fields: tuple = DEFAULT_RESULT_FIELDS, query: str = None):
+    columns = "".join(f", {RESULT_COLUMNS_SQL[field]}" for field in fields if field != "id")
+    params = {"search_text": query, "snippet_options": SNIPPET_OPTIONS} if "snippet" in fields else {}
+    return columns, params
+
+# whether the text statements have to join magazine_content for the requested fields
+def needs_content(fields: tuple = DEFAULT_RESULT_FIELDS):
+    return "content" in fields or "snippet" in fields
+
+# Statement for the keyword search on author, title and content (search_document)
+def keyword_search_statement(query: str, page: int = 1, page_size: int = 10, filters: SearchFilters = None,
+                             fields: tuple = DEFAULT_RESULT_FIELDS):
+    offset = (page - 1) * page_size
+
+    rank_expr = keyword_rank(query)
+
+    return select(
+        MagazineInformation.id,
+        *result_columns(fields, query),
+        rank_expr.label("score")
+    ).join(
+        MagazineContent, MagazineInformation.id == MagazineContent.magazine_id
+    ).where(
+        keyword_filter(query), *filter_conditions(filters)
+    ).order_by(
+        # Order by text relevance score
+        rank_expr.desc()
+    ).limit(page_size).offset(offset)
+
+# A seperate method for keyword based search on author, title and content (search_document)
+@timed("keyword_search")
+def keyword_search(db: Session,query: str,page: int=1,page_size: int=10, filters: SearchFilters = None,
+                   fields: tuple = DEFAULT_RESULT_FIELDS):
     try:
         logger.info(f"Performing keyword search for query: {query}")
 
-        offset = (page - 1) * page_size
-
-        text_search = func.to_tsquery('english', query.replace(' ', ' | '))
-
-        rank_expr = func.ts_rank_cd(MagazineContent.content_tsvector, text_search)
-
-        query = db.query(
-            MagazineInformation.id,
-            MagazineInformation.title,
-            MagazineInformation.author,
-            MagazineInformation.category,
-            MagazineInformation.publish_date,
-            MagazineContent.content,
-            rank_expr.label("score")
-        ).join(
-            MagazineContent, MagazineInformation.id == MagazineContent.magazine_id
-        ).filter(
-            # Full-text search for content_tsvector
-            text_search.op("@@")(MagazineContent.content_tsvector) |
-            # Title and author search using ILIKE for case-insensitive matching
-            func.lower(MagazineInformation.title).like(f"%{query.lower()}%") |
-            func.lower(MagazineInformation.author).like(f"%{query.lower()}%")
-        ).order_by(
-            # Order by text relevance score
-            rank_expr.desc()
-        ).limit(page_size).offset(offset)
-
-        results = query.all()
+        results = db.execute(keyword_search_statement(query, page, page_size, filters, fields)).all()
         logger.info(f"Keyword search returned {len(results)} results.")
         return results
     
@@ -83,36 +532,46 @@ def keyword_search(db: Session,query: str,page: int=1,page_size: int=10):
         raise Exception(e)
 
 
+# Statement for the vector search with pagination and min score threshold to avoid irrelevant documents
+def vector_search_statement(query_vector, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                            filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS, query: str = None):
+    offset = (page - 1) * page_size
+
+    # Cosine distance calculation (1 - cosine similarity)
+    similarity_score = vector_similarity(query_vector)
+
+    return select(
+        MagazineInformation.id,
+        *result_columns(fields, query),
+        similarity_score.label("score")
+    ).join(
+        MagazineContent, MagazineInformation.id == MagazineContent.magazine_id
+    ).where(
+        similarity_score >= min_score, *filter_conditions(filters)
+    ).order_by(
+        similarity_score.desc()  # Higher similarity scores first
+    ).limit(page_size).offset(offset)
+
 # A seperate method for vector search with pagination and min score threshold to avoid irrelevant documents
-def vector_search(db: Session, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15):
+@timed("vector_search")
+def vector_search(db: Session, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                  filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
     try:
         logger.info(f"Performing vector search for query: {query}")
-        query_vector = get_embeddings(query).tolist() 
-
-        query_vector = func.cast(query_vector, Vector(384))
-
-        offset = (page - 1) * page_size
-
-        # Cosine distance calculation (1 - cosine similarity)
-        similarity_score = 1 - func.cosine_distance(MagazineContent.content_embedding, query_vector)
-
-        query = db.query(
-            MagazineInformation.id,
-            MagazineInformation.title,
-            MagazineInformation.author,
-            MagazineInformation.category,
-            MagazineInformation.publish_date,
-            MagazineContent.content,
-            similarity_score.label("score")
-        ).join(
-            MagazineContent, MagazineInformation.id == MagazineContent.magazine_id
-        ).filter(
-            similarity_score >= min_score
-        ).order_by(
-            similarity_score.desc()  # Higher similarity scores first
-        ).limit(page_size).offset(offset)
-
-        results = query.all()
+        model_name = search_model(db)
+        query_vector = get_query_embedding(query, model_name)
+
+        # the local index holds no metadata, filtered searches are answered by Postgres
+        candidates = None
+        if uses_local_engine(has_filters(filters)):
+            candidates = local_vector_candidates(query_vector, page, page_size, min_score, model_name)
+        if candidates is not None:
+            ids, scores = candidates
+            results = db.execute(*local_hydrate_statement(ids, scores, fields, query)).fetchall() if ids else []
+        else:
+            results = db.execute(vector_search_statement(query_vector, page, page_size, min_score, filters,
+                                                         fields, query)).all()
+
         logger.info(f"Vector search returned {len(results)} results.")
         return results
     
@@ -121,67 +580,328 @@ def vector_search(db: Session, query: str, page: int = 1, page_size: int = 10, m
         raise Exception(e)
 
 
+# Counting the matches of query_magazine (keyword match OR similarity above the threshold) exactly means
+# computing the similarity of every row, the HNSW index can't serve a threshold. So no count reads more than
+# about sample_rows rows:
+#  - small tables (at most sample_rows rows) are counted exactly
+#  - otherwise the match ratio of a block sample of ~sample_rows rows is scaled to the table's row estimate.
+#    A low estimate (at most count_cap) is coarse, one sampled match stands for table_rows / sample_rows rows,
+#    so it is raised to the keyword matches counted through the GIN index, which stops after count_cap + 1
+#    rows. Matches found only by similarity stay estimated, so large tables are always approximate.
+# Returns (total, is_approximate).
+TABLE_ROWS_SQL = text("SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE relname = 'magazine_content'")
+
+def match_count_statement(query: str, query_vector, min_score: float = 0.15, filters: SearchFilters = None):
+    matches = select(MagazineContent.id).where(
+        keyword_filter(query) | (vector_similarity(query_vector) >= min_score)
+    )
+    if has_filters(filters):
+        matches = matches.join(
+            MagazineInformation, MagazineInformation.id == MagazineContent.magazine_id
+        ).where(*filter_conditions(filters))
+    return select(func.count()).select_from(matches.subquery())
+
+# the keyword matches alone, found through the GIN index on search_document, at most cap + 1 of them
+def keyword_match_count_statement(query: str, cap: int, filters: SearchFilters = None):
+    matches = select(MagazineContent.id).where(keyword_filter(query))
+    if has_filters(filters):
+        matches = matches.join(
+            MagazineInformation, MagazineInformation.id == MagazineContent.magazine_id
+        ).where(*filter_conditions(filters))
+    return select(func.count()).select_from(matches.limit(cap + 1).subquery())
+
+def sampled_match_ratio_statement(query: str, query_vector, percent: float, min_score: float = 0.15,
+                                  filters: SearchFilters = None):
+    sample = aliased(MagazineContent, tablesample(MagazineContent.__table__, func.system(percent)))
+    matched = keyword_filter(query, content=sample) | (vector_similarity(query_vector, content=sample) >= min_score)
+    if has_filters(filters):
+        matched = and_(matched, *filter_conditions(filters))
+
+    statement = select(func.avg(case((matched, 1.0), else_=0.0))).select_from(sample)
+    if has_filters(filters):
+        statement = statement.join(MagazineInformation, MagazineInformation.id == sample.magazine_id)
+    return statement
+
+@timed("count_matches")
+def count_query_matches(db: Session, query: str, min_score: float = 0.15, count_cap: int = SEARCH_COUNT_CAP,
+                        sample_rows: int = SEARCH_COUNT_SAMPLE_ROWS, filters: SearchFilters = None):
+    try:
+        query_vector = get_query_embedding(query, search_model(db))
+        table_rows = db.execute(TABLE_ROWS_SQL).scalar() or 0
+        if table_rows <= sample_rows:
+            return db.execute(match_count_statement(query, query_vector, min_score, filters=filters)).scalar(), False
+
+        percent = 100.0 * sample_rows / table_rows
+        ratio = db.execute(sampled_match_ratio_statement(query, query_vector, percent, min_score, filters)).scalar() or 0
+        estimate = round(float(ratio) * table_rows)
+        if estimate > count_cap:
+            return estimate, True
+
+        keyword_matches = db.execute(keyword_match_count_statement(query, count_cap, filters)).scalar()
+        return max(estimate, keyword_matches), True
+
+    except Exception as e:
+        logger.error(f"Error during match counting: {e}")
+        raise Exception(e)
+
+
+# vector_search served from the local memory-mapped index: the nearest ids of the requested page come from the
+# index and only those are hydrated from Postgres in a single WHERE id = ANY(...) query (local_hydrate_statement).
+# None while the index holds another model's vectors than the query's, until its rebuild after a cutover.
+def local_vector_candidates(query_vector, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                            model_name: str = None):
+    offset = (page - 1) * page_size
+    found = local_vector_index.search(query_vector, offset + page_size, model_name)
+    if found is None:
+        return None
+    ids, scores = found
+    keep = scores >= min_score
+    return ids[keep][offset:].tolist(), scores[keep][offset:].tolist()
+
+# unnest keeps the index's order and scores, the ids are resolved through the primary key.
+# Returns the statement and its parameters.
+def local_hydrate_statement(ids: list, scores: list, fields: tuple = DEFAULT_RESULT_FIELDS, query: str = None):
+    columns, params = result_columns_sql(fields, query)
+    content_join = "JOIN magazine_content mc ON mc.magazine_id = ann.id" if needs_content(fields) else ""
+    return text(f"""
+        SELECT mi.id{columns}, ann.score
+        FROM unnest(CAST(:ids AS integer[]), CAST(:scores AS double precision[])) AS ann(id, score)
+        JOIN magazine_information mi ON mi.id = ann.id
+        {content_join}
+        WHERE mi.id = ANY(CAST(:ids AS integer[]))
+        ORDER BY ann.score DESC, mi.id
+    """), {"ids": ids, "scores": scores, **params}
+
+# the local engine's nearest neighbours, passed into combined_search's vector leg as arrays. None like
+# local_vector_candidates, the leg then searches Postgres.
+def local_ann_params(query_vector, candidate_k: int = SEARCH_CANDIDATE_K, model_name: str = None):
+    found = local_vector_index.search(query_vector, candidate_k, model_name)
+    if found is None:
+        return None
+    ann_ids, ann_scores = found
+    return {"ann_ids": ann_ids.tolist(), "ann_distances": (1 - ann_scores).tolist()}
+
+
+# Nearest neighbours of :query_embedding as (magazine_id, distance), at most :candidate_k rows ordered by
+# distance. With the local engine they were already found by the in-process index and are passed in as the
+# :ann_ids / :ann_distances arrays. In the compact storage modes the HNSW index on the compact column over-fetches
+# :oversampled_k candidates which are then re-ranked by their full-precision distance.
+# conditions (filter_sql) restrict the neighbours to matching magazines. The filter is evaluated while the HNSW
+# index is walked, and with hnsw.iterative_scan the walk continues until enough rows pass it, so a selective
+# filter still returns a full candidate list. The local index has no metadata, filtered legs always use Postgres.
+def nearest_neighbours_sql(conditions: str = "", local: bool = False):
+    if local:
+        return """
+            SELECT ann.magazine_id, ann.distance
+            FROM unnest(CAST(:ann_ids AS integer[]), CAST(:ann_distances AS double precision[]))
+                AS ann(magazine_id, distance)
+        """
+
+    filter_join = f"JOIN magazine_information mi ON mi.id = mc.magazine_id WHERE {conditions}" if conditions else ""
+    storage = compact_storage(VECTOR_STORAGE_MODE)
+    if storage is None:
+        return f"""
+            SELECT mc.magazine_id, mc.content_embedding <=> CAST(:query_embedding AS vector) AS distance
+            FROM magazine_content mc
+            {filter_join}
+            ORDER BY mc.content_embedding <=> CAST(:query_embedding AS vector)
+            LIMIT :candidate_k
+        """
+
+    compact_query = storage["expression"].format(source="CAST(:query_embedding AS vector)")
+    return f"""
+            SELECT rerank.magazine_id, rerank.content_embedding <=> CAST(:query_embedding AS vector) AS distance
+            FROM (
+                SELECT mc.id FROM magazine_content mc
+                {filter_join}
+                ORDER BY mc.{storage['column']} {storage['operator']} {compact_query}
+                LIMIT :oversampled_k
+            ) compact_candidates
+            JOIN magazine_content rerank ON rerank.id = compact_candidates.id
+            ORDER BY distance
+            LIMIT :candidate_k
+        """
 
 # An efficient apporoach to perform combines search, sorting, paging and deduplication at database level
-def combined_search(db: Session, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15):
+# Each leg only fetches a bounded top-K of candidates with an index friendly ORDER BY ... LIMIT (the vector leg
+# walks the HNSW index), the two ranked lists are fused with reciprocal rank fusion and only then paginated,
+# so the cost is proportional to K rather than to the table size.
+# Results are ordered by (score, id) descending. Passing the (score, id) of the last row seen as cursor
+# switches from OFFSET paging to keyset paging, so deep pages don't rebuild and discard earlier rows.
+# One row beyond page_size is returned so the caller can tell whether a next page exists.
+# Every row also carries the number of fused candidates (total_results, computed once by the planner as an
+# init plan) and whether a leg was cut off at K, in which case more documents match than can be paged through.
+# filters are pushed into both legs, so each still ranks K matching candidates instead of post-filtering K.
+# Returns the statement and its parameters, shared by the sync and async repositories.
+def combined_search_statement(query: str, query_vector, page: int = 1, page_size: int = 10,
+                              min_score: float = 0.15, cursor: tuple = None,
+                              candidate_k: int = SEARCH_CANDIDATE_K, filters: SearchFilters = None,
+                              fields: tuple = DEFAULT_RESULT_FIELDS, ann_params: dict = None):
+    query_vector = np.array(query_vector, dtype=np.float32)
+    # convert np.array float32 to string
+    query_embedding_str = "[" + ",".join(map(str, query_vector.tolist())) + "]"
+
+    offset = 0 if cursor else (page - 1) * page_size
+    keyset_filter = "WHERE (fr.score, fr.id) < (:cursor_score, :cursor_id)" if cursor else ""
+    conditions, filter_params = filter_sql(filters)
+    keyword_filter_join = "JOIN magazine_information mi ON mi.id = mc.magazine_id" if conditions else ""
+    keyword_filter_where = f"AND {conditions}" if conditions else ""
+    columns, column_params = result_columns_sql(fields, query)
+    content_join = "JOIN magazine_content mc ON mc.magazine_id = fr.id" if needs_content(fields) else ""
+
+    sql_query = text(f"""
+        WITH keyword_candidates AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC, id) AS rank
+                FROM (
+                    SELECT
+                        mc.magazine_id AS id,
+                        ts_rank_cd(mc.search_document, websearch_to_tsquery('english', :search_text)) AS score
+                    FROM magazine_content mc
+                    {keyword_filter_join}
+                    WHERE mc.search_document @@ websearch_to_tsquery('english', :search_text)
+                    {keyword_filter_where}
+                    ORDER BY score DESC, mc.magazine_id
+                    LIMIT :candidate_k
+                ) keyword_matches
+            ),
+            vector_candidates AS (
+                SELECT magazine_id AS id, ROW_NUMBER() OVER (ORDER BY distance, magazine_id) AS rank
+                FROM (
+                    {nearest_neighbours_sql(conditions, local=ann_params is not None)}
+                ) nearest_neighbours
+                WHERE (1 - distance) >= :threshold
+            ),
+            fused_results AS (
+                SELECT id, CAST(SUM(1.0 / (:rrf_k + rank)) AS DOUBLE PRECISION) AS score
+                FROM (
+                    SELECT id, rank FROM keyword_candidates
+                    UNION ALL
+                    SELECT id, rank FROM vector_candidates
+                ) candidates
+                GROUP BY id
+            )
+            SELECT
+                mi.id{columns},
+                fr.score,
+                (SELECT COUNT(*) FROM fused_results) AS total_results,
+                (SELECT COUNT(*) FROM keyword_candidates) >= :candidate_k
+                    OR (SELECT COUNT(*) FROM vector_candidates) >= :candidate_k AS total_is_approximate
+            FROM fused_results fr
+            JOIN magazine_information mi ON mi.id = fr.id
+            {content_join}
+            {keyset_filter}
+            ORDER BY fr.score DESC, fr.id DESC
+            LIMIT :limit OFFSET :offset;
+    """)
+
+    params = {
+        "search_text": query,
+        "query_embedding": query_embedding_str,
+        "threshold": min_score,
+        "candidate_k": candidate_k,
+        "oversampled_k": oversampled_candidate_k(candidate_k),
+        "rrf_k": RRF_K,
+        "limit": page_size + 1,
+        "offset": offset,
+        **filter_params,
+        **column_params,
+        **(ann_params or {}),
+    }
+    if cursor:
+        params["cursor_score"], params["cursor_id"] = cursor
+    return sql_query, params
+
+def oversampled_candidate_k(candidate_k: int = SEARCH_CANDIDATE_K):
+    return candidate_k * VECTOR_RERANK_OVERSAMPLE if VECTOR_STORAGE_MODE != "full" else candidate_k
+
+# The HNSW scan only returns ef_search rows (at most 1000), so it has to cover the candidate window. Filtered
+# searches also turn on iterative scans, otherwise rows failing the filter would eat into that window. The
+# setting only exists from pgvector 0.8 on, older versions reject it once the extension is loaded.
+def ef_search_statement(candidate_k: int = SEARCH_CANDIDATE_K, filtered: bool = False):
+    ef_search = min(max(HNSW_EF_SEARCH, oversampled_candidate_k(candidate_k)), 1000)
+    if not filtered or HNSW_ITERATIVE_SCAN == "off":
+        return text("SELECT set_config('hnsw.ef_search', :ef_search, true)").bindparams(ef_search=str(ef_search))
+
+    return text("""
+        SELECT set_config('hnsw.ef_search', :ef_search, true),
+               CASE WHEN (SELECT string_to_array(extversion, '.')::integer[] >= '{0,8}'
+                          FROM pg_extension WHERE extname = 'vector')
+                    THEN set_config('hnsw.iterative_scan', :iterative_scan, true) END
+    """).bindparams(ef_search=str(ef_search), iterative_scan=HNSW_ITERATIVE_SCAN)
+
+@timed("combined_search")
+def combined_search(db: Session, query: str, page: int = 1, page_size: int = 10, min_score: float = 0.15,
+                    cursor: tuple = None, candidate_k: int = SEARCH_CANDIDATE_K, filters: SearchFilters = None,
+                    fields: tuple = DEFAULT_RESULT_FIELDS):
     try:
         logger.info(f"Performing combined search for query: {query}")
-        query_vector = get_embeddings(query)
-        query_vector = np.array(query_vector, dtype=np.float32)
-        # convert np.array float32 to string
-        query_embedding_str = "[" + ",".join(map(str, query_vector.tolist())) + "]"
-
-        offset = (page - 1) * page_size
-
-        sql_query = text(f"""
-            WITH keyword_search AS (
-                    SELECT 
-                        mi.id, mi.title, mi.author, mi.category, mi.publish_date,
-                        mc.content,
-                        ts_rank_cd(mc.content_tsvector, to_tsquery('english', :query)) AS score
-                    FROM magazine_information mi
-                    JOIN magazine_content mc ON mi.id = mc.magazine_id
-                    WHERE (mc.content_tsvector @@ to_tsquery('english', :query))
-                    OR mi.title % :query
-                    OR mi.author % :query
-                    OR mi.title ILIKE '%' || :query || '%' 
-                    OR mi.author ILIKE '%' || :query || '%'
-                ),
-                vector_search AS (
-                    SELECT * FROM (
-                        SELECT 
-                            mi.id, mi.title, mi.author, mi.category, mi.publish_date,
-                            mc.content,
-                            (1 - (mc.content_embedding <=> :query_embedding)) AS score
-                        FROM magazine_information mi
-                        JOIN magazine_content mc ON mi.id = mc.magazine_id
-                    ) subquery
-                    WHERE score >= :threshold 
-                    ORDER BY score DESC
-                ),
-                combined_results AS (
-                    SELECT * FROM keyword_search
-                    UNION ALL
-                    SELECT * FROM vector_search
-                )
-                SELECT DISTINCT ON (id) *
-                FROM combined_results
-                ORDER BY id, score DESC
-                LIMIT :page_size OFFSET :offset;
-        """)
+        model_name = search_model(db)
+        query_vector = get_query_embedding(query, model_name)
+        ann_params = None
+        if uses_local_engine(has_filters(filters)):
+            ann_params = local_ann_params(query_vector, candidate_k, model_name)
+        sql_query, params = combined_search_statement(query, query_vector, page, page_size, min_score,
+                                                      cursor, candidate_k, filters, fields, ann_params)
+
+        db.execute(ef_search_statement(candidate_k, has_filters(filters)))
 
         # Execute the query with parameters
-        results = db.execute(sql_query, {
-            "query": query.replace(" ", " | "),
-            "query_embedding": query_embedding_str,
-            "threshold": min_score,
-            "page_size": page_size,
-            "offset": offset,
-        }).fetchall()
+        results = db.execute(sql_query, params).fetchall()
 
         logger.info(f"Combined search returned {len(results)} results.")
         return results
     
     except Exception as e:
         logger.error(f"Error during combined search: {e}")
-        raise Exception(e)
\ No newline at end of file
+        raise Exception(e)
+
+# (category, year, magazines) rows of the maintained facet counts
+def facet_counts_statement():
+    return select(
+        MagazineFacetCount.category, MagazineFacetCount.year, MagazineFacetCount.magazines
+    ).where(MagazineFacetCount.magazines > 0)
+
+@timed("facet_counts")
+def facet_counts(db: Session):
+    try:
+        return db.execute(facet_counts_statement()).all()
+
+    except Exception as e:
+        logger.error(f"Error while reading facet counts: {e}")
+        raise Exception(e)
+
+# Statement for the export: whole magazines in id order, so an interrupted export resumes after the last id it
+# received. The embedding is selected as pgvector text, "[0.1,0.2,...]", which already is a JSON array.
+def export_statement(filters: SearchFilters = None, after_id: int = None, max_id: int = None,
+                     include_embeddings: bool = False):
+    columns = [
+        MagazineInformation.id,
+        MagazineInformation.title,
+        MagazineInformation.author,
+        MagazineInformation.category,
+        MagazineInformation.publish_date,
+        MagazineContent.content,
+    ]
+    if include_embeddings:
+        columns.append(cast(MagazineContent.content_embedding, Text).label("embedding"))
+
+    conditions = filter_conditions(filters)
+    if after_id is not None:
+        conditions.append(MagazineInformation.id > after_id)
+    if max_id is not None:
+        conditions.append(MagazineInformation.id <= max_id)
+
+    return select(*columns).join(
+        MagazineContent, MagazineInformation.id == MagazineContent.magazine_id
+    ).where(*conditions).order_by(MagazineInformation.id)
+
+# Export rows in batches of batch_size from a server-side cursor, so only one batch is held in memory at a time
+def export_rows(db: Session, filters: SearchFilters = None, after_id: int = None, max_id: int = None,
+                include_embeddings: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    try:
+        statement = export_statement(filters, after_id, max_id, include_embeddings)
+        yield from db.execute(statement.execution_options(yield_per=batch_size)).partitions()
+
+    except Exception as e:
+        logger.error(f"Error while exporting magazines: {e}")
+        raise Exception(e)
@@ -1,6 +1,7 @@
 from typing import List, Optional
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, model_validator, validator
 from datetime import datetime, date
+from app.config import INGEST_ON_DUPLICATE
 
 class MagazineBase(BaseModel):
     id: Optional[int] = None
@@ -10,9 +11,108 @@ class MagazineBase(BaseModel):
     publish_date: date = Field(..., description="Date must be in YYYY-MM-DD format.")
     content: str = Field(..., min_length=10, description="Content must be at least 10 characters long.")
     
+# Fields a search result can return: the magazine's columns and a highlighted excerpt of the content matching
+# the query. The id is always returned.
+RESULT_FIELDS = ("id", "title", "author", "category", "publish_date", "content", "snippet")
+DEFAULT_RESULT_FIELDS = ("id", "title", "author", "category", "publish_date", "content")
+
+def parse_result_fields(fields: str = None):
+    if not fields:
+        return DEFAULT_RESULT_FIELDS
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested.difference(RESULT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}, expected {', '.join(RESULT_FIELDS)}")
+    return tuple(field for field in RESULT_FIELDS if field in requested or field == "id")
+
+# What ingest does with a magazine whose content is already stored, see INGEST_ON_DUPLICATE
+DUPLICATE_POLICIES = ("skip", "update_metadata", "insert")
+
+def parse_on_duplicate(on_duplicate: str = None):
+    on_duplicate = on_duplicate or INGEST_ON_DUPLICATE
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown on_duplicate '{on_duplicate}', expected {', '.join(DUPLICATE_POLICIES)}")
+    return on_duplicate
+
+# A search result row. Built with model_construct from database rows, which are trusted, so the input
+# constraints of MagazineBase are not re-checked on every read; fields that weren't requested stay unset and
+# are left out of the JSON.
+class MagazineResult(BaseModel):
+    id: Optional[int] = None
+    title: Optional[str] = None
+    author: Optional[str] = None
+    category: Optional[str] = None
+    publish_date: Optional[date] = None
+    content: Optional[str] = None
+    snippet: Optional[str] = None
+
 class MagazineResponse(BaseModel):
-    magazines: List[MagazineBase]
+    magazines: List[MagazineResult]
     page: int
     page_size: int
     total_results: Optional[int] = None
-    total_pages: Optional[int] = None
\ No newline at end of file
+    total_pages: Optional[int] = None
+    # set when total_results is an estimate (or a lower bound) rather than an exact count
+    total_is_approximate: Optional[bool] = None
+    # opaque keyset cursor for the next page, only set by hybrid search
+    next_cursor: Optional[str] = None
+
+# Optional filters of both search endpoints. Frozen so they can be part of cache keys; an inverted date range
+# fails validation, which the routes report as a 400.
+class SearchFilters(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    category: Optional[str] = None
+    author: Optional[str] = None
+    published_from: Optional[date] = None
+    published_to: Optional[date] = None
+
+    @model_validator(mode="after")
+    def check_date_range(self):
+        if self.published_from and self.published_to and self.published_from > self.published_to:
+            raise ValueError("published_from must not be after published_to")
+        return self
+
+    def is_empty(self):
+        return all(value is None for value in self.model_dump().values())
+
+class CategoryFacet(BaseModel):
+    category: str
+    count: int
+
+class YearFacet(BaseModel):
+    year: int
+    count: int
+
+class FacetsResponse(BaseModel):
+    categories: List[CategoryFacet]
+    years: List[YearFacet]
+
+# 202 response of POST /magazine?job=true
+class IngestJobAccepted(BaseModel):
+    job_id: int
+    status: str
+    total: int
+    status_url: str
+
+class IngestRecordFailure(BaseModel):
+    # position of the record in the submitted batch
+    position: int
+    error: str
+
+# Progress of an ingest job. records_per_second is measured from the first claimed batch to the last
+# finished one, or to now while the job is still running.
+class IngestJobResponse(BaseModel):
+    job_id: int
+    status: str
+    total: int
+    processed: int
+    succeeded: int
+    failed: int
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    records_per_second: Optional[float] = None
+    # records stored without encoding their content, which was stored already
+    encodes_avoided: int = 0
+    failures: List[IngestRecordFailure] = []
@@ -0,0 +1,116 @@
+import argparse
+import gc
+import os
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from app.config import (
+    EMBEDDING_BACKEND, PROMETHEUS_MULTIPROC_DIR, SERVER_HOST, SERVER_PORT, SERVER_THREADS_PER_WORKER, SERVER_WORKERS,
+)
+
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Multi-worker production server: gunicorn managing uvicorn workers with the app preloaded in the master.
+# The PyTorch model is loaded once before forking, so its weights are shared copy-on-write by every worker
+# instead of each worker holding its own copy, and the model's intra-op threads are split between the
+# workers so N workers don't each start one thread per core.
+#
+#   python -m app.server --workers 4
+
+
+def threads_per_worker(workers: int, threads: int = SERVER_THREADS_PER_WORKER):
+    return threads or max(1, (os.cpu_count() or 1) // workers)
+
+# Runs in the master before forking. Only the PyTorch backend is preloaded: ONNX Runtime starts its thread
+# pools when the session is created and they don't survive a fork, and the quantized model is small enough
+# to load per worker. The warm-up runs single threaded so the master never starts an OpenMP thread team,
+# which isn't fork safe either.
+def preload_model():
+    from app.util.embedding_backends import OnnxBackend
+    from app.util.utils import refresh_embedding_model, set_model_threads, warm_up_model
+
+    if EMBEDDING_BACKEND == OnnxBackend.name:
+        logger.info("ONNX backend, the model is loaded by each worker.")
+        return
+
+    # preload the model the stored vectors came from, a fresh database doesn't have the state table yet
+    try:
+        refresh_embedding_model()
+    except Exception as e:
+        logger.info(f"No embedding model state yet, preloading the configured model: {str(e).splitlines()[0]}")
+    set_model_threads(1)
+    warm_up_model()
+    # objects loaded so far are never freed, keeping the collector away from them avoids touching (and so
+    # copying) their pages in every worker
+    gc.freeze()
+
+# Runs in every worker right after the fork
+def post_fork(server, worker):
+    from app.database import sync_engines
+    from app.util.utils import set_model_threads
+
+    threads = threads_per_worker(server.cfg.workers)
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    set_model_threads(threads)
+    # connections opened by the master must not be shared with the children
+    for engine in sync_engines():
+        engine.dispose(close=False)
+    logger.info(f"Worker {worker.pid} started with {threads} model threads.")
+
+# Runs in the master when a worker exited, its gauges no longer describe a live process
+def child_exit(server, worker):
+    from app.util.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
+
+
+class MagazineServer(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.main import app
+
+        return app
+
+
+def run(host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = SERVER_WORKERS, timeout: int = 120):
+    from app.util.metrics import enable_multiprocess
+
+    enable_multiprocess(PROMETHEUS_MULTIPROC_DIR or tempfile.mkdtemp(prefix="magazine-metrics-"))
+    preload_model()
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "post_fork": post_fork,
+        "child_exit": child_exit,
+        "timeout": timeout,
+    }
+    logger.info(f"Starting {workers} workers on {host}:{port}, {threads_per_worker(workers)} model threads each.")
+    MagazineServer(options).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API with several worker processes sharing one preloaded model.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--timeout", type=int, default=120, help="Seconds before a silent worker is restarted")
+    args = parser.parse_args()
+
+    run(args.host, args.port, args.workers, args.timeout)
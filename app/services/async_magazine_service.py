@@ -0,0 +1,146 @@
+from typing import List
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import INGEST_JOB_FAILURES_REPORTED, INGEST_ON_DUPLICATE
+from app.database import open_async_read_session
+from app.repositories.async_magazine_repository import (
+    create_magazine, create_magazines_bulk, keyword_search, vector_search, combined_search, count_query_matches,
+    facet_counts, export_rows, create_ingest_job, ingest_job,
+)
+from app.schemas.magazine import DEFAULT_RESULT_FIELDS, MagazineBase, SearchFilters
+from app.services.magazine_service import (
+    build_facets_response, build_hybrid_response, build_ingest_job_response, build_query_response, cache_ttl,
+    export_line, ingest_job_accepted, invalidate_search_caches, search_count_cache, search_result_cache,
+)
+from app.util.utils import normalize_query
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of magazine_service for ASYNC_MODE, sharing its result cache and response builders
+
+
+async def save_magazine(db: AsyncSession, magazine_data: MagazineBase, on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info("Saving magazine to the database: %s", magazine_data.title)
+        saved_magazine, encodes_avoided = await create_magazine(db, magazine_data, on_duplicate)
+        invalidate_search_caches()
+        return saved_magazine, encodes_avoided
+    except Exception as e:
+        logger.error("Error in save_magazine: %s", str(e))
+        raise Exception(f"Error in save_magazine: {e}")
+
+async def save_magazines_bulk(db: AsyncSession, magazines: List[MagazineBase],
+                              on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info("Bulk saving %d magazines to the database", len(magazines))
+        started = time.perf_counter()
+        saved_magazines, encodes_avoided = await create_magazines_bulk(db, magazines, on_duplicate)
+        invalidate_search_caches()
+        elapsed = time.perf_counter() - started
+        logger.info("Bulk saved %d magazines in %.2fs (%.1f records/s, %d encodes avoided)",
+                    len(saved_magazines), elapsed, len(saved_magazines) / elapsed if elapsed else 0.0,
+                    encodes_avoided)
+        return saved_magazines, encodes_avoided
+    except Exception as e:
+        logger.error("Error in save_magazines_bulk: %s", str(e))
+        raise Exception(f"Error in save_magazines_bulk: {e}")
+
+async def submit_ingest_job(db: AsyncSession, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info("Staging %d magazines as an ingest job", len(magazines))
+        return ingest_job_accepted(await create_ingest_job(db, magazines, on_duplicate), len(magazines))
+    except Exception as e:
+        logger.error("Error in submit_ingest_job: %s", str(e))
+        raise Exception(f"Error in submit_ingest_job: {e}")
+
+async def get_ingest_job(db: AsyncSession, job_id: int):
+    try:
+        job, failures = await ingest_job(db, job_id, INGEST_JOB_FAILURES_REPORTED)
+        return None if job is None else build_ingest_job_response(job, failures)
+    except Exception as e:
+        logger.error("Error in get_ingest_job: %s", str(e))
+        raise Exception(f"Error in get_ingest_job: {e}")
+
+async def query_magazine(db: AsyncSession, query: str, page: int = 1, page_size: int = 10,
+                         filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.debug("Querying magazine with search term: '%s' | Page: %d | Page Size: %d", query, page, page_size)
+        cache_key = ("query_magazine", normalize_query(query), page, page_size, filters, fields)
+        # read before searching, a write committed meanwhile keeps the response out of the cache
+        generation = search_result_cache.generation
+        count_generation = search_count_cache.generation
+        cached_response = search_result_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached results for search term: '%s'", query)
+            return cached_response
+
+        # an AsyncSession runs one statement at a time, so the two legs are awaited one after the other
+        keyword_search_results = await keyword_search(db=db, query=query, page=page, page_size=page_size*2,
+                                                      filters=filters, fields=fields)
+        logger.debug("Keyword search fetched %d results", len(keyword_search_results))
+        vector_search_results = await vector_search(db=db, query=query, page=page, page_size=page_size*2,
+                                                    filters=filters, fields=fields)
+        logger.debug("Vector search fetched %d results", len(vector_search_results))
+
+        count_key = (normalize_query(query), filters)
+        counted = search_count_cache.get(count_key)
+        if counted is None:
+            counted = await count_query_matches(db=db, query=query, filters=filters)
+            search_count_cache.put(count_key, counted, cache_ttl(db), count_generation)
+
+        response = build_query_response(keyword_search_results, vector_search_results, page, page_size, *counted,
+                                        fields=fields)
+        search_result_cache.put(cache_key, response, cache_ttl(db), generation)
+        return response
+
+    except Exception as e:
+        logger.error("Error in query_magazine: %s", str(e))
+        raise Exception(f"Error in query_magazine: {e}")
+
+async def hybrid_search(db: AsyncSession, query: str, page: int = 1, page_size: int = 10, cursor: tuple = None,
+                        filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.debug("Performing hybrid search with query: '%s' | Page: %d | Page Size: %d", query, page, page_size)
+        cache_key = ("hybrid_search", normalize_query(query), page, page_size, cursor, filters, fields)
+        generation = search_result_cache.generation
+        cached_response = search_result_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached hybrid search results for query: '%s'", query)
+            return cached_response
+
+        results = await combined_search(db=db, query=query, page=page, page_size=page_size, cursor=cursor,
+                                        filters=filters, fields=fields)
+        logger.debug("Hybrid search fetched %d results", len(results))
+
+        response = build_hybrid_response(results, page, page_size, first_page=page == 1 and cursor is None,
+                                         fields=fields)
+        search_result_cache.put(cache_key, response, cache_ttl(db), generation)
+        return response
+    except Exception as e:
+        logger.error("Error in hybrid_search: %s", str(e))
+        raise Exception(f"Error in hybrid_search: {e}")
+
+async def get_facets(db: AsyncSession):
+    try:
+        return build_facets_response(await facet_counts(db))
+    except Exception as e:
+        logger.error("Error in get_facets: %s", str(e))
+        raise Exception(f"Error in get_facets: {e}")
+
+# async counterpart of magazine_service.export_magazines
+async def export_magazines(filters: SearchFilters = None, after_id: int = None, max_id: int = None,
+                           include_embeddings: bool = False):
+    exported = 0
+    db = await open_async_read_session()
+    try:
+        async for rows in export_rows(db, filters, after_id, max_id, include_embeddings):
+            yield "".join(export_line(row, include_embeddings) for row in rows)
+            exported += len(rows)
+        logger.info("Exported %d magazines", exported)
+    except Exception as e:
+        logger.error("Error in export_magazines after %d magazines: %s", exported, str(e))
+        raise Exception(f"Error in export_magazines: {e}")
+    finally:
+        await db.close()
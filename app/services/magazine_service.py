@@ -1,125 +1,332 @@
+from typing import List
 from sqlalchemy import text
 from sqlalchemy.orm import Session
-from app.repositories.magazine_repository import create_magazine, keyword_search, vector_search, combined_search
-from app.schemas.magazine import MagazineBase, MagazineResponse
+from app.database import SessionLocal, open_read_session
+from app.repositories.magazine_repository import (
+    create_magazine, create_magazines_bulk, keyword_search, vector_search, combined_search, count_query_matches,
+    facet_counts, export_rows, create_ingest_job, ingest_job, ingest_staged_batch,
+)
+from app.schemas.magazine import (
+    DEFAULT_RESULT_FIELDS, CategoryFacet, FacetsResponse, IngestJobAccepted, IngestJobResponse, IngestRecordFailure,
+    MagazineBase, MagazineResponse, MagazineResult, SearchFilters, YearFacet,
+)
 
+import json
 import logging
+import time
 
-from app.util.utils import get_embeddings
+from app.config import (
+    INGEST_JOB_FAILURES_REPORTED, INGEST_ON_DUPLICATE, REPLICA_RESULT_CACHE_TTL, RESULT_CACHE_SIZE, RESULT_CACHE_TTL,
+    RESULT_CACHE_MAX_MB,
+)
+from app.util.cache import LRUCache
+from app.util.pagination import encode_cursor
+from app.util.timing import span
+from app.util.utils import get_embeddings, normalize_query
 
 logger = logging.getLogger(__name__)
 
-# saving magazine to the database
-def save_magazine(db: Session, magazine_data: MagazineBase):
+# rough memory footprint of a cached response, used to keep the result cache under its memory cap
+def estimate_response_size(response: MagazineResponse):
+    return 512 + sum(
+        256 + sum(len(value) for value in (magazine.title, magazine.author, magazine.category, magazine.content,
+                                           magazine.snippet) if value)
+        for magazine in response.magazines
+    )
+
+# Reads vastly outnumber writes, so search responses are cached per worker. Every committed write, by any
+# process, bumps the cache generation (see app.util.migrations.install_search_changed), which turns all
+# previously cached responses into misses.
+search_result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_MAX_MB * 1024 * 1024,
+                               estimate_response_size)
+# (total, is_approximate) per normalized query, so paging through a result set counts its matches only once
+search_count_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def invalidate_search_caches():
+    search_result_cache.invalidate()
+    search_count_cache.invalidate()
+
+# a replica may not have replayed the write that last invalidated the caches yet, so what it served expires soon
+def cache_ttl(db):
+    return REPLICA_RESULT_CACHE_TTL if db.info.get("replica") else None
+
+def total_pages(total_results, page_size: int):
+    return None if total_results is None else -(-total_results // page_size)
+
+# saving magazine to the database, returns it with the number of encodes avoided (1 for a stored content)
+def save_magazine(db: Session, magazine_data: MagazineBase, on_duplicate: str = INGEST_ON_DUPLICATE):
     try:
         logger.info("Saving magazine to the database: %s", magazine_data.title)
-        return create_magazine(db, magazine_data)
+        saved_magazine, encodes_avoided = create_magazine(db, magazine_data, on_duplicate)
+        invalidate_search_caches()
+        return saved_magazine, encodes_avoided
     except Exception as e:
         logger.error("Error in save_magazine: %s", str(e))
         raise Exception(f"Error in save_magazine: {e}")
 
-# A basic approach of querying information seperately and then performing deduplication ---> Less Efficient 
-# as paging will be inefficient and will query huge data unncessarily
-def query_magazine(db: Session, query: str, page: int = 1, page_size: int = 10):
+# saving a whole batch of magazines in one transaction, reporting the achieved throughput
+def save_magazines_bulk(db: Session, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
     try:
-        logger.debug("Querying magazine with search term: '%s' | Page: %d | Page Size: %d", query, page, page_size)
-        # Fetch all results with 2*page_size as we might fetch duplicate magazines 
-        keyword_search_results = keyword_search(db=db, query=query, page=page, page_size=page_size*2)
-        logger.debug("Keyword search fetched %d results", len(keyword_search_results))
-        vector_search_results = vector_search(db=db, query=query, page=page, page_size=page_size*2)
-        logger.debug("Vector search fetched %d results", len(vector_search_results))
-        # Merge both result sets
-        combined_results = keyword_search_results + vector_search_results
-        logger.debug("Total combined results before deduplication: %d", len(combined_results))
-
-        # Deduplicate by magazine_id (keeping highest-scored one)
-        unique_magazines = {}
-        for result in combined_results:
-            magazine_id = result.id
-            if magazine_id not in unique_magazines:
-                unique_magazines[magazine_id] = {
-                    "id": result.id,
-                    "title": result.title,
-                    "author": result.author,
-                    "category": result.category,
-                    "publish_date": result.publish_date,
-                    "content": result.content,
-                    "score": result.score
-                }
-            else:
-                if unique_magazines[magazine_id]["score"] < result.score:
-                    unique_magazines[magazine_id] = {
-                        "id": result.id,
-                        "title": result.title,
-                        "author": result.author,
-                        "category": result.category,
-                        "publish_date": result.publish_date,
-                        "content": result.content
-                    }
-
-        # Convert dictionary to list (sorted)
-        sorted_unique_magazines = list(unique_magazines.values())
-        logger.info("Total unique magazines after deduplication: %d", len(sorted_unique_magazines))
-        # Apply pagination **after deduplication**
-        offset = (page - 1) * page_size
-        paginated_results = sorted_unique_magazines[offset:offset + page_size]
-
-        # Convert to JSON-friendly format
-        magazines = [
-            MagazineBase(
-                id=magzine['id'],
-                title=magzine['title'],
-                author=magzine['author'],
-                category=magzine['category'],
-                publish_date=magzine['publish_date'],
-                content=magzine['content']
-            )
-            for magzine in paginated_results
-        ]
+        logger.info("Bulk saving %d magazines to the database", len(magazines))
+        started = time.perf_counter()
+        saved_magazines, encodes_avoided = create_magazines_bulk(db, magazines, on_duplicate)
+        invalidate_search_caches()
+        elapsed = time.perf_counter() - started
+        logger.info("Bulk saved %d magazines in %.2fs (%.1f records/s, %d encodes avoided)",
+                    len(saved_magazines), elapsed, len(saved_magazines) / elapsed if elapsed else 0.0,
+                    encodes_avoided)
+        return saved_magazines, encodes_avoided
+    except Exception as e:
+        logger.error("Error in save_magazines_bulk: %s", str(e))
+        raise Exception(f"Error in save_magazines_bulk: {e}")
+
+def ingest_job_accepted(job_id: int, total: int):
+    return IngestJobAccepted(job_id=job_id, status="queued", total=total, status_url=f"/api/magazine/jobs/{job_id}")
+
+# stages a batch as an ingest job, the background workers embed and insert it
+def submit_ingest_job(db: Session, magazines: List[MagazineBase], on_duplicate: str = INGEST_ON_DUPLICATE):
+    try:
+        logger.info("Staging %d magazines as an ingest job", len(magazines))
+        return ingest_job_accepted(create_ingest_job(db, magazines, on_duplicate), len(magazines))
+    except Exception as e:
+        logger.error("Error in submit_ingest_job: %s", str(e))
+        raise Exception(f"Error in submit_ingest_job: {e}")
+
+# Ingests one batch of staged records on its own write session, for the background workers. Returns the
+# number of records claimed, 0 once staging is drained.
+def drain_ingest_batch(batch_size: int):
+    db = SessionLocal()
+    try:
+        claimed, inserted = ingest_staged_batch(db, batch_size)
+        if inserted:
+            invalidate_search_caches()
+        return claimed
+    except Exception as e:
+        logger.error("Error in drain_ingest_batch: %s", str(e))
+        raise Exception(f"Error in drain_ingest_batch: {e}")
+    finally:
+        db.close()
+
+# Progress report of an ingest job, shared by the sync and async paths
+def build_ingest_job_response(job, failures):
+    processed = job.IngestJob.succeeded + job.IngestJob.failed
+    records_per_second = None
+    if job.IngestJob.started_at is not None:
+        elapsed = ((job.IngestJob.finished_at or job.now) - job.IngestJob.started_at).total_seconds()
+        records_per_second = round(processed / elapsed, 1) if elapsed > 0 else None
+
+    return IngestJobResponse(
+        job_id=job.IngestJob.id,
+        status=job.IngestJob.status,
+        total=job.IngestJob.total,
+        processed=processed,
+        succeeded=job.IngestJob.succeeded,
+        failed=job.IngestJob.failed,
+        created_at=job.IngestJob.created_at,
+        started_at=job.IngestJob.started_at,
+        finished_at=job.IngestJob.finished_at,
+        records_per_second=records_per_second,
+        encodes_avoided=job.IngestJob.encodes_avoided,
+        failures=[IngestRecordFailure(position=failure.position, error=failure.error) for failure in failures]
+    )
+
+# None when there is no such job
+def get_ingest_job(db: Session, job_id: int):
+    try:
+        job, failures = ingest_job(db, job_id, INGEST_JOB_FAILURES_REPORTED)
+        return None if job is None else build_ingest_job_response(job, failures)
+    except Exception as e:
+        logger.error("Error in get_ingest_job: %s", str(e))
+        raise Exception(f"Error in get_ingest_job: {e}")
+
+# Search result models with only the requested fields set. The rows come straight from our own tables, so
+# they are constructed without re-running MagazineBase's input validation.
+def result_models(rows, fields: tuple = DEFAULT_RESULT_FIELDS):
+    return [MagazineResult.model_construct(**{field: row._mapping[field] for field in fields}) for row in rows]
+
+# Merges the keyword and vector result rows into the paginated response, shared by the sync and async paths
+def build_query_response(keyword_search_results, vector_search_results, page: int, page_size: int,
+                         total_results: int = None, total_is_approximate: bool = None,
+                         fields: tuple = DEFAULT_RESULT_FIELDS):
+    # Merge both result sets
+    combined_results = keyword_search_results + vector_search_results
+    logger.debug("Total combined results before deduplication: %d", len(combined_results))
+
+    # Deduplicate by magazine_id (keeping highest-scored one)
+    unique_magazines = {}
+    for result in combined_results:
+        kept = unique_magazines.get(result.id)
+        if kept is None or kept.score < result.score:
+            unique_magazines[result.id] = result
+
+    # Convert dictionary to list (sorted)
+    sorted_unique_magazines = list(unique_magazines.values())
+    logger.info("Total unique magazines after deduplication: %d", len(sorted_unique_magazines))
+    # Apply pagination **after deduplication**
+    offset = (page - 1) * page_size
+    paginated_results = sorted_unique_magazines[offset:offset + page_size]
+
+    # Convert to JSON-friendly format
+    with span("build_response"):
+        magazines = result_models(paginated_results, fields)
 
         logger.info("Returning %d paginated results", len(magazines))
 
         # Return paginated response
-        return MagazineResponse(
+        response = MagazineResponse.model_construct(
             magazines=magazines,
             page=page,
             page_size=page_size,
-            total_results=len(sorted_unique_magazines),
-            total_pages= len(sorted_unique_magazines) // page_size
+            total_results=total_results,
+            total_pages=total_pages(total_results, page_size),
+            total_is_approximate=total_is_approximate,
+            next_cursor=None
         )
+    return response
+
+# A basic approach of querying information seperately and then performing deduplication ---> Less Efficient 
+# as paging will be inefficient and will query huge data unncessarily
+def query_magazine(db: Session, query: str, page: int = 1, page_size: int = 10, filters: SearchFilters = None,
+                   fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.debug("Querying magazine with search term: '%s' | Page: %d | Page Size: %d", query, page, page_size)
+        cache_key = ("query_magazine", normalize_query(query), page, page_size, filters, fields)
+        # read before searching, a write committed meanwhile keeps the response out of the cache
+        generation = search_result_cache.generation
+        count_generation = search_count_cache.generation
+        cached_response = search_result_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached results for search term: '%s'", query)
+            return cached_response
+
+        # Fetch all results with 2*page_size as we might fetch duplicate magazines 
+        keyword_search_results = keyword_search(db=db, query=query, page=page, page_size=page_size*2, filters=filters,
+                                                fields=fields)
+        logger.debug("Keyword search fetched %d results", len(keyword_search_results))
+        vector_search_results = vector_search(db=db, query=query, page=page, page_size=page_size*2, filters=filters,
+                                              fields=fields)
+        logger.debug("Vector search fetched %d results", len(vector_search_results))
+
+        count_key = (normalize_query(query), filters)
+        counted = search_count_cache.get(count_key)
+        if counted is None:
+            counted = count_query_matches(db=db, query=query, filters=filters)
+            search_count_cache.put(count_key, counted, cache_ttl(db), count_generation)
+
+        response = build_query_response(keyword_search_results, vector_search_results, page, page_size, *counted,
+                                        fields=fields)
+        search_result_cache.put(cache_key, response, cache_ttl(db), generation)
+        return response
 
     except Exception as e:
         logger.error("Error in query_magazine: %s", str(e))
         raise Exception(f"Error in query_magazine: {e}")
     
 
-def hybrid_search(db: Session, query: str, page: int = 1, page_size: int = 10):
-    try:
-        logger.debug("Performing hybrid search with query: '%s' | Page: %d | Page Size: %d", query, page, page_size)
-        results = combined_search(db=db,query=query,page=page,page_size=page_size)
-        logger.debug("Hybrid search fetched %d results", len(results))
-        magazines = [
-            MagazineBase(
-                id=row.id,
-                title=row.title,
-                author=row.author,
-                category=row.category,
-                publish_date=row.publish_date,
-                content=row.content
-            )
-            for row in results
-        ]
+# Trims the extra lookahead row into next_cursor and builds the response, shared by the sync and async paths
+def build_hybrid_response(results, page: int, page_size: int, first_page: bool = True,
+                          fields: tuple = DEFAULT_RESULT_FIELDS):
+    # every row carries the totals, an empty first page means there are no matches at all
+    total_results, total_is_approximate = (
+        (results[0].total_results, results[0].total_is_approximate) if results else
+        (0, False) if first_page else (None, None)
+    )
+
+    next_cursor = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_cursor = encode_cursor(results[-1].score, results[-1].id)
+
+    with span("build_response"):
+        magazines = result_models(results, fields)
 
         logger.info("Returning %d results from hybrid search", len(magazines))
 
-        return MagazineResponse(
+        response = MagazineResponse.model_construct(
             magazines=magazines,
             page=page,
-            page_size=page_size
+            page_size=page_size,
+            total_results=total_results,
+            total_pages=total_pages(total_results, page_size),
+            total_is_approximate=total_is_approximate,
+            next_cursor=next_cursor
         )
+    return response
+
+def hybrid_search(db: Session, query: str, page: int = 1, page_size: int = 10, cursor: tuple = None,
+                  filters: SearchFilters = None, fields: tuple = DEFAULT_RESULT_FIELDS):
+    try:
+        logger.debug("Performing hybrid search with query: '%s' | Page: %d | Page Size: %d", query, page, page_size)
+        cache_key = ("hybrid_search", normalize_query(query), page, page_size, cursor, filters, fields)
+        generation = search_result_cache.generation
+        cached_response = search_result_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached hybrid search results for query: '%s'", query)
+            return cached_response
+
+        results = combined_search(db=db, query=query, page=page, page_size=page_size, cursor=cursor, filters=filters,
+                                  fields=fields)
+        logger.debug("Hybrid search fetched %d results", len(results))
+
+        response = build_hybrid_response(results, page, page_size, first_page=page == 1 and cursor is None,
+                                         fields=fields)
+        search_result_cache.put(cache_key, response, cache_ttl(db), generation)
+        return response
     except Exception as e:
         logger.error("Error in hybrid_search: %s", str(e))
         raise Exception(f"Error in hybrid_search: {e}")
 
+# Rolls the (category, year) counts up into the two facet lists, shared by the sync and async paths
+def build_facets_response(rows):
+    categories, years = {}, {}
+    for row in rows:
+        categories[row.category] = categories.get(row.category, 0) + row.magazines
+        years[row.year] = years.get(row.year, 0) + row.magazines
+
+    return FacetsResponse(
+        categories=[CategoryFacet(category=category, count=count)
+                    for category, count in sorted(categories.items(), key=lambda item: (-item[1], item[0]))],
+        years=[YearFacet(year=year, count=count) for year, count in sorted(years.items(), reverse=True)]
+    )
 
+# facet counts come from the trigger maintained aggregate, a few hundred rows at most
+def get_facets(db: Session):
+    try:
+        return build_facets_response(facet_counts(db))
+    except Exception as e:
+        logger.error("Error in get_facets: %s", str(e))
+        raise Exception(f"Error in get_facets: {e}")
 
+# One NDJSON line per magazine. The embedding arrives as pgvector text, already a JSON array, and is spliced
+# in as is rather than parsed into floats and formatted again.
+def export_line(row, include_embeddings: bool = False):
+    line = json.dumps({
+        "id": row.id,
+        "title": row.title,
+        "author": row.author,
+        "category": row.category,
+        "publish_date": row.publish_date.isoformat() if row.publish_date else None,
+        "content": row.content,
+    }, ensure_ascii=False)
+    if include_embeddings:
+        line = f'{line[:-1]}, "embedding": {row.embedding or "null"}}}'
+    return line + "\n"
+
+# Streams the export as NDJSON, one chunk per cursor batch. It runs while the StreamingResponse is being sent,
+# after the endpoint has returned, so it opens (and always closes) its own read session instead of taking one
+# from the route. An error mid-stream can't change the status any more, it aborts the response and the client
+# resumes with after_id set to the last id it received.
+def export_magazines(filters: SearchFilters = None, after_id: int = None, max_id: int = None,
+                     include_embeddings: bool = False):
+    exported = 0
+    db = open_read_session()
+    try:
+        for rows in export_rows(db, filters, after_id, max_id, include_embeddings):
+            yield "".join(export_line(row, include_embeddings) for row in rows)
+            exported += len(rows)
+        logger.info("Exported %d magazines", exported)
+    except Exception as e:
+        logger.error("Error in export_magazines after %d magazines: %s", exported, str(e))
+        raise Exception(f"Error in export_magazines: {e}")
+    finally:
+        db.close()
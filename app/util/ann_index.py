@@ -0,0 +1,281 @@
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from app.config import EMBEDDING_DIMENSION, LOCAL_INDEX_PATH, LOCAL_INDEX_SYNC_LOOKBACK, LOCAL_INDEX_SYNC_SECONDS
+from app.database import engine
+from app.model.magazine import MagazineContent
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialised within one process
+    fcntl = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_STATE_SQL = text("SELECT active_model, reembed_status FROM embedding_model_state WHERE id = 1")
+
+
+# Flat nearest-neighbour index over magazine_content.content_embedding kept in two append-only files,
+# ids.i64 (magazine ids) and vectors.f32 (L2 normalised rows), next to a model file naming the embedding model
+# the vectors came from. Searches read them through read-only memory maps, so every API worker on a host
+# shares the same page cache pages instead of its own copy. Writers append under an exclusive file lock;
+# vectors are written before their ids, and the row count is taken from ids.i64, so readers never see an id
+# without its vector. After a re-embed cutover the index is rebuilt from the swapped column (see rebuild).
+class LocalVectorIndex:
+    def __init__(self, directory: str, dimension: int = EMBEDDING_DIMENSION, chunk_rows: int = 65536):
+        self.directory = directory
+        self.dimension = dimension
+        self.chunk_rows = chunk_rows
+        self.ids_path = os.path.join(directory, "ids.i64")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.model_path = os.path.join(directory, "model")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.rebuild_lock_path = os.path.join(directory, "rebuild.lock")
+        self._lock = Lock()
+        self._rows = 0
+        self._version = None
+        self._ids = None
+        self._vectors = None
+        self._model = None
+
+    def _row_count(self):
+        return os.path.getsize(self.ids_path) // 8 if os.path.exists(self.ids_path) else 0
+
+    def _read_model(self):
+        try:
+            with open(self.model_path) as model_file:
+                return model_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_model(self, model_name: str):
+        with open(self.model_path + ".tmp", "w") as model_file:
+            model_file.write(model_name)
+        os.replace(self.model_path + ".tmp", self.model_path)
+
+    def _stat_version(self):
+        try:
+            stat = os.stat(self.ids_path)
+            return stat.st_ino, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    # Remaps the files when rows were appended since the last search, or the index was rebuilt. A rebuild
+    # swaps several files, so they are mapped under the shared lock and always come from the same build.
+    def _refresh(self):
+        version = self._stat_version()
+        with self._lock:
+            if version != self._version:
+                with self._file_lock(self.lock_path, shared=True):
+                    version = self._stat_version()
+                    rows = version[1] // 8 if version else 0
+                    self._ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(rows,)) if rows else None
+                    self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                              shape=(rows, self.dimension)) if rows else None
+                    self._model = self._read_model()
+                    self._rows = rows
+                    self._version = version
+            return self._rows, self._ids, self._vectors, self._model
+
+    @contextmanager
+    def _file_lock(self, path: str, shared: bool = False):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock, self._file_lock(self.lock_path):
+            yield
+
+    def __len__(self):
+        return self._row_count()
+
+    # the embedding model the indexed vectors came from
+    def model_name(self):
+        return self._refresh()[3]
+
+    # Returns (ids, cosine similarities) of the k nearest rows, best first. None when the index holds the
+    # vectors of another model than model_name, which the query vector can't be compared with.
+    def search(self, query_vector, k: int, model_name: str = None):
+        rows, ids, vectors, index_model = self._refresh()
+        if model_name is not None and index_model != model_name:
+            return None
+        if not rows or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+
+        best_ids = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        # scanned in chunks so the temporary score array stays small whatever the index size
+        for start in range(0, rows, self.chunk_rows):
+            scores = vectors[start:start + self.chunk_rows] @ query_vector
+            top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            best_scores = np.concatenate([best_scores, scores[top]])
+            best_ids = np.concatenate([best_ids, ids[start:start + self.chunk_rows][top]])
+            if len(best_scores) > k:
+                keep = np.argpartition(-best_scores, k - 1)[:k]
+                best_scores, best_ids = best_scores[keep], best_ids[keep]
+
+        order = np.argsort(-best_scores, kind="stable")
+        return best_ids[order], best_scores[order]
+
+    # Ids of the last rows of the index, back to the first chunk whose ids are all below floor_id. Rows are
+    # appended in about ascending id order, never further out of order than the sync lookback, so an id at or
+    # above floor_id + lookback can't sit in front of such a chunk.
+    def _tail_ids(self, rows: int, floor_id: int, chunk_rows: int = 4096):
+        ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(rows,))
+        start = rows
+        while start > 0 and ids[max(start - chunk_rows, 0):start].max() >= floor_id:
+            start = max(start - chunk_rows, 0)
+        return np.array(ids[start:])
+
+    # Appends rows whose ids are not indexed yet, safe to call from several processes at once. Only the tail
+    # that can hold the ids is checked, so a single-row append doesn't read the whole index. Vectors of
+    # another model than the indexed one are skipped (the rebuild after a cutover picks their rows up), an
+    # empty index takes on the model of its first rows.
+    def append(self, ids, vectors, model_name: str = None, lookback: int = LOCAL_INDEX_SYNC_LOOKBACK):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dimension)
+        if not len(ids):
+            return 0
+
+        with self._exclusive():
+            rows = self._row_count()
+            if model_name is not None and self._read_model() != model_name:
+                if rows:
+                    return 0
+                self._write_model(model_name)
+            if rows:
+                new_rows = ~np.isin(ids, self._tail_ids(rows, int(ids.min()) - lookback))
+                ids, vectors = ids[new_rows], vectors[new_rows]
+            if not len(ids):
+                return 0
+
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.clip(norms, 1e-12, None)
+
+            with open(self.vectors_path, "ab") as vectors_file:
+                # drops vectors of an append that crashed before its ids were written
+                vectors_file.truncate(rows * self.dimension * 4)
+                vectors_file.write(vectors.tobytes())
+            with open(self.ids_path, "ab") as ids_file:
+                ids_file.write(ids.tobytes())
+        return len(ids)
+
+    def max_id(self):
+        rows, ids, _, _ = self._refresh()
+        return int(ids.max()) if rows else 0
+
+    # Pulls rows written by other processes (bulk loads, other workers). Ids are handed out before commit,
+    # so a lookback window re-reads recent ids that may have committed after a larger one was indexed.
+    # Once a re-embed cutover has switched the active model, the index is rebuilt instead, as soon as the
+    # cutover's repair of the rows written with the old model is done.
+    def sync_from_db(self, lookback: int = LOCAL_INDEX_SYNC_LOOKBACK, batch_size: int = 10000):
+        with engine.connect() as connection:
+            state = connection.execute(INDEX_STATE_SQL).first()
+        if self._row_count() and self._read_model() != state.active_model:
+            return 0 if state.reembed_status == "repairing" else self._rebuild_stale(state.active_model)
+
+        appended = 0
+        last_id = max(self.max_id() - lookback, 0)
+        with engine.connect() as connection:
+            while True:
+                rows = connection.execute(
+                    select(MagazineContent.magazine_id, MagazineContent.content_embedding)
+                    .where(MagazineContent.magazine_id > last_id, MagazineContent.content_embedding.isnot(None),
+                           func.coalesce(MagazineContent.embedding_model, state.active_model) == state.active_model)
+                    .order_by(MagazineContent.magazine_id)
+                    .limit(batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                appended += self.append([row.magazine_id for row in rows], [row.content_embedding for row in rows],
+                                        state.active_model)
+                last_id = rows[-1].magazine_id
+
+        if appended:
+            logger.info(f"Local vector index synced, appended {appended} rows ({len(self)} total).")
+        return appended
+
+    # Syncs every interval seconds from a daemon thread, so searches never wait on a sync and concurrent
+    # requests don't each start one when the interval runs out
+    def watch(self, interval: float = LOCAL_INDEX_SYNC_SECONDS):
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync_from_db()
+                except Exception as e:
+                    logger.warning(f"Could not sync the local vector index: {e}")
+
+        Thread(target=watch, name="local-vector-index-sync", daemon=True).start()
+
+    # Builds a fresh index of the active model's vectors in a build directory while searches keep using the
+    # current one, swaps its files in under the exclusive lock, then catches up with the rows committed
+    # during the build. One process per host builds at a time.
+    def rebuild(self):
+        with self._file_lock(self.rebuild_lock_path):
+            return self._rebuild()
+
+    def _rebuild_stale(self, model_name: str):
+        with self._file_lock(self.rebuild_lock_path):
+            # another worker on the host may have rebuilt it while this one waited
+            if self._read_model() == model_name:
+                return 0
+            logger.info(f"Rebuilding the local vector index for {model_name}, it holds {self._read_model()} "
+                        f"vectors.")
+            return self._rebuild()
+
+    def _rebuild(self):
+        build = LocalVectorIndex(os.path.join(self.directory, "build"), self.dimension, self.chunk_rows)
+        for path in (build.ids_path, build.vectors_path, build.model_path):
+            if os.path.exists(path):
+                os.remove(path)
+        appended = build.sync_from_db(lookback=0)
+
+        with self._exclusive():
+            # the ids go last, readers remap on their change
+            for source, target in ((build.vectors_path, self.vectors_path), (build.model_path, self.model_path),
+                                   (build.ids_path, self.ids_path)):
+                if os.path.exists(source):
+                    os.replace(source, target)
+                elif os.path.exists(target):
+                    os.remove(target)
+        return appended + self.sync_from_db()
+
+
+local_vector_index = LocalVectorIndex(LOCAL_INDEX_PATH)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Build or update the local memory-mapped vector index.")
+    parser.add_argument("command", choices=["build", "sync"])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        local_vector_index.rebuild()
+    else:
+        local_vector_index.sync_from_db()
+    logger.info(f"Local vector index at {LOCAL_INDEX_PATH} holds {len(local_vector_index)} rows.")
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from app.config import (
+    EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_PATH,
+    EMBEDDING_ONNX_QUANTIZED, EMBEDDING_ONNX_THREADS,
+)
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Embedding backends share one small interface: encode(texts, batch_size) takes a string or a list of
+# strings and returns a float32 vector or a (n, dimension) matrix, like SentenceTransformer.encode.
+
+
+# The original float32 PyTorch model
+class SentenceTransformerBackend:
+    name = "sentence-transformers"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, threads: int = 0):
+        from sentence_transformers import SentenceTransformer
+
+        self.set_threads(threads)
+        self.model = SentenceTransformer(model_name)
+
+    # torch's intra-op thread count is process wide and can be changed after loading, e.g. after a fork
+    def set_threads(self, threads: int):
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+
+    def encode(self, texts, batch_size: int = 32):
+        return self.model.encode(texts, batch_size=batch_size)
+
+
+# ONNX Runtime inference from a local model directory (see `python -m app.embedding_tools export`),
+# by default using the int8 dynamically quantized graph, which is 2-4x faster on CPU-only nodes.
+# Mirrors the sentence transformer pipeline: mean pooling over the attention mask, then L2 normalisation.
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_path: str = EMBEDDING_MODEL_PATH, quantized: bool = EMBEDDING_ONNX_QUANTIZED,
+                 threads: int = EMBEDDING_ONNX_THREADS):
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The onnx embedding backend needs the onnxruntime and transformers packages.") from e
+
+        if not model_path:
+            raise ValueError("EMBEDDING_MODEL_PATH must point to an exported model directory for the onnx backend.")
+
+        model_file = os.path.join(model_path, "model_quantized.onnx" if quantized else "model.onnx")
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"ONNX model not found: {model_file}")
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        logger.info(f"Loaded ONNX embedding model from {model_file}.")
+
+    def _encode_batch(self, texts):
+        tokens = self.tokenizer(texts, padding=True, truncation=True, max_length=512, return_tensors="np")
+        inputs = {name: value.astype(np.int64) for name, value in tokens.items() if name in self.input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def encode(self, texts, batch_size: int = 32):
+        if isinstance(texts, str):
+            return self._encode_batch([texts])[0]
+
+        batches = [self._encode_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        return np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+
+
+BACKENDS = {
+    SentenceTransformerBackend.name: SentenceTransformerBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+# model_name picks a model other than the configured one: a model name for sentence-transformers, an exported
+# model directory for onnx
+def create_backend(name: str = EMBEDDING_BACKEND, threads: int = 0, model_name: str = None):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}', expected one of: {', '.join(BACKENDS)}")
+    kwargs = {"threads": threads} if threads else {}
+    if model_name and model_name != EMBEDDING_MODEL_NAME:
+        kwargs["model_path" if name == OnnxBackend.name else "model_name"] = model_name
+    return BACKENDS[name](**kwargs)
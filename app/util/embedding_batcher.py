@@ -0,0 +1,67 @@
+from concurrent.futures import Future
+from threading import Lock, Thread
+import queue
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Collects query encodings from concurrent request threads over a short window and runs them
+# through the model as one batch, so N concurrent searches cost one forward pass instead of N
+class EmbeddingBatcher:
+    def __init__(self, encode_batch, max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = queue.Queue()
+        self._worker = None
+        self._lock = Lock()
+
+    def encode(self, text: str):
+        return self.submit(text).result()
+
+    # non-blocking variant, async callers await the future instead of parking a thread on it
+    def submit(self, text: str):
+        self._ensure_worker()
+        future = Future()
+        self._pending.put((text, future))
+        return future
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self):
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # drain whatever is already queued, then wait out the rest of the window
+                batch.append(self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            # identical concurrent queries are encoded once and fanned out to every waiter
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                embeddings = self.encode_batch(texts)
+                by_text = dict(zip(texts, embeddings))
+                for text, future in batch:
+                    future.set_result(by_text[text])
+                logger.debug("Encoded %d queries for %d waiters in one batch", len(texts), len(batch))
+            except Exception as e:
+                logger.error(f"Batched query encoding failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
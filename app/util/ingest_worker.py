@@ -0,0 +1,71 @@
+import argparse
+from threading import Event, Thread
+
+from app.config import INGEST_JOB_BATCH_SIZE, INGEST_POLL_SECONDS, INGEST_WORKERS
+from app.services.magazine_service import drain_ingest_batch
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Background ingest workers: threads that drain ingest_staging one batch (one encode, one transaction) at a
+# time. Any number of them can run across API processes and hosts, claiming with FOR UPDATE SKIP LOCKED keeps
+# them off each other's records. Each API process starts INGEST_WORKERS of them; dedicated ingest hosts run
+#
+#   python -m app.util.ingest_worker --workers 4
+
+_wakeup = Event()
+_stop = Event()
+
+
+# wakes this process's idle workers right away instead of at their next poll
+def notify_ingest_workers():
+    _wakeup.set()
+
+def run_ingest_worker(batch_size: int = INGEST_JOB_BATCH_SIZE, poll_seconds: float = INGEST_POLL_SECONDS):
+    while not _stop.is_set():
+        try:
+            claimed = drain_ingest_batch(batch_size)
+        except Exception as e:
+            # the batch rolled back and its records are pending again, retried after the poll interval
+            logger.error(f"Ingest batch failed: {e}", exc_info=True)
+            claimed = 0
+
+        if not claimed:
+            _wakeup.wait(poll_seconds)
+            _wakeup.clear()
+
+def start_ingest_workers(workers: int = INGEST_WORKERS, batch_size: int = INGEST_JOB_BATCH_SIZE, daemon: bool = True):
+    _stop.clear()
+    threads = [
+        Thread(target=run_ingest_worker, args=(batch_size,), name=f"ingest-worker-{index}", daemon=daemon)
+        for index in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    if threads:
+        logger.info(f"Started {workers} ingest workers.")
+    return threads
+
+def stop_ingest_workers():
+    _stop.set()
+    _wakeup.set()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Embed and insert the records staged by ingest jobs.")
+    parser.add_argument("--workers", type=int, default=max(INGEST_WORKERS, 1))
+    parser.add_argument("--batch-size", type=int, default=INGEST_JOB_BATCH_SIZE, help="Records claimed per transaction")
+    args = parser.parse_args()
+
+    worker_threads = start_ingest_workers(args.workers, args.batch_size, daemon=False)
+    try:
+        for worker_thread in worker_threads:
+            worker_thread.join()
+    except KeyboardInterrupt:
+        logger.info("Stopping the ingest workers after their current batch.")
+        stop_ingest_workers()
@@ -0,0 +1,222 @@
+import glob
+import json
+import os
+import time
+from threading import Lock, Thread
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Minimal Prometheus metrics, rendered in the text exposition format at /metrics. Values are kept per process.
+# Behind the multi-worker server a scrape lands on one worker, so there every process also writes its values
+# to a file in a shared directory (multiprocess mode, see enable_multiprocess) and /metrics renders all of
+# them: histograms summed over every worker, exited ones included so the counts never go back, and gauges
+# of the live workers with a pid label.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+# directory of the per-process files in multiprocess mode, None when values only cover this process
+_multiprocess_dir = None
+_flusher_pid = None
+_flusher_lock = Lock()
+
+
+def _format_labels(labels: dict):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+# cumulative histogram with one series per label combination
+class Histogram:
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        _start_flusher()
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                    for key, value in self._series.items()}
+
+    # series defaults to this process's, multiprocess mode passes the sum over every worker
+    def render(self, series: dict = None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        series = self.snapshot() if series is None else series
+        for key, value in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, value["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': repr(float(bound))})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {value['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {value['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {value['count']}")
+        return lines
+
+
+# gauge read from a callback at scrape time, e.g. the current pool usage
+class Gauge:
+    def __init__(self, name: str, description: str, callback):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        _registry.append(self)
+
+    def value(self):
+        try:
+            return float(self.callback())
+        except Exception as e:
+            logger.warning(f"Could not read gauge {self.name}: {e}")
+            return None
+
+    # values defaults to this process's, multiprocess mode passes {pid: value} of the live workers
+    def render(self, values: dict = None):
+        if values is None:
+            value = self.value()
+            lines = [] if value is None else [f"{self.name} {value}"]
+        else:
+            lines = [f"{self.name}{_format_labels({'pid': pid})} {value}" for pid, value in sorted(values.items())]
+        if not lines:
+            return []
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", *lines]
+
+
+def _write_json(path: str, payload):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as payload_file:
+        json.dump(payload, payload_file)
+    os.replace(temp_path, path)
+
+def _read_json(path: str):
+    try:
+        with open(path) as payload_file:
+            return json.load(payload_file)
+    except (OSError, ValueError):
+        return None
+
+# writes this process's histograms and gauge values to its files in the multiprocess directory
+def flush_metrics():
+    if _multiprocess_dir is None:
+        return
+    pid = os.getpid()
+    _write_json(os.path.join(_multiprocess_dir, f"histograms_{pid}.json"), {
+        metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+        for metric in _registry if isinstance(metric, Histogram)
+    })
+    _write_json(os.path.join(_multiprocess_dir, f"gauges_{pid}.json"), {
+        metric.name: metric.value() for metric in _registry if isinstance(metric, Gauge)
+    })
+
+# one flush thread per process, started by the first observation after a fork
+def _start_flusher(interval: float = 1.0):
+    global _flusher_pid
+    if _multiprocess_dir is None or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def flush():
+        while True:
+            time.sleep(interval)
+            try:
+                flush_metrics()
+            except Exception as e:
+                logger.warning(f"Could not write the metrics of process {os.getpid()}: {e}")
+
+    Thread(target=flush, name="metrics-flush", daemon=True).start()
+
+# Turns on multiprocess mode for the workers forked from this process. Files left by an earlier run are
+# removed, their counts belong to processes of another server. The calling process (the gunicorn master)
+# never starts a flush thread: a thread holding a metric's lock while the master forks would leave that
+# lock held in the worker.
+def enable_multiprocess(directory: str):
+    global _multiprocess_dir, _flusher_pid
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)
+    _multiprocess_dir = directory
+    _flusher_pid = os.getpid()
+    logger.info(f"Metrics of every worker are collected in {directory}.")
+
+# drops the gauges of an exited worker, its histograms keep counting towards the totals
+def mark_process_dead(pid: int):
+    if _multiprocess_dir is not None:
+        try:
+            os.remove(os.path.join(_multiprocess_dir, f"gauges_{pid}.json"))
+        except FileNotFoundError:
+            pass
+
+def _render_multiprocess():
+    flush_metrics()
+    histograms, gauges = {}, {}
+    for path in glob.glob(os.path.join(_multiprocess_dir, "histograms_*.json")):
+        for name, series in (_read_json(path) or {}).items():
+            merged = histograms.setdefault(name, {})
+            for key, value in series:
+                total = merged.setdefault(tuple(key), {"buckets": [0] * len(value["buckets"]), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], value["buckets"])]
+                total["sum"] += value["sum"]
+                total["count"] += value["count"]
+    for path in glob.glob(os.path.join(_multiprocess_dir, "gauges_*.json")):
+        pid = os.path.basename(path)[len("gauges_"):-len(".json")]
+        for name, value in (_read_json(path) or {}).items():
+            if value is not None:
+                gauges.setdefault(name, {})[pid] = value
+
+    lines = []
+    for metric in _registry:
+        if isinstance(metric, Histogram):
+            lines.extend(metric.render(histograms.get(metric.name, {})))
+        else:
+            lines.extend(metric.render(gauges.get(metric.name, {})))
+    return lines
+
+def render_metrics():
+    if _multiprocess_dir is not None:
+        return "\n".join(_render_multiprocess()) + "\n"
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+stage_duration = Histogram(
+    "magazine_stage_duration_seconds", "Time spent in each request stage (embedding, SQL, serialization).",
+    ("stage",),
+)
+request_duration = Histogram(
+    "magazine_http_request_duration_seconds", "End to end request latency by route.",
+    ("method", "route", "status"),
+)
+pool_checkout_wait = Histogram(
+    "magazine_db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool.",
+    ("pool",), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0),
+)
+
+# pool size, checked out connections, overflow in use and saturation (checked out / maximum) of an engine.
+# The pool is looked up at scrape time, dispose() swaps in a new one.
+def register_pool_metrics(engine, max_connections: int, prefix: str = "magazine_db_pool"):
+    Gauge(f"{prefix}_size", "Configured number of persistent connections.", lambda: engine.pool.size())
+    Gauge(f"{prefix}_checked_out", "Connections currently checked out.", lambda: engine.pool.checkedout())
+    Gauge(f"{prefix}_overflow", "Overflow connections currently open.", lambda: max(engine.pool.overflow(), 0))
+    Gauge(f"{prefix}_saturation", "Checked out connections as a fraction of pool_size + max_overflow.",
+          lambda: engine.pool.checkedout() / max_connections)
@@ -0,0 +1,385 @@
+import argparse
+import time
+
+from sqlalchemy import text
+
+from app.config import EMBEDDING_MODEL_NAME
+from app.database import engine
+from app.util.vector_storage import compact_index_definition, compact_storage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations that can't be expressed through Base.metadata.create_all on an existing database.
+#
+#   python -m app.util.migrations compact-vectors --mode halfvec
+#   python -m app.util.migrations search-document --drop-legacy
+#   python -m app.util.migrations facet-counts
+#   python -m app.util.migrations content-hash
+
+
+# Adds the compact vector column, keeps it in sync through a trigger (so every writer - API, bulk ingest,
+# COPY loads - fills it without code changes), backfills existing rows in id-ordered batches with a
+# commit per batch, and finally builds its HNSW index concurrently.
+def migrate_compact_vectors(mode: str, batch_size: int = 10000):
+    storage = compact_storage(mode)
+    column = storage["column"]
+    function_name = f"magazine_content_sync_{column}"
+
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE magazine_content ADD COLUMN IF NOT EXISTS {column} {storage['type']};"))
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger AS $$
+            BEGIN
+                NEW.{column} := {storage['expression'].format(source='NEW.content_embedding')};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+        """))
+        connection.execute(text(f"DROP TRIGGER IF EXISTS trg_{function_name} ON magazine_content;"))
+        connection.execute(text(f"""
+            CREATE TRIGGER trg_{function_name}
+            BEFORE INSERT OR UPDATE OF content_embedding ON magazine_content
+            FOR EACH ROW EXECUTE FUNCTION {function_name}();
+        """))
+        max_id = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM magazine_content")).scalar()
+    logger.info(f"Added {column} with its sync trigger, backfilling ids up to {max_id}.")
+
+    started = time.perf_counter()
+    for start_id in range(0, max_id, batch_size):
+        with engine.begin() as connection:
+            updated = connection.execute(text(f"""
+                UPDATE magazine_content
+                SET {column} = {storage['expression'].format(source='content_embedding')}
+                WHERE id > :start_id AND id <= :end_id
+                AND {column} IS NULL AND content_embedding IS NOT NULL
+            """), {"start_id": start_id, "end_id": start_id + batch_size}).rowcount
+        logger.info(f"Backfilled {column} for ids {start_id + 1}-{start_id + batch_size} ({updated} rows, "
+                    f"{(start_id + batch_size) / (time.perf_counter() - started):.0f} ids/sec).")
+
+    name, definition, description = compact_index_definition(mode)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};"))
+    logger.info(f"{description} created successfully.")
+
+
+# The weighted full-text document searched by the keyword legs: title (A), author (B) and content (C).
+# A generated column can't read magazine_information, so it is kept up to date by triggers on both tables:
+#  - magazine_content rows compute it on insert and whenever content or magazine_id change. The
+#    information row is always written first (API, bulk ingest and COPY loads alike), so the trigger
+#    finds the title and author.
+#  - a title or author change touches content of the matching rows, which re-runs the content trigger
+# Idempotent and cheap, the start-up runs it on every boot so fresh and existing databases get the column
+# and triggers; filling rows written before the triggers existed is left to migrate_search_document.
+SEARCH_DOCUMENT_SQL = [
+    "ALTER TABLE magazine_content ADD COLUMN IF NOT EXISTS search_document tsvector;",
+    """
+    CREATE OR REPLACE FUNCTION magazine_content_search_document() RETURNS trigger AS $$
+    BEGIN
+        -- ingest passes the document of a stored magazine with the same title, author and content
+        IF TG_OP = 'INSERT' AND NEW.search_document IS NOT NULL THEN
+            RETURN NEW;
+        END IF;
+        SELECT setweight(to_tsvector('english', coalesce(mi.title, '')), 'A') ||
+               setweight(to_tsvector('english', coalesce(mi.author, '')), 'B')
+        INTO NEW.search_document
+        FROM magazine_information mi WHERE mi.id = NEW.magazine_id;
+        NEW.search_document := coalesce(NEW.search_document, ''::tsvector) ||
+                               setweight(to_tsvector('english', coalesce(NEW.content, '')), 'C');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_magazine_content_search_document
+    BEFORE INSERT OR UPDATE OF content, magazine_id ON magazine_content
+    FOR EACH ROW EXECUTE FUNCTION magazine_content_search_document();
+    """,
+    """
+    CREATE OR REPLACE FUNCTION magazine_information_search_document() RETURNS trigger AS $$
+    BEGIN
+        UPDATE magazine_content SET content = content WHERE magazine_id = NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_magazine_information_search_document
+    AFTER UPDATE OF title, author ON magazine_information
+    FOR EACH ROW WHEN (OLD.title IS DISTINCT FROM NEW.title OR OLD.author IS DISTINCT FROM NEW.author)
+    EXECUTE FUNCTION magazine_information_search_document();
+    """,
+]
+
+# indexes and column the search document replaces, only dropped on request
+LEGACY_KEYWORD_SQL = [
+    "DROP INDEX CONCURRENTLY IF EXISTS content_tsvector_idx;",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_magazine_title_trgm;",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_magazine_author_trgm;",
+    "ALTER TABLE magazine_content DROP COLUMN IF EXISTS content_tsvector;",
+]
+
+
+def install_search_document(connection):
+    for statement in SEARCH_DOCUMENT_SQL:
+        connection.execute(text(statement))
+
+# Backfills search_document for rows written before the triggers existed, in id-ordered batches with a
+# commit per batch. The no-op content update fires the content trigger, so the document is built by the one
+# definition above. Then builds its GIN index and optionally drops what it replaces.
+def migrate_search_document(batch_size: int = 10000, drop_legacy: bool = False):
+    from app.util.utils import INDEX_DEFINITIONS
+
+    with engine.begin() as connection:
+        install_search_document(connection)
+        max_id = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM magazine_content")).scalar()
+    logger.info(f"Installed the search_document triggers, backfilling ids up to {max_id}.")
+
+    started = time.perf_counter()
+    for start_id in range(0, max_id, batch_size):
+        with engine.begin() as connection:
+            updated = connection.execute(text("""
+                UPDATE magazine_content SET content = content
+                WHERE id > :start_id AND id <= :end_id AND search_document IS NULL
+            """), {"start_id": start_id, "end_id": start_id + batch_size}).rowcount
+        logger.info(f"Backfilled search_document for ids {start_id + 1}-{start_id + batch_size} ({updated} rows, "
+                    f"{(start_id + batch_size) / (time.perf_counter() - started):.0f} ids/sec).")
+
+    name, definition, description = next(index for index in INDEX_DEFINITIONS if index[0] == "idx_search_document")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};"))
+        logger.info(f"{description} created successfully.")
+
+        if drop_legacy:
+            for statement in LEGACY_KEYWORD_SQL:
+                connection.execute(text(statement))
+            logger.info("Dropped content_tsvector and the title/author trigram indexes.")
+
+
+# Magazines per (category, publication year) for the facets endpoint. Statement level triggers with transition
+# tables apply one grouped delta per statement, so a bulk insert of 500 rows upserts a handful of counter rows
+# rather than 500, and the rows are upserted in key order so concurrent writers can't deadlock on them.
+FACET_DELTA_UPSERT = """
+            INSERT INTO magazine_facet_counts AS counts (category, year, magazines)
+            SELECT category, extract(year FROM publish_date)::integer, sum(delta)
+            FROM ({changes}) changes
+            WHERE category IS NOT NULL AND publish_date IS NOT NULL
+            GROUP BY 1, 2
+            HAVING sum(delta) <> 0
+            ORDER BY 1, 2
+            ON CONFLICT (category, year) DO UPDATE SET magazines = counts.magazines + EXCLUDED.magazines;"""
+
+FACET_COUNTS_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS magazine_facet_counts (
+        category VARCHAR NOT NULL,
+        year INTEGER NOT NULL,
+        magazines BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, year)
+    );
+    """,
+    """
+    CREATE OR REPLACE FUNCTION magazine_facet_counts_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM magazine_facet_counts;
+        ELSIF TG_OP = 'INSERT' THEN
+            {insert}
+        ELSIF TG_OP = 'DELETE' THEN
+            {delete}
+        ELSE
+            {update}
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """.format(
+        # a transition table can only be referenced by the events that have it, hence one upsert per event
+        insert=FACET_DELTA_UPSERT.format(changes="SELECT category, publish_date, 1 AS delta FROM new_rows"),
+        delete=FACET_DELTA_UPSERT.format(changes="SELECT category, publish_date, -1 AS delta FROM old_rows"),
+        update=FACET_DELTA_UPSERT.format(changes="""
+            SELECT category, publish_date, 1 AS delta FROM new_rows
+            UNION ALL
+            SELECT category, publish_date, -1 AS delta FROM old_rows"""),
+    ),
+]
+
+# transition tables allow a single event per trigger
+FACET_COUNTS_TRIGGERS = {
+    "insert": "AFTER INSERT ON magazine_information REFERENCING NEW TABLE AS new_rows",
+    "update": "AFTER UPDATE ON magazine_information REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "delete": "AFTER DELETE ON magazine_information REFERENCING OLD TABLE AS old_rows",
+    "truncate": "AFTER TRUNCATE ON magazine_information",
+}
+
+# Idempotent, run by the start-up like install_search_document. The first install (or rebuild=True) also
+# recounts the existing rows, with writes to magazine_information blocked until the triggers are in place so
+# no row is counted twice or missed.
+def install_facet_counts(connection, rebuild: bool = False):
+    installed = connection.execute(text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = 'trg_magazine_facet_counts_insert'"
+    )).first()
+    if rebuild or not installed:
+        connection.execute(text("LOCK TABLE magazine_information IN SHARE ROW EXCLUSIVE MODE;"))
+
+    for statement in FACET_COUNTS_SQL:
+        connection.execute(text(statement))
+    for event, definition in FACET_COUNTS_TRIGGERS.items():
+        connection.execute(text(f"""
+            CREATE OR REPLACE TRIGGER trg_magazine_facet_counts_{event}
+            {definition}
+            FOR EACH STATEMENT EXECUTE FUNCTION magazine_facet_counts_apply();
+        """))
+
+    if rebuild or not installed:
+        connection.execute(text("DELETE FROM magazine_facet_counts;"))
+        recounted = connection.execute(text("""
+            INSERT INTO magazine_facet_counts (category, year, magazines)
+            SELECT category, extract(year FROM publish_date)::integer, count(*)
+            FROM magazine_information
+            WHERE category IS NOT NULL AND publish_date IS NOT NULL
+            GROUP BY 1, 2
+        """)).rowcount
+        logger.info(f"Recounted {recounted} facet rows.")
+
+
+# Records the embedding model per content row and seeds embedding_model_state with EMBEDDING_MODEL_NAME on a
+# fresh database. Idempotent, run by the start-up like install_search_document; once the state row exists the
+# model it names wins over the configuration.
+def install_embedding_model_state(connection):
+    connection.execute(text("ALTER TABLE magazine_content ADD COLUMN IF NOT EXISTS embedding_model varchar;"))
+    connection.execute(text("""
+        INSERT INTO embedding_model_state (id, active_model, reembed_status, reembed_last_id)
+        VALUES (1, :model, 'idle', 0)
+        ON CONFLICT (id) DO NOTHING
+    """), {"model": EMBEDDING_MODEL_NAME})
+    active_model = connection.execute(text("SELECT active_model FROM embedding_model_state WHERE id = 1")).scalar()
+    if active_model != EMBEDDING_MODEL_NAME:
+        logger.warning(f"The database holds {active_model} embeddings, EMBEDDING_MODEL_NAME={EMBEDDING_MODEL_NAME} "
+                       f"is ignored.")
+
+
+# sha256 of the content, in the hex form app.repositories.magazine_repository.content_hash computes. A trigger
+# like search_document's, so COPY loads get it too. Also adds the ingest job columns reporting its use.
+CONTENT_HASH_SQL = [
+    "ALTER TABLE magazine_content ADD COLUMN IF NOT EXISTS content_hash varchar(64);",
+    """
+    CREATE OR REPLACE FUNCTION magazine_content_hash() RETURNS trigger AS $$
+    BEGIN
+        NEW.content_hash := encode(sha256(convert_to(NEW.content, 'UTF8')), 'hex');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_magazine_content_hash
+    BEFORE INSERT OR UPDATE OF content ON magazine_content
+    FOR EACH ROW EXECUTE FUNCTION magazine_content_hash();
+    """,
+    "ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS on_duplicate varchar NOT NULL DEFAULT 'insert';",
+    "ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS encodes_avoided integer NOT NULL DEFAULT 0;",
+]
+
+# Idempotent, run by the start-up. Rows written before the trigger existed are hashed by migrate_content_hash.
+def install_content_hash(connection):
+    for statement in CONTENT_HASH_SQL:
+        connection.execute(text(statement))
+
+# Announces committed changes to the searchable data on SEARCH_CHANGED_CHANNEL. A NOTIFY is only delivered once
+# its transaction commits, so every API process drops its cached search responses after a write by any process:
+# other workers, the ingest workers, precompute loads and re-embed jobs alike. Statement level triggers send one
+# notification per statement, and Postgres folds identical ones within a transaction.
+SEARCH_CHANGED_CHANNEL = "magazine_search_changed"
+
+SEARCH_CHANGED_SQL = [
+    f"""
+    CREATE OR REPLACE FUNCTION magazine_search_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{SEARCH_CHANGED_CHANNEL}', '');
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_magazine_information_search_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON magazine_information
+    FOR EACH STATEMENT EXECUTE FUNCTION magazine_search_changed();
+    """,
+    # the column list keeps re-embed backfills of content_embedding_next from notifying on every batch
+    """
+    CREATE OR REPLACE TRIGGER trg_magazine_content_search_changed
+    AFTER INSERT OR UPDATE OF content, search_document, content_embedding, magazine_id OR DELETE OR TRUNCATE
+    ON magazine_content
+    FOR EACH STATEMENT EXECUTE FUNCTION magazine_search_changed();
+    """,
+]
+
+# Idempotent, run by the start-up. Trigger column lists follow renamed columns, so the re-embed cutover runs it
+# again after swapping content_embedding.
+def install_search_changed(connection):
+    for statement in SEARCH_CHANGED_SQL:
+        connection.execute(text(statement))
+
+# For changes the triggers don't see, delivered when the caller's transaction commits
+def notify_search_changed(connection):
+    connection.execute(text("SELECT pg_notify(:channel, '')"), {"channel": SEARCH_CHANGED_CHANNEL})
+
+# Hashes the rows written before the trigger existed in id-ordered batches with a commit per batch, then builds
+# the lookup index. The hash is set directly, a no-op content update would rebuild the search documents too.
+def migrate_content_hash(batch_size: int = 10000):
+    from app.util.utils import INDEX_DEFINITIONS
+
+    with engine.begin() as connection:
+        install_content_hash(connection)
+        max_id = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM magazine_content")).scalar()
+    logger.info(f"Installed the content_hash trigger, backfilling ids up to {max_id}.")
+
+    started = time.perf_counter()
+    for start_id in range(0, max_id, batch_size):
+        with engine.begin() as connection:
+            updated = connection.execute(text("""
+                UPDATE magazine_content SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')
+                WHERE id > :start_id AND id <= :end_id AND content_hash IS NULL AND content IS NOT NULL
+            """), {"start_id": start_id, "end_id": start_id + batch_size}).rowcount
+        logger.info(f"Backfilled content_hash for ids {start_id + 1}-{start_id + batch_size} ({updated} rows, "
+                    f"{(start_id + batch_size) / (time.perf_counter() - started):.0f} ids/sec).")
+
+    name, definition, description = next(index for index in INDEX_DEFINITIONS if index[0] == "idx_content_hash")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};"))
+    logger.info(f"{description} created successfully.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Run schema migrations.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = commands.add_parser("compact-vectors", help="Add and backfill a compact embedding column")
+    compact_parser.add_argument("--mode", choices=["halfvec", "binary"], required=True)
+    compact_parser.add_argument("--batch-size", type=int, default=10000)
+
+    document_parser = commands.add_parser("search-document", help="Backfill and index the weighted search document")
+    document_parser.add_argument("--batch-size", type=int, default=10000)
+    document_parser.add_argument("--drop-legacy", action="store_true",
+                                 help="Drop content_tsvector and the trigram indexes it replaces")
+
+    commands.add_parser("facet-counts", help="Recount the category/year facet counts")
+
+    hash_parser = commands.add_parser("content-hash", help="Backfill and index the content hash used by ingest")
+    hash_parser.add_argument("--batch-size", type=int, default=10000)
+
+    args = parser.parse_args()
+    if args.command == "compact-vectors":
+        migrate_compact_vectors(args.mode, args.batch_size)
+    elif args.command == "search-document":
+        migrate_search_document(args.batch_size, args.drop_legacy)
+    elif args.command == "facet-counts":
+        with engine.begin() as connection:
+            install_facet_counts(connection, rebuild=True)
+    elif args.command == "content-hash":
+        migrate_content_hash(args.batch_size)
@@ -0,0 +1,16 @@
+import base64
+import json
+
+
+# Opaque keyset cursor for hybrid search: the (score, id) of the last row on the previous page
+def encode_cursor(score: float, magazine_id: int):
+    payload = json.dumps({"s": score, "i": magazine_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(payload["s"]), int(payload["i"])
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
@@ -0,0 +1,347 @@
+import argparse
+import re
+import time
+
+from sqlalchemy import text
+
+from app.config import (
+    EMBEDDING_DIMENSION, EMBEDDING_MODEL_CHECK_SECONDS, REEMBED_BATCH_SIZE, REEMBED_MAX_ROWS_PER_SECOND,
+    REEMBED_THREADS,
+)
+from app.database import engine
+from app.util.migrations import install_search_changed, notify_search_changed
+from app.util.utils import INDEX_DEFINITIONS, advisory_lock, create_indexes, get_embeddings_batch, set_model_threads
+from app.util.vector_storage import COMPACT_VECTOR_STORAGE
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Switches the stored embeddings to another model while the API keeps serving:
+#
+#   python -m app.util.reembed start --model all-MiniLM-L12-v2
+#   python -m app.util.reembed status
+#   python -m app.util.reembed drop-previous
+#
+# 1. content_embedding_next and embedding_model_next are added next to the live columns.
+# 2. Every row is encoded with the new model in id-ordered batches, each written in one transaction together
+#    with its last id in embedding_model_state, so a stopped job resumes after the last committed batch. The
+#    job is held to --max-rows-per-second and its model to --threads threads, live traffic keeps its CPU.
+# 3. The indexes of content_embedding are built on the new column concurrently and the state becomes ready,
+#    which makes the API processes preload the new model.
+# 4. The cutover transaction encodes the rows written in the meantime, then swaps the columns and their
+#    indexes by renaming (content_embedding -> content_embedding_previous, content_embedding_next ->
+#    content_embedding) and flips active_model. Searches read the old vectors up to its commit and the new
+#    ones after it.
+# While a re-embed is under way searches read the active model inside their own transaction (see
+# app.util.utils.search_model), so a query is always encoded with the model of the vectors it is compared to.
+# Ingest switches its model within EMBEDDING_MODEL_CHECK_SECONDS of the cutover; rows a process still wrote
+# with the old model in that window are re-encoded by the job afterwards, in the repairing state. Local vector
+# indexes (VECTOR_SEARCH_ENGINE=local) are rebuilt from the swapped column once the repair is done, searches
+# use pgvector until then. The old column is kept, for going back by hand, until drop-previous.
+
+# key of the advisory lock keeping two re-embed jobs apart
+REEMBED_LOCK_KEY = 7262052
+# ids below the last re-embedded one the cutover re-checks, for rows whose insert committed after a larger id's
+CUTOVER_LOOKBACK_IDS = 10000
+
+STATE_SQL = """
+    SELECT active_model, next_model, reembed_status, reembed_last_id, previous_model
+    FROM embedding_model_state WHERE id = 1
+"""
+
+NEXT_BATCH_SQL = text("""
+    SELECT id, content FROM magazine_content
+    WHERE id > :after_id
+    ORDER BY id
+    LIMIT :limit
+""")
+
+# one statement per batch, the vectors travel as their text form and are cast by the database
+WRITE_BATCH_SQL = """
+    UPDATE magazine_content mc
+    SET {embedding_column} = batch.embedding::vector, {model_column} = :model
+    FROM unnest(CAST(:ids AS integer[]), CAST(:embeddings AS text[])) AS batch(id, embedding)
+    WHERE mc.id = batch.id
+"""
+
+EMBEDDING_COLUMN = re.compile(r"\bcontent_embedding\b")
+
+
+def read_state(connection, for_update: bool = False):
+    return connection.execute(text(STATE_SQL + (" FOR UPDATE" if for_update else ""))).first()
+
+def update_state(connection, **values):
+    assignments = ", ".join(f"{column} = :{column}" for column in values)
+    connection.execute(text(f"UPDATE embedding_model_state SET {assignments}, updated_at = now() WHERE id = 1"),
+                        values)
+
+def column_exists(connection, column: str):
+    return connection.execute(text("""
+        SELECT 1 FROM information_schema.columns WHERE table_name = 'magazine_content' AND column_name = :column
+    """), {"column": column}).first() is not None
+
+# the indexes of content_embedding in INDEX_DEFINITIONS, defined on the column with the given suffix
+def embedding_index_definitions(suffix: str = ""):
+    return [
+        (f"{name}{suffix}", EMBEDDING_COLUMN.sub(f"content_embedding{suffix}", definition), description)
+        for name, definition, description in INDEX_DEFINITIONS if EMBEDDING_COLUMN.search(definition)
+    ]
+
+def format_vector(vector):
+    return "[" + ",".join(map(str, vector.tolist())) + "]"
+
+def encode_rows(connection, rows, model_name: str, embedding_column: str, model_column: str):
+    embeddings = get_embeddings_batch([row.content or "" for row in rows], model_name=model_name)
+    connection.execute(text(WRITE_BATCH_SQL.format(embedding_column=embedding_column, model_column=model_column)), {
+        "ids": [row.id for row in rows],
+        "embeddings": [format_vector(embedding) for embedding in embeddings],
+        "model": model_name,
+    })
+
+# Checks the target model and adds the next columns. Returns the id to continue after: the recorded progress
+# when the interrupted job was re-embedding to the same model, else 0.
+def prepare_reembed(model_name: str):
+    dimension = len(get_embeddings_batch(["dimension check"], model_name=model_name)[0])
+    if dimension != EMBEDDING_DIMENSION:
+        raise ValueError(f"{model_name} produces {dimension} dimensional embeddings, the schema stores "
+                         f"{EMBEDDING_DIMENSION}.")
+
+    with engine.begin() as connection:
+        state = read_state(connection, for_update=True)
+        if state.reembed_status == "repairing":
+            raise ValueError(f"The cutover to {state.active_model} isn't repaired yet, run cutover to finish it.")
+        if model_name == state.active_model:
+            raise ValueError(f"content_embedding already holds {model_name} embeddings.")
+        if state.next_model and state.next_model != model_name:
+            raise ValueError(f"A re-embed to {state.next_model} is in progress, resume or abort it first.")
+        if column_exists(connection, "content_embedding_previous"):
+            raise ValueError(f"content_embedding_previous still holds the {state.previous_model} embeddings, "
+                             f"run drop-previous first.")
+        # the compact columns are derived by a trigger that would keep following the old column
+        for storage in COMPACT_VECTOR_STORAGE.values():
+            if column_exists(connection, storage["column"]):
+                raise ValueError(f"Drop {storage['column']} before re-embedding and run migrations compact-vectors "
+                                 f"again after the cutover.")
+
+        connection.execute(text("SET LOCAL lock_timeout = '10s';"))
+        connection.execute(text(f"""
+            ALTER TABLE magazine_content
+            ADD COLUMN IF NOT EXISTS content_embedding_next vector({EMBEDDING_DIMENSION}),
+            ADD COLUMN IF NOT EXISTS embedding_model_next varchar;
+        """))
+        if state.next_model == model_name:
+            logger.info(f"Resuming the re-embed to {model_name} after id {state.reembed_last_id}.")
+            return state.reembed_last_id
+
+        update_state(connection, next_model=model_name, reembed_status="backfilling", reembed_last_id=0)
+        logger.info(f"Re-embedding to {model_name}, replacing {state.active_model}.")
+        return 0
+
+# Encodes the rows after after_id into the next column in id-ordered batches, a transaction per batch that
+# also records the batch's last id, sleeping between batches to stay under max_rows_per_second
+def backfill(model_name: str, after_id: int, batch_size: int, max_rows_per_second: float):
+    started = time.monotonic()
+    processed = 0
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(NEXT_BATCH_SQL, {"after_id": after_id, "limit": batch_size}).all()
+        if not rows:
+            return after_id
+
+        with engine.begin() as connection:
+            encode_rows(connection, rows, model_name, "content_embedding_next", "embedding_model_next")
+            update_state(connection, reembed_last_id=rows[-1].id)
+        after_id = rows[-1].id
+        processed += len(rows)
+
+        if max_rows_per_second:
+            time.sleep(max(0.0, processed / max_rows_per_second - (time.monotonic() - started)))
+        logger.info(f"Re-embedded {processed} rows up to id {after_id} "
+                    f"({processed / (time.monotonic() - started):.0f} rows/sec).")
+
+# Encodes the rows the id-ordered walk missed because their insert committed behind it
+def catch_up(model_name: str, batch_size: int):
+    with engine.connect() as connection:
+        ids = connection.execute(text(
+            "SELECT id FROM magazine_content WHERE content_embedding_next IS NULL ORDER BY id"
+        )).scalars().all()
+    for start in range(0, len(ids), batch_size):
+        with engine.begin() as connection:
+            rows = connection.execute(text("""
+                SELECT id, content FROM magazine_content
+                WHERE id = ANY(:ids) AND content_embedding_next IS NULL
+            """), {"ids": ids[start:start + batch_size]}).all()
+            if rows:
+                encode_rows(connection, rows, model_name, "content_embedding_next", "embedding_model_next")
+    if ids:
+        logger.info(f"Caught up {len(ids)} rows written behind the re-embed.")
+
+def build_next_indexes():
+    with engine.begin() as connection:
+        update_state(connection, reembed_status="indexing")
+    create_indexes(concurrently=True, definitions=embedding_index_definitions("_next"))
+    with engine.begin() as connection:
+        update_state(connection, reembed_status="ready")
+
+# renames of the columns and their indexes, current -> _previous and _next -> current
+def swap_statements():
+    statements = []
+    for name, _, _ in embedding_index_definitions():
+        statements.append(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_previous;")
+        statements.append(f"ALTER INDEX {name}_next RENAME TO {name};")
+    for column in ("content_embedding", "embedding_model"):
+        statements.append(f"ALTER TABLE magazine_content RENAME COLUMN {column} TO {column}_previous;")
+        statements.append(f"ALTER TABLE magazine_content RENAME COLUMN {column}_next TO {column};")
+    return statements
+
+# The atomic switch. Writers are blocked while the rows written since the catch-up are encoded, searches only
+# for the renames at the end. Returns the largest id at the cutover.
+def cut_over(model_name: str):
+    with engine.begin() as connection:
+        connection.execute(text("SET LOCAL lock_timeout = '10s';"))
+        connection.execute(text("LOCK TABLE magazine_content IN SHARE ROW EXCLUSIVE MODE;"))
+        state = read_state(connection, for_update=True)
+        if state.next_model != model_name or state.reembed_status != "ready":
+            raise ValueError(f"No completed re-embed to {model_name} to cut over to.")
+
+        rows = connection.execute(text("""
+            SELECT id, content FROM magazine_content
+            WHERE id > :after_id AND content_embedding_next IS NULL
+            ORDER BY id
+        """), {"after_id": state.reembed_last_id - CUTOVER_LOOKBACK_IDS}).all()
+        if rows:
+            encode_rows(connection, rows, model_name, "content_embedding_next", "embedding_model_next")
+
+        connection.execute(text("LOCK TABLE magazine_content IN ACCESS EXCLUSIVE MODE;"))
+        for statement in swap_statements():
+            connection.execute(text(statement))
+        # re-points the trigger's column list at the swapped-in column, and drops the cached searches at commit
+        install_search_changed(connection)
+        notify_search_changed(connection)
+        max_id = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM magazine_content")).scalar()
+        # repairing until repair_after_cutover is done, reembed_last_id keeps the cutover's last id for it
+        update_state(connection, active_model=model_name, previous_model=state.active_model, next_model=None,
+                     reembed_status="repairing", reembed_last_id=max_id)
+    logger.info(f"Cut over from {state.active_model} to {model_name} ({len(rows)} rows encoded during the switch).")
+    return max_id
+
+# Re-encodes the rows processes wrote with the old model before they noticed the cutover. The local vector
+# indexes are rebuilt from the swapped column once the state is idle again.
+def repair_after_cutover(model_name: str, cutover_id: int, batch_size: int):
+    time.sleep(2 * EMBEDDING_MODEL_CHECK_SECONDS)
+    with engine.connect() as connection:
+        ids = connection.execute(text("""
+            SELECT id FROM magazine_content
+            WHERE id > :after_id AND embedding_model IS DISTINCT FROM :model
+            ORDER BY id
+        """), {"after_id": cutover_id - CUTOVER_LOOKBACK_IDS, "model": model_name}).scalars().all()
+    for start in range(0, len(ids), batch_size):
+        with engine.begin() as connection:
+            rows = connection.execute(text("SELECT id, content FROM magazine_content WHERE id = ANY(:ids)"),
+                                      {"ids": ids[start:start + batch_size]}).all()
+            encode_rows(connection, rows, model_name, "content_embedding", "embedding_model")
+    with engine.begin() as connection:
+        update_state(connection, reembed_status="idle", reembed_last_id=0)
+    if ids:
+        logger.info(f"Re-encoded {len(ids)} rows written with the previous model after the cutover.")
+
+def reembed(model_name: str, batch_size: int = REEMBED_BATCH_SIZE,
+            max_rows_per_second: float = REEMBED_MAX_ROWS_PER_SECOND, cutover: bool = True):
+    with advisory_lock(REEMBED_LOCK_KEY):
+        last_id = backfill(model_name, prepare_reembed(model_name), batch_size, max_rows_per_second)
+        catch_up(model_name, batch_size)
+        build_next_indexes()
+        logger.info(f"content_embedding_next is complete up to id {last_id} and indexed.")
+        if cutover:
+            cut_over_and_repair(model_name, batch_size)
+
+def cut_over_and_repair(model_name: str, batch_size: int = REEMBED_BATCH_SIZE):
+    # the processes preload the new model once they see the ready state
+    time.sleep(2 * EMBEDDING_MODEL_CHECK_SECONDS)
+    catch_up(model_name, batch_size)
+    repair_after_cutover(model_name, cut_over(model_name), batch_size)
+
+def abort_reembed():
+    with engine.begin() as connection:
+        state = read_state(connection, for_update=True)
+        connection.execute(text("SET LOCAL lock_timeout = '10s';"))
+        connection.execute(text("""
+            ALTER TABLE magazine_content
+            DROP COLUMN IF EXISTS content_embedding_next,
+            DROP COLUMN IF EXISTS embedding_model_next;
+        """))
+        update_state(connection, next_model=None, reembed_status="idle", reembed_last_id=0)
+    logger.info(f"Aborted the re-embed to {state.next_model}.")
+
+def drop_previous():
+    with engine.begin() as connection:
+        state = read_state(connection, for_update=True)
+        connection.execute(text("SET LOCAL lock_timeout = '10s';"))
+        connection.execute(text("""
+            ALTER TABLE magazine_content
+            DROP COLUMN IF EXISTS content_embedding_previous,
+            DROP COLUMN IF EXISTS embedding_model_previous;
+        """))
+        update_state(connection, previous_model=None)
+    logger.info(f"Dropped the {state.previous_model} embeddings.")
+
+def reembed_status():
+    with engine.connect() as connection:
+        state = read_state(connection)
+        max_id = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM magazine_content")).scalar()
+    return {
+        "active_model": state.active_model,
+        "next_model": state.next_model,
+        "status": state.reembed_status,
+        "last_id": state.reembed_last_id,
+        "max_id": max_id,
+        "previous_model": state.previous_model,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Re-embed the stored content with another embedding model.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    start_parser = commands.add_parser("start", help="Re-embed into a new column (resumes an interrupted run)")
+    start_parser.add_argument("--model", required=True, help="Model name, or an exported directory for onnx")
+    start_parser.add_argument("--batch-size", type=int, default=REEMBED_BATCH_SIZE)
+    start_parser.add_argument("--max-rows-per-second", type=float, default=REEMBED_MAX_ROWS_PER_SECOND,
+                              help="Rate limit, 0 runs unthrottled")
+    start_parser.add_argument("--threads", type=int, default=REEMBED_THREADS, help="Intra-op threads of the model")
+    start_parser.add_argument("--no-cutover", action="store_true", help="Stop once the new column is indexed")
+
+    cutover_parser = commands.add_parser("cutover", help="Switch to the completed re-embed, or finish the repair "
+                                                         "of an interrupted cutover")
+    cutover_parser.add_argument("--batch-size", type=int, default=REEMBED_BATCH_SIZE)
+    cutover_parser.add_argument("--threads", type=int, default=REEMBED_THREADS)
+
+    commands.add_parser("status", help="Show the active model and the re-embed progress")
+    commands.add_parser("abort", help="Drop the partially filled new column")
+    commands.add_parser("drop-previous", help="Drop the embeddings of the model replaced by the last cutover")
+
+    args = parser.parse_args()
+    if args.command == "start":
+        set_model_threads(args.threads)
+        reembed(args.model, args.batch_size, args.max_rows_per_second, not args.no_cutover)
+    elif args.command == "cutover":
+        set_model_threads(args.threads)
+        with advisory_lock(REEMBED_LOCK_KEY):
+            state = reembed_status()
+            if state["status"] == "repairing":
+                repair_after_cutover(state["active_model"], state["last_id"], args.batch_size)
+            else:
+                cut_over_and_repair(state["next_model"], args.batch_size)
+    elif args.command == "status":
+        for key, value in reembed_status().items():
+            print(f"{key}: {value}")
+    elif args.command == "abort":
+        with advisory_lock(REEMBED_LOCK_KEY):
+            abort_reembed()
+    elif args.command == "drop-previous":
+        drop_previous()
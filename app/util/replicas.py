@@ -0,0 +1,42 @@
+import time
+from itertools import count
+from threading import Lock
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Spreads read sessions across the replica engines round robin. A replica that failed to hand out a
+# connection is left out for retry_seconds, then tried again by the next read; while every replica is
+# out, reads go to the primary. Holds sync or async engines alike, the caller does the connecting.
+class ReadReplicas:
+    def __init__(self, engines: list, primary, retry_seconds: float):
+        self.engines = list(engines)
+        self.primary = primary
+        self.retry_seconds = retry_seconds
+        self._down_until = {id(engine): 0.0 for engine in self.engines}
+        self._turn = count()
+        self._lock = Lock()
+
+    # engines to try in order for the next read: the healthy replicas starting at this read's turn, then the primary
+    def candidates(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [engine for engine in self.engines if self._down_until[id(engine)] <= now]
+        if healthy:
+            start = next(self._turn) % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        return healthy + [self.primary]
+
+    def mark_down(self, engine, error: Exception):
+        if engine is self.primary:
+            return
+        with self._lock:
+            self._down_until[id(engine)] = time.monotonic() + self.retry_seconds
+        logger.warning(f"Read replica {engine.url.render_as_string(hide_password=True)} failed, "
+                       f"skipping it for {self.retry_seconds:.0f}s: {str(error).splitlines()[0]}")
+
+    def healthy_count(self):
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for until in self._down_until.values() if until <= now)
@@ -0,0 +1,24 @@
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from app.schemas.magazine import MagazineResponse
+from app.util.timing import span
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# store responses report how many content encodes were skipped because the content was already stored
+ENCODES_AVOIDED_HEADER = "X-Encodes-Avoided"
+
+# Search responses are built from our own rows with model_construct, so running them through FastAPI's
+# response_model validation and jsonable_encoder again only costs time. They are dumped straight to JSON
+# instead, leaving out the fields that were never set (the ones not asked for with `fields=`).
+def json_response(model: BaseModel, status_code: int = 200):
+    with span("render"):
+        content = model.model_dump_json(exclude_unset=True)
+    return Response(content=content, status_code=status_code, media_type="application/json")
+
+def empty_search_response(page: int, page_size: int):
+    return json_response(MagazineResponse(magazines=[], page=page, page_size=page_size, total_results=0,
+                                          total_pages=0, total_is_approximate=False, next_cursor=None))
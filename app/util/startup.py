@@ -0,0 +1,88 @@
+from threading import Lock, Thread
+from app.config import VECTOR_SEARCH_ENGINE
+from app.database import engine, Base
+from app.services.magazine_service import invalidate_search_caches
+from app.util.ann_index import local_vector_index
+from app.util.ingest_worker import start_ingest_workers
+from app.util.migrations import (
+    SEARCH_CHANGED_CHANNEL, install_content_hash, install_embedding_model_state, install_facet_counts,
+    install_search_changed, install_search_document,
+)
+from app.util.utils import (
+    advisory_lock, create_indexes, refresh_embedding_model, warm_up_model, watch_embedding_model,
+    watch_notifications,
+)
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Readiness of the slow start-up steps. The server binds immediately and these run in background
+# threads; /health/ready only reports ready once every one of them has finished.
+_state = {"database": False, "indexes": False, "model": False}
+if VECTOR_SEARCH_ENGINE == "local":
+    _state["vector_index"] = False
+_errors = {}
+_lock = Lock()
+
+
+def _mark(step: str, ready: bool, error: Exception = None):
+    with _lock:
+        _state[step] = ready
+        if error is not None:
+            _errors[step] = str(error)
+        else:
+            _errors.pop(step, None)
+
+def prepare_database():
+    step = "database"
+    try:
+        # one worker at a time, the others find the tables and indexes already in place
+        with advisory_lock():
+            # Create database tables
+            Base.metadata.create_all(bind=engine)
+            with engine.begin() as connection:
+                install_search_document(connection)
+                install_facet_counts(connection)
+                install_embedding_model_state(connection)
+                install_content_hash(connection)
+                install_search_changed(connection)
+            # encode with the model the stored vectors came from, and follow re-embed cutovers
+            refresh_embedding_model()
+            watch_embedding_model()
+            # drop cached search responses whenever any process commits a write
+            watch_notifications(SEARCH_CHANGED_CHANNEL, invalidate_search_caches, "search-cache-invalidation")
+            _mark(step, True)
+            # the staging tables exist now, ingest jobs can be drained
+            start_ingest_workers()
+
+            #create missing indexes without blocking writes
+            step = "indexes"
+            create_indexes(concurrently=True)
+            _mark(step, True)
+
+        #catch the local vector index up with rows written since it was last synced, then keep it synced
+        if VECTOR_SEARCH_ENGINE == "local":
+            step = "vector_index"
+            local_vector_index.sync_from_db()
+            local_vector_index.watch()
+            _mark(step, True)
+    except Exception as e:
+        logger.error(f"Database preparation failed at step '{step}': {e}", exc_info=True)
+        _mark(step, False, e)
+
+def prepare_model():
+    try:
+        warm_up_model()
+        _mark("model", True)
+    except Exception as e:
+        logger.error(f"Model warm-up failed: {e}", exc_info=True)
+        _mark("model", False, e)
+
+def start_background_startup():
+    for target in (prepare_database, prepare_model):
+        Thread(target=target, name=target.__name__, daemon=True).start()
+
+def readiness():
+    with _lock:
+        return all(_state.values()), dict(_state), dict(_errors)
@@ -0,0 +1,130 @@
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from fastapi.routing import APIRoute
+
+from app.util.metrics import request_duration, stage_duration
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per-request timing spans. Every span is recorded in the stage_duration histogram, and when it runs
+# inside a request it is also added to that request's timings, which TimingMiddleware reports in the
+# Server-Timing response header. FastAPI copies the context into the threadpool running sync endpoints,
+# so the dict set by the middleware is the one spans in request threads add to.
+_request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+def record(stage: str, seconds: float):
+    stage_duration.observe(seconds, stage=stage)
+    add_to_request(stage, seconds)
+
+# only reported in Server-Timing, for time that already has its own histogram
+def add_to_request(stage: str, seconds: float):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+# decorator form of span, for repository and utility functions (sync or async)
+def timed(stage: str):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def server_timing_header(timings: dict):
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()
+                     if not stage.startswith("_"))
+
+
+# Times the endpoint function itself and remembers when it returned, so the middleware can attribute the
+# remaining time until the response starts to response validation and serialization
+class TimedRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, self._timed_endpoint(endpoint), **kwargs)
+
+    @staticmethod
+    def _timed_endpoint(endpoint):
+        def finished(started):
+            record("endpoint", time.perf_counter() - started)
+            timings = _request_timings.get()
+            if timings is not None:
+                timings["_endpoint_finished"] = time.perf_counter()
+
+        if inspect.iscoroutinefunction(endpoint):
+            @wraps(endpoint)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    finished(started)
+            return async_wrapper
+
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                finished(started)
+        return wrapper
+
+
+# ASGI middleware setting up the per-request timings, adding the Server-Timing header and recording the
+# request latency by route template (not raw path, which would explode the label cardinality)
+class TimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = {}
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                now = time.perf_counter()
+                if "_endpoint_finished" in timings:
+                    record("serialize", now - timings["_endpoint_finished"])
+                timings["total"] = now - started
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing_header(timings).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = scope.get("route")
+            request_duration.observe(time.perf_counter() - started, method=scope["method"],
+                                     route=getattr(route, "path", "unmatched"), status=status_code)
+            _request_timings.reset(token)
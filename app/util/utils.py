@@ -1,64 +1,314 @@
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import inspect, text
+import asyncio
+import contextvars
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock, Thread
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.pool import NullPool
 from app.database import engine
+from app.config import (
+    EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_CHECK_SECONDS, VECTOR_STORAGE_MODE,
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL,
+    EMBEDDING_BATCHING_ENABLED, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT_MS,
+    EMBEDDING_EXECUTOR_THREADS,
+)
+from app.util.cache import LRUCache
+from app.util.embedding_backends import create_backend
+from app.util.embedding_batcher import EmbeddingBatcher
+from app.util.timing import timed
+from app.util.vector_storage import compact_index_definition
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-# selected this model looking at its speed and performance ratio
-model = SentenceTransformer("multi-qa-MiniLM-L6-cos-v1")  
+# loaded on first use (or by the startup warm-up) so importing this module stays cheap,
+# the backend (PyTorch or quantized ONNX) is picked by EMBEDDING_BACKEND. Models are kept by name: the
+# active one encodes queries and new content, during a re-embed the next one is preloaded for the cutover.
+_models = {}
+_model_lock = Lock()
+_model_threads = 0
+# the model whose vectors content_embedding holds, followed from embedding_model_state
+_active_model = EMBEDDING_MODEL_NAME
+# the re-embed status last read with it, a cutover can only come while it isn't idle
+_reembed_status = "idle"
+
+def active_model_name():
+    return _active_model
+
+def get_model(model_name: str = None):
+    model_name = model_name or _active_model
+    model = _models.get(model_name)
+    if model is None:
+        with _model_lock:
+            model = _models.get(model_name)
+            if model is None:
+                logger.info(f"Loading {EMBEDDING_BACKEND} embedding backend for {model_name}.")
+                model = _models[model_name] = create_backend(EMBEDDING_BACKEND, _model_threads, model_name)
+    return model
+
+# intra-op threads for the model of this process (0 keeps the backend default), applied to an already
+# loaded model when the backend supports it, so forked server workers can split the cores between them
+def set_model_threads(threads: int):
+    global _model_threads
+    _model_threads = threads
+    for model in list(_models.values()):
+        if hasattr(model, "set_threads"):
+            model.set_threads(threads)
+
+# loads the model and runs one encode so the first real request doesn't pay for lazy initialisation
+def warm_up_model():
+    get_model().encode("warm up")
+    logger.info("Embedding model loaded and warmed up.")
+
+# search traffic repeats the same queries a lot, so their embeddings are cached per worker
+query_embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
 
 # utlity method to create embedding of content field of magazine
-def get_embeddings(text: str):
-    return model.encode(text)
+@timed("embedding")
+def get_embeddings(text: str, model_name: str = None):
+    return get_model(model_name).encode(text)
+
+# batched variant used by bulk ingestion, encodes many contents in a single call
+@timed("embedding_batch")
+def get_embeddings_batch(texts: list, batch_size: int = EMBEDDING_BATCH_SIZE, model_name: str = None):
+    return get_model(model_name).encode(texts, batch_size=batch_size)
+
+EMBEDDING_MODEL_STATE_SQL = text("""
+    SELECT active_model, next_model, reembed_status FROM embedding_model_state WHERE id = 1
+""")
+
+# Follows embedding_model_state (see app.util.reembed): preloads the next model once its column is complete,
+# so the cutover doesn't wait on a model load, and switches query and ingest encoding to it at the cutover
+def refresh_embedding_model():
+    global _active_model, _reembed_status
+    with engine.connect() as connection:
+        state = connection.execute(EMBEDDING_MODEL_STATE_SQL).first()
+    if state is None:
+        return
+    if state.reembed_status == "ready" and state.next_model:
+        get_model(state.next_model)
+    if state.active_model != _active_model:
+        get_model(state.active_model)
+        logger.info(f"Embedding model switched from {_active_model} to {state.active_model}.")
+        _active_model = state.active_model
+    _reembed_status = state.reembed_status
+    # releases the previous model after a cutover (or one loaded before the state was first read)
+    with _model_lock:
+        for name in [name for name in _models if name not in (state.active_model, state.next_model)]:
+            del _models[name]
+
+def watch_embedding_model(interval: float = EMBEDDING_MODEL_CHECK_SECONDS):
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh_embedding_model()
+            except Exception as e:
+                logger.warning(f"Could not read the embedding model state: {e}")
+
+    Thread(target=watch, name="embedding-model-watcher", daemon=True).start()
+
+# Runs callback in a daemon thread after every NOTIFY on channel, listening on a connection of its own outside
+# the pools. Notifications sent while that connection was down are lost, so callback also runs on every
+# (re)connect; an idle connection is probed every interval seconds so a dead one is noticed.
+def watch_notifications(channel: str, callback, name: str, interval: float = 30, retry_seconds: float = 5):
+    listen_engine = create_engine(engine.url, poolclass=NullPool)
+
+    def listen():
+        while True:
+            try:
+                with listen_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                    connection.exec_driver_sql(f"LISTEN {channel}")
+                    dbapi_connection = connection.connection.driver_connection
+                    callback()
+                    while True:
+                        if select.select([dbapi_connection], [], [], interval) == ([], [], []):
+                            connection.exec_driver_sql("SELECT 1")
+                            continue
+                        dbapi_connection.poll()
+                        if dbapi_connection.notifies:
+                            dbapi_connection.notifies.clear()
+                            callback()
+            except Exception as e:
+                logger.warning(f"Lost the {channel} listener connection, reconnecting: {e}")
+                time.sleep(retry_seconds)
+
+    Thread(target=listen, name=name, daemon=True).start()
+
+# the model is uncased, so queries differing only in case or spacing share one cache entry
+def normalize_query(query: str):
+    return " ".join(query.split()).lower()
+
+# the batched items are (model name, query) pairs, a batch straddling a cutover is encoded once per model
+def encode_query_batch(items: list):
+    embeddings = {}
+    for model_name in dict.fromkeys(model_name for model_name, _ in items):
+        texts = [text for name, text in items if name == model_name]
+        embeddings.update(zip([(model_name, text) for text in texts],
+                              get_embeddings_batch(texts, model_name=model_name)))
+    return [embeddings[item] for item in items]
+
+# concurrent cache misses from all request threads share batched forward passes
+query_batcher = EmbeddingBatcher(encode_query_batch, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT_MS)
+
+SEARCH_MODEL_LOCK_SQL = text("LOCK TABLE magazine_content IN ACCESS SHARE MODE")
+SEARCH_MODEL_SQL = text("SELECT active_model FROM embedding_model_state WHERE id = 1")
+
+# The model to encode a search's query with. While a re-embed is under way the cutover can swap the columns at
+# any moment, and this process only notices within EMBEDDING_MODEL_CHECK_SECONDS. So the search transaction
+# first locks magazine_content, which waits out a cutover in progress (it holds the table exclusively until it
+# commits) and keeps the next one off until the search is done, and then reads the model the column holds.
+def search_model(db):
+    if _reembed_status == "idle":
+        return _active_model
+    db.execute(SEARCH_MODEL_LOCK_SQL)
+    return db.execute(SEARCH_MODEL_SQL).scalar()
 
-def create_indexes():
+async def search_model_async(db):
+    if _reembed_status == "idle":
+        return _active_model
+    await db.execute(SEARCH_MODEL_LOCK_SQL)
+    return (await db.execute(SEARCH_MODEL_SQL)).scalar()
+
+# cached embedding lookup for search queries, skips the encode entirely on a hit. Entries are keyed by the
+# model too, so a switch of the active model never serves an embedding of the previous one. model_name
+# defaults to the active model, searches pass the one from search_model.
+@timed("query_embedding")
+def get_query_embedding(query: str, model_name: str = None):
+    model_name = model_name or _active_model
+    key = normalize_query(query)
+    cache_key = (model_name, key)
+    embedding = query_embedding_cache.get(cache_key)
+    if embedding is None:
+        embedding = query_batcher.encode(cache_key) if EMBEDDING_BATCHING_ENABLED else get_embeddings(key, model_name)
+        # cached arrays are shared between requests, so guard them against in-place changes
+        embedding.setflags(write=False)
+        query_embedding_cache.put(cache_key, embedding)
+    return embedding
+
+# CPU-bound work of the async request path (encodes, local index scans) runs here instead of on the event loop
+embedding_executor = ThreadPoolExecutor(EMBEDDING_EXECUTOR_THREADS, thread_name_prefix="embedding")
+
+# runs function on the embedding executor inside a copy of the caller's context, so timing spans still
+# reach the request they belong to
+async def run_in_embedding_executor(function, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(embedding_executor, partial(context.run, function, *args))
+
+# async get_query_embedding: cache hits return straight away, misses await the batcher's future (or the
+# executor when batching is off) so no thread is parked while the batch is encoded
+@timed("query_embedding")
+async def get_query_embedding_async(query: str, model_name: str = None):
+    model_name = model_name or _active_model
+    key = normalize_query(query)
+    cache_key = (model_name, key)
+    embedding = query_embedding_cache.get(cache_key)
+    if embedding is None:
+        if EMBEDDING_BATCHING_ENABLED:
+            embedding = await asyncio.wrap_future(query_batcher.submit(cache_key))
+        else:
+            embedding = await run_in_embedding_executor(get_embeddings, key, model_name)
+        embedding.setflags(write=False)
+        query_embedding_cache.put(cache_key, embedding)
+    return embedding
+
+# name, definition and description of every secondary index, in creation order
+INDEX_DEFINITIONS = [
+    ("idx_content_embedding_cosine", "ON magazine_content USING hnsw (content_embedding vector_cosine_ops)",
+     "HNSW index (Vector Cosine)"),
+    ("idx_magazine_title", "ON magazine_information (title)",
+     "Index for magazine_information --> title"),
+    # (filter column, publish_date) composites serve the search filters alone or with a date range
+    ("idx_magazine_author_date", "ON magazine_information (author, publish_date)",
+     "Index for magazine_information --> author, publish_date"),
+    ("idx_magazine_category_date", "ON magazine_information (category, publish_date)",
+     "Index for magazine_information --> category, publish_date"),
+    ("idx_magazine_publish_date", "ON magazine_information (publish_date)",
+     "Index for magazine_information --> publish_date"),
+    ("idx_search_document", "ON magazine_content USING GIN(search_document)",
+     "Index (GIN) for magazine_content --> search_document"),
+    ("idx_score", "ON magazine_content USING btree(content_embedding)",
+     "Index (B-TREE) for magazine_content --> content_embedding"),
+    ("idx_magazine_id", "ON magazine_content(magazine_id)",
+     "Indexes for magazine_content --> magazine_id"),
+    # not unique, on_duplicate=insert stores the same content more than once
+    ("idx_content_hash", "ON magazine_content (content_hash)",
+     "Index for magazine_content --> content_hash"),
+]
+
+# the compact storage modes search their own HNSW index
+if VECTOR_STORAGE_MODE != "full":
+    INDEX_DEFINITIONS.append(compact_index_definition(VECTOR_STORAGE_MODE))
+
+# definitions defaults to INDEX_DEFINITIONS, the re-embed passes the indexes of the column it fills
+def create_indexes(maintenance_work_mem: str = None, concurrently: bool = False, definitions: list = None):
+    definitions = INDEX_DEFINITIONS if definitions is None else definitions
     try:
-        with engine.connect() as connection:
-            # Create HNSW indexes for content_embedding
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_content_embedding_cosine
-                ON magazine_content USING hnsw (content_embedding vector_cosine_ops);
-            """))
-            logger.info('HNSW index (Vector Cosine) created successfully.')
-
-            # Create indexes for magazine_information
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_magazine_title
-                ON magazine_information (title);
-            """))
-            logger.info('Index for magazine_information --> title created successfully.')
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_magazine_author
-                ON magazine_information (author);
-            """))
-            logger.info('Index for magazine_information --> author created successfully.')
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_magazine_title_trgm ON magazine_information USING GIN(title gin_trgm_ops);
-            """))
-            logger.info('Index (GIN+TRIGRAM) for magazine_content --> title created successfully.')
-
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_magazine_author_trgm ON magazine_information USING GIN(author gin_trgm_ops);
-            """))
-            logger.info('Index GIN+TRIGRAM for magazine_information --> Author created successfully.')
-
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS content_tsvector_idx ON magazine_content USING GIN(content_tsvector);
-            """))
-            logger.info('Index (GIN) for magazine_content --> content_tsvector created successfully.')
-
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_score ON magazine_content USING btree(content_embedding);
-            """))
-            logger.info('Index (B-TREE) for magazine_content --> content_embedding created successfully.')
-
-            connection.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_magazine_id ON magazine_content(magazine_id);
-            """))
-            logger.info('Indexes for magazine_content --> magazine_id created successfully.')
+        if concurrently:
+            return _create_indexes_concurrently(maintenance_work_mem, definitions)
+
+        with engine.begin() as connection:
+            # bulk loads pass a larger budget so the HNSW graph is built in memory
+            if maintenance_work_mem:
+                connection.execute(text("SELECT set_config('maintenance_work_mem', :value, true)"),
+                                   {"value": maintenance_work_mem})
+
+            for name, definition, description in definitions:
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} {definition};"))
+                logger.info(f'{description} created successfully.')
 
     except Exception as error:
         logger.error(f'Error creating indexes: {error}')
-        raise error
\ No newline at end of file
+        raise error
+
+# CREATE INDEX CONCURRENTLY keeps the tables writable while the server is already serving traffic.
+# It can't run inside a transaction, and an interrupted build leaves an INVALID index behind that
+# IF NOT EXISTS would silently keep, so those are dropped and rebuilt.
+def _create_indexes_concurrently(maintenance_work_mem: str = None, definitions: list = INDEX_DEFINITIONS):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if maintenance_work_mem:
+            connection.execute(text("SELECT set_config('maintenance_work_mem', :value, false)"),
+                               {"value": maintenance_work_mem})
+
+        for name, definition, description in definitions:
+            invalid = connection.execute(text("""
+                SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+                WHERE c.relname = :name AND NOT i.indisvalid
+            """), {"name": name}).first()
+            if invalid:
+                logger.warning(f'Dropping invalid index {name} left by an interrupted build.')
+                connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name};"))
+
+            connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};"))
+            logger.info(f'{description} created successfully.')
+
+# key of the advisory lock serialising schema and index builds
+SCHEMA_LOCK_KEY = 7262051
+
+# Session level advisory lock, so when several server workers (or hosts) start at once only one of them
+# creates tables and indexes while the others wait and then find everything in place. The connection is in
+# autocommit, an open transaction would make CREATE INDEX CONCURRENTLY in another session wait for it.
+@contextmanager
+def advisory_lock(key: int = SCHEMA_LOCK_KEY):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+# used before bulk loads, building indexes once afterwards is far cheaper than maintaining them row by row
+def drop_indexes():
+    try:
+        with engine.begin() as connection:
+            for name, _, description in INDEX_DEFINITIONS:
+                connection.execute(text(f"DROP INDEX IF EXISTS {name};"))
+                logger.info(f'{description} dropped.')
+
+    except Exception as error:
+        logger.error(f'Error dropping indexes: {error}')
+        raise error
@@ -0,0 +1,42 @@
+from app.config import EMBEDDING_DIMENSION, VECTOR_STORAGE_MODE
+
+# Opt-in compact copies of content_embedding for the ANN index (pgvector >= 0.7). The HNSW index is built
+# on the compact column, candidates are over-fetched from it and re-ranked with the full-precision vectors.
+#   halfvec - half precision floats, half the index size with near identical recall
+#   binary  - one bit per dimension compared by hamming distance, 32x smaller, needs a larger oversample
+# {source} is the full-precision vector expression the compact value is derived from.
+COMPACT_VECTOR_STORAGE = {
+    "halfvec": {
+        "column": "content_embedding_half",
+        "type": f"halfvec({EMBEDDING_DIMENSION})",
+        "expression": "{source}::halfvec(%d)" % EMBEDDING_DIMENSION,
+        "operator": "<=>",
+        "index": "idx_content_embedding_half_cosine",
+        "opclass": "halfvec_cosine_ops",
+    },
+    "binary": {
+        "column": "content_embedding_bits",
+        "type": f"bit({EMBEDDING_DIMENSION})",
+        "expression": "binary_quantize({source})::bit(%d)" % EMBEDDING_DIMENSION,
+        "operator": "<~>",
+        "index": "idx_content_embedding_bits_hamming",
+        "opclass": "bit_hamming_ops",
+    },
+}
+
+
+def compact_storage(mode: str = VECTOR_STORAGE_MODE):
+    if mode == "full":
+        return None
+    if mode not in COMPACT_VECTOR_STORAGE:
+        raise ValueError(f"Unknown vector storage mode '{mode}', expected full, {', '.join(COMPACT_VECTOR_STORAGE)}")
+    return COMPACT_VECTOR_STORAGE[mode]
+
+# (name, definition, description) of the ANN index on the compact column, in INDEX_DEFINITIONS format
+def compact_index_definition(mode: str = VECTOR_STORAGE_MODE):
+    storage = compact_storage(mode)
+    return (
+        storage["index"],
+        f"ON magazine_content USING hnsw ({storage['column']} {storage['opclass']})",
+        f"HNSW index ({mode}) for magazine_content --> {storage['column']}",
+    )